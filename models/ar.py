@@ -0,0 +1,88 @@
+"""
+AR Model Module
+---------------
+This module contains a lightweight autoregressive model for the hourly price series of one station and fuel, as produced by
+process_prices.resample_timestamps(). It only needs numpy, is fitted with least squares in milliseconds and keeps its coefficients
+as plain arrays, so that thousands of station models can be trained in parallel (models.scheduler) and evaluated together (models.inference).
+
+It includes:
+
+    - lag_matrix(): design matrix of the lagged values of a series.
+
+    - ARModel: AR(p) model with intercept, fitted with (ridge) least squares and predicted recursively.
+
+    - fit_arima(): optional pmdarima model with the same fit interface, if pmdarima is installed.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def lag_matrix(values: np.ndarray, lags: int):
+    """Returns the lagged values of a series as matrix (most recent lag first) and the target values they predict.
+
+    Returns:
+        tuple: (X of shape (n - lags) x lags, y of length n - lags)
+    """
+    windows = sliding_window_view(values, lags + 1)
+    return windows[:, -2::-1], windows[:, -1]
+
+
+class ARModel:
+    """AR(p) model: y_t = intercept + sum_i coef_i * y_(t-i). Predictions for several steps feed back their own forecasts.
+
+    Attributes:
+        lags (int): order p of the model
+        ridge (float): L2 penalty of the coefficients, stabilizes flat series with many constant prices
+        coef (np.ndarray): coefficients of lag 1 to p
+        intercept (float): intercept
+        n_obs (int): number of observations the model was fitted on
+    """
+
+    kind = 'ar'
+
+    def __init__(self, lags: int=24, ridge: float=1e-6):
+        self.lags = lags
+        self.ridge = ridge
+        self.coef = None
+        self.intercept = np.nan
+        self.n_obs = 0
+
+    def get_params(self) -> dict:
+        return {'lags': self.lags, 'ridge': self.ridge}
+
+    def fit(self, values):
+        """Fits the model to a series without gaps. Series shorter than 2 * lags are fitted as constant at their mean."""
+
+        values = np.asarray(values, dtype=float)
+        self.n_obs = len(values)
+        self.coef = np.zeros(self.lags)
+        if len(values) < 2 * self.lags:
+            self.intercept = float(np.mean(values)) if len(values) else np.nan
+            return self
+
+        X, y = lag_matrix(values, self.lags)
+        # center the series, so that the intercept is not penalized
+        mean = values.mean()
+        X, y = X - mean, y - mean
+        self.coef = np.linalg.solve(X.T @ X + self.ridge * len(y) * np.eye(self.lags), X.T @ y)
+        self.intercept = float(mean * (1 - self.coef.sum()))
+        return self
+
+    def predict(self, history, steps: int=24) -> np.ndarray:
+        """Forecasts the next steps after the history, which needs at least lags values"""
+
+        window = list(np.asarray(history, dtype=float)[-self.lags:][::-1])
+        forecast = np.empty(steps)
+        for step in range(steps):
+            forecast[step] = self.intercept + np.dot(self.coef, window)
+            window = [forecast[step]] + window[:-1]
+        return forecast
+
+
+def fit_arima(values, **params):
+    """Fits a pmdarima auto_arima model, as an alternative to ARModel with the same interface for the scheduler. Requires the pmdarima package."""
+    import pmdarima
+
+    model = pmdarima.auto_arima(np.asarray(values, dtype=float), suppress_warnings=True, error_action='ignore', **params)
+    model.kind = 'arima'
+    return model
@@ -0,0 +1,184 @@
+"""
+Inference Module
+----------------
+This module contains the batch inference path for the station models trained with models.scheduler. Instead of calling the predict
+method of each model in a loop, models are grouped by their kind and models with linear coefficients (ARModel) are evaluated together:
+their coefficients are stacked into one stations x lags matrix and all stations are forecast with one array operation per step.
+Other models (e.g. pmdarima) fall back to a loop over their stations. Models are loaded lazily through an LRU cache, so an hourly refresh
+only reads the models of new or retrained stations from disk:
+
+    forecaster = BatchForecaster(MODELS_DIR, 'diesel', model='ar')
+    panel = load_panel(ROOT_DIR / 'resampled_prices' / 'diesel', start='2023-05-01')
+    forecast = forecaster.predict(panel, steps=24)
+
+The forecast is a panel on the same station x time grid as process_prices.resample_timestamps(), continuing the timestamps of the input.
+
+It includes:
+
+    - ModelCache: LRU cache of station models loaded from the model directory.
+
+    - stack_ar(): stack the coefficients of AR models into arrays.
+
+    - forecast_ar(): forecast many stations with stacked AR coefficients at once.
+
+    - history_matrix(): stations x timestamps matrix of the last values of a resampled panel.
+
+    - BatchForecaster: batch forecasts of all stations of a panel, grouped by model kind.
+"""
+import pickle
+from pathlib import Path
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+from src import process
+from src.config.paths import MODELS_DIR
+from .scheduler import model_file, forecast
+
+
+class ModelCache:
+    """LRU cache of station models. Models are loaded from their pickle file on first use, the least recently used are dropped beyond capacity.
+       Each use checks the modification time of the model file, so models that TrainingScheduler retrains or trains for new stations
+       replace the cached ones in a long-running process.
+
+    Attributes:
+        directory (Path): model directory of a fuel and model, see TrainingScheduler.directory
+        capacity (int): maximum number of models in memory
+        models (OrderedDict): station -> (model, modification time of its file), the most recently used last. (None, None) for stations without a model file.
+    """
+
+    def __init__(self, directory, capacity: int=20_000):
+        self.directory = Path(directory)
+        self.capacity = capacity
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, station: str):
+        file = model_file(self.directory, station)
+        try:
+            mtime = file.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if station in self.models and self.models[station][1] == mtime:
+            self.hits += 1
+            self.models.move_to_end(station)
+            return self.models[station][0]
+
+        self.misses += 1
+        model = None
+        if mtime is not None:
+            with open(file, 'rb') as f:
+                model = pickle.load(f)['model']
+        self.models[station] = (model, mtime)
+        self.models.move_to_end(station)
+        if len(self.models) > self.capacity:
+            self.models.popitem(last=False)
+        return model
+
+    def clear(self):
+        self.models.clear()
+
+
+def stack_ar(models: list):
+    """Stacks the coefficients of AR models with possibly different orders, shorter models are padded with zero coefficients.
+
+    Returns:
+        tuple: (coefficients of shape models x max lags, intercepts)
+    """
+    lags = max(len(model.coef) for model in models)
+    coef = np.zeros((len(models), lags))
+    for row, model in enumerate(models):
+        coef[row, :len(model.coef)] = model.coef
+    intercepts = np.array([model.intercept for model in models], dtype=float)
+    return coef, intercepts
+
+
+def forecast_ar(coef: np.ndarray, intercepts: np.ndarray, history: np.ndarray, steps: int) -> np.ndarray:
+    """Recursive forecasts of many AR models at once, like ARModel.predict() for each row.
+
+    Args:
+        coef (np.ndarray): coefficients of shape stations x lags, lag 1 first
+        intercepts (np.ndarray): intercept of each station
+        history (np.ndarray): last values of each station of shape stations x (at least lags), oldest first
+        steps (int): number of steps to forecast
+
+    Returns:
+        np.ndarray: forecasts of shape stations x steps
+    """
+    lags = coef.shape[1]
+    # window of the most recent values, lag 1 first
+    window = history[:, :-lags - 1:-1].copy() if lags else np.empty((len(history), 0))
+    forecasts = np.empty((len(history), steps))
+    for step in range(steps):
+        forecasts[:, step] = intercepts + np.einsum('ij,ij->i', coef, window)
+        window = np.concatenate([forecasts[:, step:step + 1], window[:, :-1]], axis=1)
+    return forecasts
+
+
+def history_matrix(panel: pd.DataFrame, column: str, date: str='date', individual: str='station'):
+    """Aligns a resampled panel to its station x time grid and returns the values as matrix. Gaps are forward filled per station.
+
+    Returns:
+        tuple: (sorted stations, sorted timestamps, np.ndarray of shape stations x timestamps)
+    """
+    panel = panel[[column]].reorder_levels([individual, date])
+    stations = panel.index.get_level_values(individual).unique().sort_values()
+    dates = panel.index.get_level_values(date).unique().sort_values()
+    grid = process.reindex_product(panel, [stations, dates])
+    values = grid[column].to_numpy(dtype=float).reshape(len(stations), len(dates))
+    values = pd.DataFrame(values.T).ffill().to_numpy().T
+    return stations, dates, values
+
+
+class BatchForecaster:
+    """Batch forecasts of all stations of a resampled panel with their trained models.
+
+    Attributes:
+        fuel (str): price column to forecast
+        cache (ModelCache): lazily loaded models of MODELS_DIR/fuel/model
+    """
+
+    def __init__(self, directory=MODELS_DIR, fuel: str='diesel', model: str='ar', capacity: int=20_000):
+        self.fuel = fuel
+        self.cache = ModelCache(Path(directory) / fuel / model, capacity)
+
+    def predict(self, panel: pd.DataFrame, steps: int=24, freq: str=None) -> pd.DataFrame:
+        """Forecasts the next steps of all stations in the panel.
+
+        Args:
+            panel (pd.DataFrame): resampled panel indexed by station and date, e.g. the output of resample_timestamps() or load_panel()
+            steps (int, optional): number of timestamps to forecast. Defaults to 24.
+            freq (str, optional): frequency of the panel. Defaults to None, inferred from the timestamps.
+
+        Returns:
+            pd.DataFrame: panel indexed by station and date with the fuel column for the steps after the last timestamp of the panel.
+                          Stations without a model are NaN.
+        """
+        stations, dates, values = history_matrix(panel, self.fuel)
+        freq = freq or pd.infer_freq(dates) or (dates[-1] - dates[-2])
+        future = pd.date_range(dates[-1], periods=steps + 1, freq=freq)[1:]
+
+        forecasts = np.full((len(stations), steps), np.nan)
+        kinds = {}
+        for row, station in enumerate(stations):
+            model = self.cache.get(station)
+            if model is not None:
+                kinds.setdefault(getattr(model, 'kind', None), []).append((row, model))
+
+        for kind, group in kinds.items():
+            rows = np.array([row for row, _ in group])
+            models = [model for _, model in group]
+            if kind == 'ar':
+                coef, intercepts = stack_ar(models)
+                history = values[rows, -max(coef.shape[1], 1):]
+                forecasts[rows] = forecast_ar(coef, intercepts, history, steps)
+            else:
+                for row, model in group:
+                    history = values[row][~np.isnan(values[row])]
+                    forecasts[row] = forecast(model, history, steps)
+
+        index = process.product_index([stations, future], ['station', 'date'])
+        return pd.DataFrame({self.fuel: forecasts.ravel()}, index=index)
@@ -0,0 +1,268 @@
+"""
+Scheduler Module
+----------------
+This module contains the training scheduler for per-station forecasting models. It takes the resampled per-fuel panels of
+process_prices.resample_timestamps() (one file per day, or the merged file of FileMerger), shards the stations across a process pool
+and persists the fitted model and its metrics for each station:
+
+    panel = load_panel(ROOT_DIR / 'resampled_prices' / 'diesel', start='2023-01-01', end='2023-04-30')
+    scheduler = TrainingScheduler(MODELS_DIR, 'diesel', model='ar', params={'lags': 24}, workers=8)
+    metrics = scheduler.run(panel)
+
+Each station is only trained again if its series or the hyperparameters changed: a content hash of both is stored in the index of the
+model directory (MODELS_DIR/fuel/model/index.csv) together with the metrics, the models themselves are pickled per station.
+Workers only receive the series of their shard and only return metrics, and at most max_pending shards are in flight, so the memory of
+each worker and of the scheduler stays bounded independent of the number of stations.
+
+It includes:
+
+    - load_panel(): read resampled files of a date range into one panel.
+
+    - station_hash(): content hash of the series and hyperparameters of a station.
+
+    - fit_station(): fit one station model and evaluate it on a holdout period.
+
+    - fit_shard(): fit and save the models of a shard of stations, runs in the worker processes.
+
+    - model_file(): pickle file of a station model.
+
+    - TrainingScheduler: cache-aware parallel training of all stations of a panel.
+"""
+import os
+import sys
+import json
+import pickle
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+
+from src import process
+from src.catalog import FileCatalog
+from src.config.paths import MODELS_DIR
+from .ar import ARModel, fit_arima
+
+
+def fit_ar(values, **params):
+    return ARModel(**params).fit(values)
+
+
+# model name -> function(values, **params) returning a fitted model
+MODELS = {
+    'ar': fit_ar,
+    'arima': fit_arima,
+}
+
+
+def load_panel(directory, start=None, end=None, date: str='date', individual: str='station') -> pd.DataFrame:
+    """Reads the resampled files of a directory between start and end into one panel indexed by station and date, sorted by station"""
+
+    files = FileCatalog.open(directory).paths(start, end)
+    panel = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    panel = process.set_panel_index(panel, date=date, individual=individual)
+    panel = panel.reorder_levels([individual, date])
+    return panel[~panel.index.duplicated(keep='last')].sort_index()
+
+
+def station_hash(dates: np.ndarray, values: np.ndarray, model: str, params: dict) -> str:
+    """Content hash of the timestamps and values of a station series, the model name and its hyperparameters"""
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(dates, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    digest.update(json.dumps([model, params], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def forecast(model, history, steps: int) -> np.ndarray:
+    """Forecasts the next steps after history with any model of MODELS"""
+
+    if getattr(model, 'kind', None) == 'arima':
+        return np.asarray(model.predict(n_periods=steps))
+    return model.predict(history, steps)
+
+
+def fit_station(values: np.ndarray, model: str='ar', params: dict=None, holdout: int=24):
+    """Fits a model to the series of one station and evaluates it on the last holdout values, then refits it on the whole series.
+
+    Args:
+        values (np.ndarray): equidistant series of one station
+        model (str, optional): name of the model in MODELS. Defaults to 'ar'.
+        params (dict, optional): hyperparameters of the model. Defaults to None.
+        holdout (int, optional): number of values to evaluate the forecast of the model fitted on the remaining values. Defaults to 24.
+
+    Returns:
+        tuple: (fitted model, dict of metrics)
+    """
+    params = params or {}
+    fit = MODELS[model]
+    metrics = {'n_obs': len(values), 'mae': np.nan, 'rmse': np.nan}
+
+    if holdout and len(values) > 2 * holdout:
+        train, test = values[:-holdout], values[-holdout:]
+        errors = forecast(fit(train, **params), train, holdout) - test
+        metrics['mae'] = float(np.mean(np.abs(errors)))
+        metrics['rmse'] = float(np.sqrt(np.mean(errors ** 2)))
+    return fit(values, **params), metrics
+
+
+def model_file(directory, station: str) -> Path:
+    """Pickle file of a station model, in sub-directories by the first characters of the uuid to keep directories small"""
+    return Path(directory) / station[:2] / f'{station}.pkl'
+
+
+def fit_shard(directory, shard: list, model: str, params: dict, holdout: int) -> list:
+    """Fits and saves the models of a shard of stations. Runs in a worker process and only returns the metrics, the models stay on disk.
+
+    Args:
+        directory (Path): model directory
+        shard (list): (station, hash, values) of each station
+        model (str): name of the model in MODELS
+        params (dict): hyperparameters of the model
+        holdout (int): see fit_station()
+
+    Returns:
+        list: dict of station, hash, metrics or error for each station
+    """
+    results = []
+    for station, content_hash, values in shard:
+        result = {'station': station, 'hash': content_hash}
+        try:
+            fitted, metrics = fit_station(values, model, params, holdout)
+            file = model_file(directory, station)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            # replacing the file at once, so a running BatchForecaster never loads a partially written model
+            temporary = file.with_name(f'.{file.name}.{os.getpid()}.tmp')
+            with open(temporary, 'wb') as f:
+                pickle.dump({'station': station, 'model': fitted, 'params': params, 'hash': content_hash}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, file)
+            result.update(metrics)
+        except Exception as err:
+            # failed stations are not cached and retried on the next run
+            result.update(hash=None, error=f'{type(err).__name__}: {err}')
+        results.append(result)
+    return results
+
+
+class TrainingScheduler:
+    """Cache-aware parallel training of one model per station for one fuel.
+
+    Attributes:
+        directory (Path): model directory of the fuel and model, MODELS_DIR/fuel/model
+        fuel (str): price column to forecast
+        model (str): name of the model in MODELS
+        params (dict): hyperparameters of the model
+        workers (int): number of worker processes, 0 trains in the current process
+        shard_size (int): stations per task
+        max_pending (int): maximum number of shards in flight, bounds the memory of the scheduler
+        max_tasks_per_child (int): shards after which a worker is replaced to release its memory (python 3.11+)
+        holdout (int): see fit_station()
+        index (pd.DataFrame): hash and metrics of each trained station
+    """
+
+    def __init__(self, directory=MODELS_DIR, fuel: str='diesel', model: str='ar', params: dict=None, workers: int=None,
+                 shard_size: int=100, max_pending: int=None, max_tasks_per_child: int=50, holdout: int=24):
+        if model not in MODELS:
+            raise ValueError(f"model must be one of {list(MODELS)}")
+        self.directory = Path(directory) / fuel / model
+        self.fuel = fuel
+        self.model = model
+        self.params = params or {}
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.shard_size = shard_size
+        self.max_pending = max_pending or 2 * max(self.workers, 1)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.holdout = holdout
+        self.index = self.load_index()
+
+    @property
+    def index_file(self) -> Path:
+        return self.directory / 'index.csv'
+
+    def load_index(self) -> pd.DataFrame:
+        if self.index_file.is_file():
+            return pd.read_csv(self.index_file, dtype={'station': str, 'hash': str}).set_index('station')
+        return pd.DataFrame(columns=['hash']).rename_axis('station')
+
+    def save_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index.to_csv(self.index_file)
+
+    def shards(self, panel: pd.DataFrame):
+        """Yields shards of (station, hash, values) for all stations of the panel whose hash is not in the index.
+           The series of a station is its fuel column without missing values, in the order of the panel.
+        """
+        stations = panel.index.get_level_values('station')
+        dates = pd.DatetimeIndex(panel.index.get_level_values('date')).asi8
+        values = panel[self.fuel].to_numpy(dtype=float)
+        known = self.index['hash'].to_dict()
+
+        shard = []
+        starts = process.block_starts(stations)
+        for first, last in zip(starts, np.r_[starts[1:], len(panel)]):
+            station = stations[first]
+            series = values[first:last]
+            is_valid = ~np.isnan(series)
+            content_hash = station_hash(dates[first:last][is_valid], series[is_valid], self.model, self.params)
+            if known.get(station) == content_hash and model_file(self.directory, station).is_file():
+                continue
+            shard.append((station, content_hash, series[is_valid]))
+            if len(shard) == self.shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    def executor(self) -> ProcessPoolExecutor:
+        if sys.version_info >= (3, 11):
+            return ProcessPoolExecutor(self.workers, max_tasks_per_child=self.max_tasks_per_child)
+        return ProcessPoolExecutor(self.workers)
+
+    def update_index(self, results: list):
+        results = pd.DataFrame(results).set_index('station')
+        errors = results[results['hash'].isna()]
+        for station, error in errors.get('error', pd.Series(dtype=str)).items():
+            print(f"Training of {station} failed: {error}")
+        self.index = pd.concat([self.index[~self.index.index.isin(results.index)], results.drop(columns='error', errors='ignore')[results['hash'].notna()]])
+
+    def run(self, panel: pd.DataFrame) -> pd.DataFrame:
+        """Trains all stations of a panel (indexed by station and date, sorted by station) that are not cached yet, and saves the index.
+
+        Returns:
+            pd.DataFrame: index with hash and metrics of all trained stations, including those from earlier runs
+        """
+        panel = panel if panel.index.names[0] == 'station' else panel.reorder_levels(['station', 'date']).sort_index()
+        shards = self.shards(panel)
+        progress = tqdm(desc=f'Training {self.model} models for {self.fuel}', unit=' stations')
+
+        if self.workers == 0:
+            for shard in shards:
+                self.update_index(fit_shard(self.directory, shard, self.model, self.params, self.holdout))
+                progress.update(len(shard))
+        else:
+            with self.executor() as executor:
+                pending = set()
+                for shard in shards:
+                    pending.add(executor.submit(fit_shard, self.directory, shard, self.model, self.params, self.holdout))
+                    if len(pending) >= self.max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            results = future.result()
+                            self.update_index(results)
+                            progress.update(len(results))
+                for future in wait(pending).done:
+                    results = future.result()
+                    self.update_index(results)
+                    progress.update(len(results))
+
+        progress.close()
+        self.save_index()
+        return self.index
+
+    def load_model(self, station: str):
+        """Loads the fitted model of a station"""
+        with open(model_file(self.directory, station), 'rb') as f:
+            return pickle.load(f)['model']
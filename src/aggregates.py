@@ -0,0 +1,237 @@
+"""
+Aggregates Module
+-----------------
+This module contains the daily aggregate store: time-weighted daily price statistics per station, rolled up by brand and region.
+Each price of the processed panel is weighted by the time it was valid, so that stations with many price changes don't dominate the means.
+The store keeps sums instead of means (seconds, sum and sum of squares of time-weighted prices, min and max), so days, chunks of a day
+and stations can be combined exactly. It is updated per file as a side product of RawPriceProcessor, dashboards then read the small daily files:
+
+    store = AggregateStore(PROCESSED_DIR / 'aggregates', station_groups(pd.read_csv(ROOT_DIR / 'data' / 'stations.csv')))
+    processor = RawPriceProcessor(PRICES_DIR, PROCESSED_PRICES, aggregates=store)
+    processor.process_directory()
+    brands = store.read('brand', start='2023-05-01')
+
+It includes:
+
+    - daily_totals(): time-weighted daily totals of each station from a processed panel.
+
+    - combine_totals(): combine totals of several chunks, days or stations.
+
+    - stats_from_totals(): mean, standard deviation, min, max and selling hours from totals.
+
+    - station_groups(): brand and region of each station from the station list, to roll up the station totals.
+
+    - AggregateStore: incrementally maintained csv store of daily totals per station and per group.
+"""
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+from . import process
+
+FUELS = ['diesel', 'e5', 'e10']
+
+# how each total is combined
+TOTALS = {
+    'seconds': 'sum',
+    'sum': 'sum',
+    'sum2': 'sum',
+    'min': 'min',
+    'max': 'max',
+}
+
+
+def daily_totals(panel: pd.DataFrame, fuels: list=FUELS, from_midnight: bool=True, end=None) -> pd.DataFrame:
+    """Time-weighted daily totals of each station from a processed panel sorted by station and date, as produced by RawPriceProcessor.
+       Each price is valid from its timestamp until the next timestamp of the station, the last price of a day until midnight.
+       Only the time a product is sold counts, i.e. prices that are not NaN and, if available, with {fuel}_is_selling = 1.
+
+    Args:
+        panel (pd.DataFrame): panel indexed by 'station' and 'date' with tz-aware timestamps
+        fuels (list, optional): price columns. Defaults to FUELS.
+        from_midnight (bool, optional): the first price of each station and day is also valid since midnight. False if the panel continues an earlier chunk
+                                        of the same day. Defaults to True.
+        end (pd.Timestamp, optional): end of the last prices of each station instead of midnight, e.g. the first timestamp of the next chunk. Defaults to None.
+
+    Returns:
+        pd.DataFrame: totals indexed by 'date' (day) and 'station' with the columns {fuel}_{total} for each total in TOTALS
+    """
+    stations = panel.index.get_level_values('station')
+    timestamps = pd.DatetimeIndex(panel.index.get_level_values('date'))
+    days = timestamps.normalize()
+
+    # rows of the same station and day are contiguous in a sorted panel
+    is_new_station = np.zeros(len(panel), dtype=bool)
+    is_new_station[process.block_starts(stations)] = True
+    is_first = is_new_station | np.r_[True, days[1:] != days[:-1]]
+    is_last = np.r_[is_first[1:], True]
+    is_station_last = np.r_[is_new_station[1:], True]
+
+    times = timestamps.asi8
+    midnights = days.asi8
+    # the following midnight, also on days with a shift in daylight saving time
+    next_midnights = (days + pd.Timedelta(hours=36)).normalize().asi8
+
+    begin = np.where(is_first & (from_midnight | ~is_new_station), midnights, times)
+    stop = np.where(is_last, next_midnights, np.r_[times[1:], 0])
+    if end is not None:
+        stop = np.where(is_station_last, pd.Timestamp(end).value, stop)
+    seconds = (stop - begin) / 1e9
+
+    groups = np.cumsum(is_first) - 1
+    first = np.flatnonzero(is_first)
+    totals = {}
+    for fuel in fuels:
+        prices = panel[fuel].to_numpy(dtype=float)
+        is_valid = ~np.isnan(prices) & (seconds > 0)
+        if f'{fuel}_is_selling' in panel.columns:
+            is_valid &= panel[f'{fuel}_is_selling'].to_numpy() == 1
+        weights = np.where(is_valid, seconds, 0)
+        values = np.where(is_valid, prices, 0)
+
+        totals[f'{fuel}_seconds'] = np.bincount(groups, weights, minlength=len(first))
+        totals[f'{fuel}_sum'] = np.bincount(groups, weights * values, minlength=len(first))
+        totals[f'{fuel}_sum2'] = np.bincount(groups, weights * values ** 2, minlength=len(first))
+        totals[f'{fuel}_min'] = np.minimum.reduceat(np.where(is_valid, prices, np.inf), first) if len(first) else []
+        totals[f'{fuel}_max'] = np.maximum.reduceat(np.where(is_valid, prices, -np.inf), first) if len(first) else []
+
+    index = pd.MultiIndex.from_arrays([days[first].tz_localize(None), stations[first]], names=['date', 'station'])
+    return pd.DataFrame(totals, index=index)
+
+
+def combine_totals(totals, by=None) -> pd.DataFrame:
+    """Combines totals, e.g. of several chunks of the same day or of all stations of a group.
+
+    Args:
+        totals (pd.DataFrame or list): totals as returned by daily_totals(), or a list of them
+        by (list, optional): index levels or columns to group by. Defaults to None, grouping by 'date' and 'station'.
+
+    Returns:
+        pd.DataFrame: combined totals. Min and max of days without any valid price are NaN.
+    """
+    if isinstance(totals, list):
+        totals = pd.concat(totals)
+    by = by if by is not None else ['date', 'station']
+    columns = [c for c in totals.columns if c.rsplit('_', 1)[-1] in TOTALS]
+    agg = {c: TOTALS[c.rsplit('_', 1)[-1]] for c in columns}
+    combined = totals.groupby(by, sort=True)[columns].agg(agg)
+    return combined.replace([np.inf, -np.inf], np.nan)
+
+
+def stats_from_totals(totals: pd.DataFrame, fuels: list=FUELS) -> pd.DataFrame:
+    """Time-weighted mean, standard deviation, min and max and the hours a product was sold, for each row of totals"""
+
+    stats = {}
+    for fuel in fuels:
+        seconds = totals[f'{fuel}_seconds'].to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = totals[f'{fuel}_sum'].to_numpy() / seconds
+            variance = totals[f'{fuel}_sum2'].to_numpy() / seconds - mean ** 2
+        stats[f'{fuel}_mean'] = mean.round(4)
+        stats[f'{fuel}_std'] = np.sqrt(np.clip(variance, 0, None)).round(4)
+        stats[f'{fuel}_min'] = totals[f'{fuel}_min'].replace([np.inf, -np.inf], np.nan).to_numpy()
+        stats[f'{fuel}_max'] = totals[f'{fuel}_max'].replace([np.inf, -np.inf], np.nan).to_numpy()
+        stats[f'{fuel}_hours'] = (seconds / 3600).round(3)
+    return pd.DataFrame(stats, index=totals.index)
+
+
+def station_groups(stations: pd.DataFrame, uuid: str='uuid') -> pd.DataFrame:
+    """Brand and region of each station to roll up station totals, e.g. from data/stations.csv.
+       The region is the 'kreis_name' if the stations were located with subsets.PostcodeIndex, otherwise the postcode region (first two digits).
+
+    Returns:
+        pd.DataFrame: indexed by station with the columns 'brand' and 'region'
+    """
+    stations = stations.drop_duplicates(subset=uuid, keep='last').set_index(uuid)
+    brand = stations['brand'].fillna('').astype(str).str.strip().str.upper().replace('', 'NONE')
+    if 'kreis_name' in stations.columns:
+        region = stations['kreis_name']
+    else:
+        region = stations['post_code'].astype(str).str.extract(r'^(\d{4,5})', expand=False).str.zfill(5).str[:2]
+    return pd.DataFrame({'brand': brand, 'region': region.fillna('unknown')}).rename_axis('station')
+
+
+class AggregateStore:
+    """Incrementally maintained store of daily totals in a directory: one csv file per year for stations and for each group (e.g. brand and region).
+       update() appends the totals of new days, read() returns daily statistics without touching any panel.
+
+    Attributes:
+        directory (Path): directory of the store
+        groups (pd.DataFrame): group columns indexed by station, see station_groups(). None stores only station totals.
+        fuels (list): price columns
+    """
+
+    def __init__(self, directory, groups: pd.DataFrame=None, fuels: list=FUELS):
+        self.directory = Path(directory)
+        self.groups = groups
+        self.fuels = fuels
+
+    def levels(self) -> list:
+        """Names of all aggregation levels of the store"""
+        return ['station'] + (list(self.groups.columns) if self.groups is not None else [])
+
+    def update(self, totals: pd.DataFrame):
+        """Appends the daily totals of stations (e.g. of one file) to the station files and the rolled up totals to the group files"""
+
+        totals = combine_totals(totals)
+        self.append('station', totals)
+        if self.groups is None:
+            return
+
+        stations = totals.index.get_level_values('station')
+        for column in self.groups.columns:
+            group = pd.Index(self.groups[column].reindex(stations).fillna('unknown').to_numpy(), name=column)
+            grouped = totals.reset_index(level='station', drop=True).set_index(group, append=True)
+            rolled_up = combine_totals(grouped, by=['date', column])
+            rolled_up['stations'] = grouped.groupby(['date', column]).size()
+            self.append(column, rolled_up)
+
+    def append(self, level: str, totals: pd.DataFrame):
+        """Appends totals to the yearly files of a level"""
+
+        years = totals.index.get_level_values('date').year
+        for year in np.unique(years):
+            file = self.directory / level / f'{level}_daily_{year}.csv'
+            file.parent.mkdir(parents=True, exist_ok=True)
+            totals[years == year].to_csv(file, mode='a', header=not file.is_file())
+
+    def read_totals(self, level: str='station', start=None, end=None) -> pd.DataFrame:
+        """Reads the totals of a level between start and end (inclusive). Days that were stored more than once (e.g. reprocessed) keep their last totals."""
+
+        files = sorted((self.directory / level).glob(f'{level}_daily_*.csv'))
+        if start is not None:
+            files = [f for f in files if int(f.stem.rsplit('_', 1)[-1]) >= pd.Timestamp(start).year]
+        if end is not None:
+            files = [f for f in files if int(f.stem.rsplit('_', 1)[-1]) <= pd.Timestamp(end).year]
+        if not files:
+            return pd.DataFrame()
+
+        totals = pd.concat([pd.read_csv(f, parse_dates=['date'], dtype={level: str}) for f in files], ignore_index=True)
+        totals = totals.drop_duplicates(subset=['date', level], keep='last').set_index(['date', level]).sort_index()
+        dates = totals.index.get_level_values('date')
+        is_selected = np.ones(len(totals), dtype=bool)
+        if start is not None:
+            is_selected &= dates >= pd.Timestamp(start)
+        if end is not None:
+            is_selected &= dates <= pd.Timestamp(end)
+        return totals[is_selected]
+
+    def read(self, level: str='station', start=None, end=None) -> pd.DataFrame:
+        """Reads daily statistics of a level ('station' or a group column like 'brand' or 'region') between start and end, see stats_from_totals()"""
+
+        totals = self.read_totals(level, start, end)
+        if totals.empty:
+            return totals
+        stats = stats_from_totals(totals, self.fuels)
+        if 'stations' in totals.columns:
+            stats['stations'] = totals['stations']
+        return stats
+
+    def national(self, start=None, end=None) -> pd.DataFrame:
+        """Daily statistics of all stations combined, as a time-weighted replacement of the daily means in the RawPriceProcessor metadata"""
+
+        totals = self.read_totals('station', start, end)
+        if totals.empty:
+            return totals
+        return stats_from_totals(combine_totals(totals, by='date'), self.fuels)
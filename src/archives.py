@@ -0,0 +1,455 @@
+"""
+Archives Module
+---------------
+This module contains the ingestion of compressed files and tar archives without decompressing them to disk first. The raw history is mirrored
+as compressed daily files (e.g. 2023-05-01-prices.csv.gz) or as one tarball per month (e.g. prices/2023/05.tar.gz). The members of an archive
+are addressed by virtual paths below the archive, so catalogs, processors and work queues treat them like any other file:
+
+    prices/2023/05.tar.gz/2023-05-01-prices.csv
+
+Compressed files are read by pandas directly, archive members are read from the archive stream. decompress_ahead() decompresses upcoming files
+in parallel threads while the current one is parsed, reading each archive only once for all of its members:
+
+    processor = RawPriceProcessor(PRICES_DIR, PROCESSED_DIR / 'prices', prefetch=2, decompress=4, compression='gzip')
+    processor.process_directory()
+
+Targets mirror the logical layout of the sources, i.e. without the archive and compression suffixes (prices/2023/05/2023-05-01-prices.csv),
+plus the suffix of the output compression if one is set.
+zstd requires the optional package zstandard, all other formats are part of the standard library.
+
+It includes:
+
+    - compression_of(): compression of a file from its suffix.
+
+    - matches(): whether a file name has a suffix, either plain or compressed.
+
+    - split_member(): split a virtual member path into its archive and the member name.
+
+    - logical_path(): path of a file without archive and compression suffixes.
+
+    - open_compressed(): open a compressed (or plain) file as binary stream.
+
+    - list_members(): members of a tar archive with their sizes.
+
+    - ArchiveCursor: open stream of a tar archive that reads its members in order.
+
+    - MemberReader: reads single members through cursors that continue where the last member was read.
+
+    - read_member(), open_binary(), read_csv(): read files and archive members.
+
+    - decompress_ahead(): decompress files and archive members in parallel threads ahead of the consumer.
+"""
+import io
+import os
+import bz2
+import lzma
+import gzip
+import queue
+import contextlib
+import tarfile
+import threading
+import posixpath
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# file suffix -> compression as named by pandas
+COMPRESSIONS = {'gz': 'gzip', 'zst': 'zstd', 'bz2': 'bz2', 'xz': 'xz'}
+SUFFIXES = {compression: suffix for suffix, compression in COMPRESSIONS.items()}
+
+# suffixes of tar archives, longest first so that '.tar.gz' is not taken for '.gz'
+ARCHIVES = ('.tar.gz', '.tar.zst', '.tar.bz2', '.tar.xz', '.tgz', '.tar')
+
+
+def compression_of(file) -> str:
+    """Compression of a file from its suffix, e.g. 'gzip' for '.gz' or '.tgz'. None if it is not compressed."""
+
+    name = Path(file).name
+    if name.endswith('.tgz'):
+        return 'gzip'
+    return COMPRESSIONS.get(name.rsplit('.', 1)[-1]) if '.' in name else None
+
+
+def strip_compression(name: str) -> str:
+    """Name of a file without its compression suffix, e.g. '2023-05-01-prices.csv' for '2023-05-01-prices.csv.gz'"""
+
+    if '.' in name and name.rsplit('.', 1)[-1] in COMPRESSIONS:
+        return name.rsplit('.', 1)[0]
+    return name
+
+
+def with_compression(path, compression: str=None) -> Path:
+    """Path with the suffix of compression appended, e.g. '.gz' for 'gzip'. None leaves the path unchanged."""
+
+    path = Path(path)
+    return path.with_name(f'{path.name}.{SUFFIXES[compression]}') if compression else path
+
+
+def is_archive(name: str) -> bool:
+    return str(name).endswith(ARCHIVES)
+
+
+def strip_archive(name: str) -> str:
+    """Name of an archive without its suffix, e.g. '05' for '05.tar.gz'"""
+
+    for suffix in ARCHIVES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def matches(name: str, suffix: str='csv') -> bool:
+    """True if a file name ends with suffix, either plain or followed by a compression suffix, e.g. '.csv' or '.csv.gz'"""
+
+    return strip_compression(name).endswith(f'.{suffix}')
+
+
+def split_member(path):
+    """Splits a virtual path below an archive, e.g. 'prices/2023/05.tar.gz/2023-05-01-prices.csv'.
+
+    Returns:
+        tuple: (path of the archive, name of the member) or (path, None) if path is not a member of an archive
+    """
+    parts = Path(path).parts
+    for i, part in enumerate(parts[:-1]):
+        if is_archive(part):
+            return Path(*parts[:i + 1]), '/'.join(parts[i + 1:])
+    return Path(path), None
+
+
+def is_member(path) -> bool:
+    return split_member(path)[1] is not None
+
+
+def source_file(path) -> Path:
+    """The file on disk that contains path: the archive of a member, otherwise path itself"""
+    return split_member(path)[0]
+
+
+def logical_path(path) -> Path:
+    """Path of a file as if all archives and compressed files were extracted,
+       e.g. 'prices/2023/05/2023-05-01-prices.csv' for 'prices/2023/05.tar.gz/2023-05-01-prices.csv.gz'
+    """
+    parts = [strip_archive(part) if is_archive(part) else part for part in Path(path).parts[:-1]]
+    return Path(*parts, strip_compression(Path(path).name))
+
+
+def open_compressed(file, compression: str='infer'):
+    """Opens a file as binary stream that decompresses while reading.
+
+    Args:
+        file (str or Path): file on disk
+        compression (str, optional): 'gzip', 'zstd', 'bz2', 'xz' or None. Defaults to 'infer', using compression_of().
+
+    Returns:
+        binary file object
+    """
+    compression = compression_of(file) if compression == 'infer' else compression
+    if compression == 'gzip':
+        return gzip.open(file, 'rb')
+    if compression == 'bz2':
+        return bz2.open(file, 'rb')
+    if compression == 'xz':
+        return lzma.open(file, 'rb')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.open(file, 'rb')
+    return open(file, 'rb')
+
+
+@contextlib.contextmanager
+def open_archive(archive):
+    """Opens a tar archive as stream, so that it is decompressed once from start to end. Members have to be read in their order in the archive."""
+
+    with open_compressed(archive) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+        yield tar
+
+
+def member_name(info: tarfile.TarInfo) -> str:
+    return posixpath.normpath(info.name)
+
+
+def list_members(archive, suffix: str='csv') -> list:
+    """Lists the files of a tar archive that end with suffix (plain or compressed), in their order in the archive.
+       Compressed archives have to be decompressed once to be listed.
+
+    Returns:
+        list: (member name, size) of each file
+    """
+    with open_archive(archive) as tar:
+        return [(member_name(info), info.size) for info in tar if info.isfile() and matches(info.name, suffix)]
+
+
+def iter_members(archive, names: list):
+    """Generator that reads the members names of an archive in one pass. Yields (name, bytes or exception) in the order of names,
+       so names should be sorted like the archive. Names that are not found in the archive yield a FileNotFoundError.
+    """
+    remaining = deque(names)
+    found = {}
+    try:
+        with open_archive(archive) as tar:
+            for info in tar:
+                name = member_name(info)
+                if name in remaining and info.isfile():
+                    data = tar.extractfile(info).read()
+                    if compression_of(name):
+                        data = open_compressed(io.BytesIO(data), compression_of(name)).read()
+                    found[name] = data
+                # yield the members that are complete, keeping the order of names
+                while remaining and remaining[0] in found:
+                    name = remaining.popleft()
+                    yield name, found.pop(name)
+                if not remaining:
+                    return
+    except Exception as e:
+        for name in remaining:
+            yield name, found.pop(name, e)
+        return
+    for name in remaining:
+        yield name, found.pop(name, FileNotFoundError(f"{name} is not a member of {archive}"))
+
+
+class ArchiveCursor:
+    """Open stream of a tar archive, positioned after the last member that was read. That member is kept, so it can be read again.
+
+    Attributes:
+        archive (Path): the archive
+        mtime (int): modification time of the archive when it was opened, in ns
+        position (int): number of entries of the archive passed so far, minus one
+        name (str), data (bytes): last member that was read and its decompressed content
+    """
+
+    def __init__(self, archive):
+        self.archive = Path(archive)
+        self.mtime = os.stat(archive).st_mtime_ns
+        self.stack = contextlib.ExitStack()
+        self.tar = self.stack.enter_context(tarfile.open(fileobj=self.stack.enter_context(open_compressed(archive)), mode='r|'))
+        self.entries = iter(self.tar)
+        self.position = -1
+        self.name = None
+        self.data = None
+
+    def read(self, name: str, order: dict) -> bytes:
+        """Reads member name, which has to come after the current position. order collects the position of every member that is passed.
+
+        Raises:
+            FileNotFoundError: if name is not found until the end of the archive
+        """
+        if name == self.name:
+            return self.data
+        for info in self.entries:
+            self.position += 1
+            member = member_name(info)
+            order.setdefault(member, self.position)
+            if member == name and info.isfile():
+                data = self.tar.extractfile(info).read()
+                if compression_of(name):
+                    data = open_compressed(io.BytesIO(data), compression_of(name)).read()
+                self.name, self.data = name, data
+                return data
+        raise FileNotFoundError(f"{name} is not a member of {self.archive}")
+
+    def close(self):
+        self.stack.close()
+
+
+class MemberReader:
+    """Reads single members of tar archives without decompressing each archive from the start for every member.
+       Each archive is read through cursors that continue from the last member they read, so members that are read in their order in the archive
+       (like processing the files of a directory in order) take one pass over the archive. A member that is read again right away (e.g. by
+       RawPriceProcessor.start_file() and read_file()) is not decompressed again. Several cursors per archive serve threads at different positions,
+       e.g. the background reader of prefetch and the processing thread.
+
+    Attributes:
+        capacity (int): maximum number of open cursors, the least recently used is closed. Each keeps its last member in memory.
+        cursors (list): open cursors, the most recently used last
+        orders (dict): archive -> (modification time, {member: position}) of the members passed so far
+    """
+
+    def __init__(self, capacity: int=3):
+        self.capacity = capacity
+        self.cursors = []
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def read(self, path) -> bytes:
+        """Reads and decompresses the member of a virtual member path"""
+
+        archive, member = split_member(path)
+        with self.lock:
+            mtime = os.stat(archive).st_mtime_ns
+            # cursors and member positions of an archive that changed are discarded
+            for cursor in [cursor for cursor in self.cursors if cursor.archive == archive and cursor.mtime != mtime]:
+                self.close(cursor)
+            if self.orders.get(archive, (None,))[0] != mtime:
+                self.orders[archive] = (mtime, {})
+            order = self.orders[archive][1]
+
+            cursor = self.find(archive, member, order)
+            try:
+                data = cursor.read(member, order)
+            except Exception:
+                self.close(cursor)
+                raise
+            self.cursors.remove(cursor)
+            self.cursors.append(cursor)
+            return data
+
+    def find(self, archive, member: str, order: dict) -> ArchiveCursor:
+        """The cursor of archive that is closest before member (or at it), a new cursor if there is none.
+           A member that no cursor passed yet can only come after all of them.
+        """
+        position = order.get(member)
+        candidates = [cursor for cursor in self.cursors if cursor.archive == archive
+                      and (position is None or cursor.position < position or cursor.name == member)]
+        if candidates:
+            return max(candidates, key=lambda cursor: cursor.position)
+
+        if len(self.cursors) >= self.capacity:
+            self.close(self.cursors[0])
+        cursor = ArchiveCursor(archive)
+        self.cursors.append(cursor)
+        return cursor
+
+    def close(self, cursor: ArchiveCursor):
+        self.cursors.remove(cursor)
+        cursor.close()
+
+    def clear(self):
+        with self.lock:
+            for cursor in list(self.cursors):
+                self.close(cursor)
+            self.orders = {}
+
+
+# shared by all readers of single members, e.g. FileProcessor.read_file() without decompress and in process_queue()
+MEMBERS = MemberReader()
+
+
+def read_member(path) -> bytes:
+    """Reads and decompresses a single member of an archive through MEMBERS, so reading the members of an archive in order takes one pass over it.
+       decompress_ahead() additionally decompresses in parallel threads.
+    """
+    return MEMBERS.read(path)
+
+
+def read_bytes(file) -> bytes:
+    """Reads the decompressed content of a file or archive member"""
+
+    if is_member(file):
+        return read_member(file)
+    with open_compressed(file) as f:
+        return f.read()
+
+
+def open_binary(file):
+    """Opens a file or archive member as binary stream of its decompressed content. Plain and compressed files are streamed from disk
+       (compressed streams can seek, but slowly), members are read into memory.
+    """
+    if is_member(file):
+        return io.BytesIO(read_member(file))
+    return open_compressed(file)
+
+
+def read_csv(file, source=None, **kwargs):
+    """pd.read_csv of a plain or compressed csv file or archive member.
+
+    Args:
+        file (str or Path): file or virtual member path
+        source (optional): content of file that was already decompressed, e.g. by decompress_ahead(). Defaults to None, reading file.
+        **kwargs: passed on to pd.read_csv, e.g. chunksize
+
+    Returns:
+        pd.DataFrame or a reader of chunks like pd.read_csv
+    """
+    if source is None:
+        # pandas decompresses files by their suffix itself
+        source = io.BytesIO(read_member(file)) if is_member(file) else Path(file).resolve()
+    return pd.read_csv(source, **kwargs)
+
+
+def group_files(files) -> list:
+    """Groups consecutive members of the same archive, so that each archive is read once for all of them. Other files are groups of one."""
+
+    groups = []
+    for file in files:
+        archive, member = split_member(file)
+        if member is not None and groups and groups[-1][0] == archive:
+            groups[-1][1].append(file)
+        else:
+            groups.append((archive if member is not None else None, [file]))
+    return groups
+
+
+def read_group(archive, files: list):
+    """Generator that yields (file, source) of a group from group_files(). Sources are BytesIO of the decompressed content,
+       plain files are not read ahead and yield their path. Errors are yielded as the source of the files they affect.
+    """
+    if archive is not None:
+        members = [split_member(file)[1] for file in files]
+        for file, (_, data) in zip(files, iter_members(archive, members)):
+            yield file, data if isinstance(data, Exception) else io.BytesIO(data)
+        return
+
+    for file in files:
+        if compression_of(file) is None:
+            yield file, Path(file).resolve()
+            continue
+        try:
+            yield file, io.BytesIO(read_bytes(file))
+        except Exception as e:
+            yield file, e
+
+
+def decompress_ahead(files, workers: int=4, buffer: int=2):
+    """Generator that decompresses files and archive members in parallel threads and yields them in order. The next workers groups of files
+       (single files or all consecutive members of an archive, see group_files()) are decompressed at the same time.
+       Each group keeps at most buffer decompressed files ahead, so memory is bounded by about workers * buffer decompressed files.
+       zlib, bz2, lzma and zstandard release the GIL while decompressing, so the threads run in parallel.
+
+    Args:
+        files (iterable): files or virtual member paths
+        workers (int, optional): number of groups decompressed at the same time. Defaults to 4.
+        buffer (int, optional): number of decompressed files kept ahead per group. Defaults to 2.
+
+    Yields:
+        tuple: (file, source) with a BytesIO of the decompressed content, the path of a plain file or the exception if decompressing failed
+    """
+    groups = deque(group_files(files))
+    stop = threading.Event()
+
+    def fill(archive, files, items):
+        for item in read_group(archive, files):
+            # time out regularly to notice when the consumer stopped early
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+
+    def start(lanes):
+        archive, files = groups.popleft()
+        items = queue.Queue(maxsize=max(buffer, 1))
+        executor.submit(fill, archive, files, items)
+        lanes.append((len(files), items))
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    lanes = deque()
+    try:
+        while groups and len(lanes) < max(workers, 1):
+            start(lanes)
+        while lanes:
+            count, items = lanes.popleft()
+            for _ in range(count):
+                yield items.get()
+            if groups:
+                start(lanes)
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
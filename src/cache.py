@@ -0,0 +1,226 @@
+"""
+Cache Module
+------------
+This module contains a content-addressed cache of processed files, so that PriceProcessor only recomputes files whose result can have changed.
+The key of a result is the hash of the input file's content, the identity of the method (module, name and a hash of its source code)
+and its args and kwargs, plus everything else that changes the output (e.g. the subset). The output files are stored under their key,
+so switching a parameter back and forth restores earlier results instead of recomputing them:
+
+    cache = ResultCache(PROCESSED_DIR / 'cache', max_bytes=20 * 2**30)
+    processor = PriceProcessor(source, target, cache=cache)
+    processor.set_method(process_prices.resample_timestamps, agg_dict, freq='H')
+    processor.process_directory()
+
+Input files are only hashed again if their size or modification time changed. Once the cache grows beyond max_bytes, the least recently used
+results are evicted.
+
+It includes:
+
+    - file_hash(): content hash of a file.
+
+    - value_token(): stable token of an argument, e.g. numbers, strings, containers, DataFrames and sparse matrices.
+
+    - method_token(): identity of a function including a hash of its source code.
+
+    - ResultCache: directory of output files by key with an index for lookup and eviction.
+"""
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import threading
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+from . import archives
+
+# bytes read at once when hashing files
+HASH_BLOCK = 2**20
+
+
+def file_hash(file) -> str:
+    """SHA-1 hash of the content of a file. Members of archives are hashed by their decompressed content, see src.archives."""
+
+    digest = hashlib.sha1()
+    with archives.open_binary(file) if archives.is_member(file) else open(file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def value_token(value):
+    """Returns a stable, json-serializable token of a value that is passed on to a method.
+       DataFrames, Series, arrays and sparse matrices are represented by a hash of their content, functions by method_token().
+       Other objects have to provide their own token with a cache_token() method, e.g. process.LevelCache, which does not change the result.
+
+    Raises:
+        TypeError: for objects without a token, as a change of their content would not invalidate the cached results
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [value_token(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((value_token(v) for v in value), key=repr)
+    if isinstance(value, dict):
+        return {str(k): value_token(v) for k, v in sorted(value.items(), key=lambda item: repr(item[0]))}
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return hashlib.sha1(pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index)).to_numpy().tobytes()).hexdigest()
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value).tobytes() + str(value.dtype).encode()).hexdigest()
+    if isinstance(value, (np.generic, pd.Timestamp, pd.Timedelta, Path)):
+        return str(value)
+    if hasattr(value, 'tocoo') and hasattr(value, 'nnz'):
+        # scipy sparse matrices
+        coo = value.tocoo()
+        return value_token([list(coo.shape), coo.row, coo.col, coo.data])
+    if hasattr(value, 'cache_token'):
+        return value.cache_token()
+    if callable(value):
+        return method_token(value)
+    raise TypeError(f"{type(value).__qualname__} has no cache token. Define a cache_token() method that changes with everything that changes the result.")
+
+
+def method_token(method) -> str:
+    """Identity of a function: module, qualified name and a hash of its source code, so that editing the function invalidates its results"""
+
+    name = f'{getattr(method, "__module__", "")}.{getattr(method, "__qualname__", type(method).__qualname__)}'
+    try:
+        source = inspect.getsource(method)
+    except (OSError, TypeError):
+        code = getattr(method, '__code__', None)
+        source = code.co_code.hex() if code is not None else ''
+    return f'{name}:{hashlib.sha1(source.encode()).hexdigest()}'
+
+
+class ResultCache:
+    """Directory of output files stored by their key, with a json index of the size and last use of each entry.
+
+    Attributes:
+        directory (Path): directory of the cache, entries are stored in objects/<first two characters>/<key>
+        max_bytes (int): size of all entries after which the least recently used ones are evicted. None never evicts.
+        entries (dict): key -> {'size', 'used'}
+        inputs (dict): input file -> {'size', 'mtime', 'hash'}, so unchanged inputs are not hashed again
+        hits (int), misses (int): lookups of the current session
+    """
+
+    def __init__(self, directory, max_bytes: int=None):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.inputs = {}
+        self.hits = 0
+        self.misses = 0
+        if self.index_file.is_file():
+            with open(self.index_file) as f:
+                index = json.load(f)
+            self.entries, self.inputs = index.get('entries', {}), index.get('inputs', {})
+
+    @property
+    def index_file(self) -> Path:
+        return self.directory / 'index.json'
+
+    def object_file(self, key: str) -> Path:
+        return self.directory / 'objects' / key[:2] / key
+
+    def save(self):
+        """Saves the index, called after each stored entry"""
+
+        with self.lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            temporary = self.index_file.with_suffix('.tmp')
+            with open(temporary, 'w') as f:
+                json.dump({'entries': self.entries, 'inputs': self.inputs}, f)
+            temporary.replace(self.index_file)
+
+    def input_hash(self, file) -> str:
+        """Content hash of an input file, reused as long as its size and modification time (of its archive for members) don't change"""
+
+        stat = archives.source_file(file).stat()
+        with self.lock:
+            known = self.inputs.get(str(file))
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['hash']
+        content_hash = file_hash(file)
+        with self.lock:
+            self.inputs[str(file)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash}
+        return content_hash
+
+    def key(self, file, method, args=(), kwargs=None, **context) -> str:
+        """Key of the result of method(read(file), *args, **kwargs). context adds anything else that changes the result, e.g. the subset."""
+
+        token = {
+            'input': self.input_hash(file),
+            'method': method_token(method),
+            'args': value_token(list(args)),
+            'kwargs': value_token(kwargs or {}),
+            'context': value_token(context),
+        }
+        return hashlib.sha1(json.dumps(token, sort_keys=True, default=str).encode()).hexdigest()
+
+    def restore(self, key: str, target) -> bool:
+        """Restores the cached output of key to target. A target that is already the cached output is not copied again.
+
+        Returns:
+            bool: True if the key was cached
+        """
+        target = Path(target)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not self.object_file(key).is_file():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return False
+            entry['used'] = time.time()
+            self.hits += 1
+
+        # the output of the last run usually is still in place
+        if not (target.is_file() and target.stat().st_size == entry['size'] and entry.get('target') == str(target)
+                and entry.get('mtime') == target.stat().st_mtime_ns):
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self.object_file(key), target)
+            with self.lock:
+                entry.update(target=str(target), mtime=target.stat().st_mtime_ns)
+        return True
+
+    def store(self, key: str, target):
+        """Stores the output file target under key and evicts old entries if the cache is full"""
+
+        target = Path(target)
+        file = self.object_file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(target, file)
+        with self.lock:
+            self.entries[key] = {'size': file.stat().st_size, 'used': time.time(), 'target': str(target), 'mtime': target.stat().st_mtime_ns}
+            self.evict()
+            self.save()
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits into max_bytes"""
+
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total = self.size()
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['used']):
+                if total <= self.max_bytes:
+                    break
+                self.object_file(key).unlink(missing_ok=True)
+                del self.entries[key]
+                total -= entry['size']
+
+    def clear(self):
+        """Removes all entries"""
+
+        with self.lock:
+            shutil.rmtree(self.directory / 'objects', ignore_errors=True)
+            self.entries = {}
+            self.save()
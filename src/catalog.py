@@ -0,0 +1,476 @@
+"""
+Catalog Module
+--------------
+This module contains a catalog of all files in a data directory, so that a directory tree like prices/YEAR/MONTH/ is walked only once instead of on every call.
+The catalog knows the date of each file (parsed from its filename), its size and modification time and, once counted, its number of rows.
+Files are ordered by these dates, so the processing order does not depend on naming conventions alone.
+
+The catalog is saved in a hidden file next to the cataloged directory (e.g. data/.prices_csv_catalog.pkl for data/prices) and loaded on the next start.
+refresh() then only lists the directories whose modification time changed, i.e. where files were added, removed or renamed.
+Compressed files (e.g. '.csv.gz') and the members of tar archives are cataloged as well, members by virtual paths below their archive (see src.archives).
+Members carry the modification time of their archive, as archives are only listed again when they change.
+Based on the catalog, random samples across many days read only the required parts of each file, e.g. for interactive work in notebooks:
+
+    catalog = FileCatalog.open(ROOT_DIR / 'data' / 'prices')
+    files = catalog.paths(start='2023-01-01', end='2023-01-31')
+    rows = catalog.sample_rows(10_000, start='2023-01-01', days=30, random_state=42)
+    stations = catalog.sample_stations(5, days=7)
+
+It includes:
+
+    - parse_date(): extract the date of a file from its filename.
+
+    - scan_directory(): list the files and sub-directories of one directory with their date, size and modification time.
+
+    - scan_archive(): list the members of a tar archive like the files of a directory.
+
+    - archive_records(): the cataloged members of each archive, to reuse them while the archive does not change.
+
+    - scan_files(): walk a directory tree once and list all files with their date, size and modification time.
+
+    - catalog_file(): default location to save the catalog of a directory.
+
+    - index_lines(): count the rows of a csv file and remember the byte offset of every n-th row.
+
+    - read_rows(): read specific rows of a csv file, only reading the blocks of the file that contain them.
+
+    - FileCatalog: catalog of a directory with date-range queries and random sampling of files, rows and stations.
+"""
+import io
+import os
+import re
+import random
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+from . import fileutils
+from . import archives
+
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+# every LINE_STEP-th row of a file gets a byte offset in the line index
+LINE_STEP = 1000
+
+FILE_COLUMNS = ['path', 'date', 'size', 'mtime', 'rows']
+
+
+def parse_date(file) -> pd.Timestamp:
+    """Extracts the date from a filename like '2023-05-01-prices.csv'. Returns NaT if the name contains no date."""
+
+    match = DATE_PATTERN.search(Path(file).name)
+    return pd.Timestamp(match.group()) if match else pd.NaT
+
+
+def scan_archive(archive, root, suffix: str='csv', mtime: float=None) -> list:
+    """Lists the members of a tar archive as (path, size, mtime) records with virtual paths below the archive.
+       Sizes are the decompressed sizes of the members, the modification time is the one of the archive.
+    """
+    archive_path = Path(os.path.relpath(archive, root)).as_posix()
+    mtime = mtime if mtime is not None else os.stat(archive).st_mtime
+    return [(f'{archive_path}/{member}', size, mtime) for member, size in archives.list_members(archive, suffix)]
+
+
+def scan_directory(directory, root, suffix: str='csv', known_archives: dict=None):
+    """Lists one directory (not its sub-folders) with os.scandir, which returns the file sizes and modification times without extra system calls.
+       Compressed files with suffix are listed as well, tar archives are listed with their members, see scan_archive().
+
+    Args:
+        directory (str or Path): directory to list
+        root (str or Path): root of the catalog, paths are relative to it
+        suffix (str, optional): file ending. Defaults to 'csv'.
+        known_archives (dict, optional): relative path -> (mtime, records) of archives listed before, see archive_records().
+                                         Their members are reused as long as the modification time is the same, instead of decompressing them again.
+
+    Returns:
+        tuple: (list of (path, size, mtime) of all files, list of relative paths of all sub-directories)
+    """
+    records = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path = Path(os.path.relpath(entry.path, root)).as_posix()
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(path)
+            elif archives.is_archive(entry.name) and entry.is_file():
+                mtime = entry.stat().st_mtime
+                known = (known_archives or {}).get(path)
+                records.extend(known[1] if known and known[0] == mtime else scan_archive(entry.path, root, suffix, mtime))
+            elif archives.matches(entry.name, suffix) and entry.is_file():
+                stat = entry.stat()
+                records.append((path, stat.st_size, stat.st_mtime))
+    return records, subdirectories
+
+
+def archive_records(files: pd.DataFrame) -> dict:
+    """Groups the catalog entries of archive members by archive: relative path of the archive -> (mtime, list of (path, size, mtime) records)"""
+
+    known = {}
+    for path, size, mtime in files[['path', 'size', 'mtime']].itertuples(index=False, name=None):
+        archive, member = archives.split_member(path)
+        if member is not None:
+            known.setdefault(archive.as_posix(), (mtime, []))[1].append((path, size, mtime))
+    return known
+
+
+def to_frame(records: list) -> pd.DataFrame:
+    """Creates catalog entries from (path, size, mtime) records, sorted by date and path"""
+
+    files = pd.DataFrame(records, columns=['path', 'size', 'mtime'])
+    files.insert(1, 'date', pd.to_datetime([parse_date(p) for p in files['path']]))
+    return files.sort_values(['date', 'path'], ignore_index=True)
+
+
+def scan_files(path, suffix: str='csv') -> pd.DataFrame:
+    """Walks a directory tree once, see scan_directory().
+
+    Args:
+        path (str or Path): directory to scan, including all sub-folders
+        suffix (str, optional): file ending. Defaults to 'csv'.
+
+    Returns:
+        pd.DataFrame: one row per file with the columns 'path' (relative to path), 'date', 'size' and 'mtime', sorted by date and path
+    """
+    records = []
+    directories = [Path(path)]
+    while directories:
+        files, subdirectories = scan_directory(directories.pop(), path, suffix)
+        records.extend(files)
+        directories.extend(Path(path) / d for d in subdirectories)
+    return to_frame(records)
+
+
+def catalog_file(root, suffix: str='csv') -> Path:
+    """Default file to save the catalog of root in: a hidden file next to root, so catalogs of other directories don't collect in the project.
+       It is not saved within root, as saving would change the modification time of root and cause a rescan on every refresh().
+    """
+
+    root = Path(root).resolve()
+    return root.parent / f'.{root.name}_{suffix}_catalog.pkl'
+
+
+def index_lines(file, step: int=LINE_STEP, buffer_size: int=2**22):
+    """Counts the rows of a csv file by scanning it for line breaks in binary blocks, without parsing it. Assumes no line breaks within quoted values.
+       Compressed files and archive members are scanned in their decompressed form, the offsets refer to it.
+
+    Args:
+        file (str or Path): csv file with one header line
+        step (int, optional): a byte offset is kept for every step-th row. Defaults to LINE_STEP.
+        buffer_size (int, optional): number of bytes scanned at once. Defaults to 4 MiB.
+
+    Returns:
+        tuple: (number of rows without the header, np.ndarray of byte offsets of the rows 0, step, 2*step, ...)
+    """
+    newlines = []
+    size = 0
+    with archives.open_binary(file) as f:
+        while buffer := f.read(buffer_size):
+            newlines.append(np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n')) + size)
+            size += len(buffer)
+
+    line_starts = np.concatenate([[0]] + [positions + 1 for positions in newlines])
+    # a line break at the end of the file does not start another line
+    line_starts = line_starts[line_starts < size]
+    return max(len(line_starts) - 1, 0), line_starts[1::step]
+
+
+def read_rows(file, positions, offsets: np.ndarray, step: int=LINE_STEP, **kwargs) -> pd.DataFrame:
+    """Reads specific rows of a csv file. Only the blocks of step rows that contain any of the rows are read and parsed.
+       Compressed files are decompressed up to the last block (the blocks are read in ascending order), members of archives are read completely.
+
+    Args:
+        file (str or Path): csv file with one header line
+        positions (array-like): row numbers to read, starting at 0 after the header
+        offsets (np.ndarray): byte offsets of every step-th row as returned by index_lines()
+        step (int, optional): step the offsets were created with. Defaults to LINE_STEP.
+        **kwargs: passed on to pd.read_csv, e.g. usecols
+
+    Returns:
+        pd.DataFrame: the rows in ascending order of their positions
+    """
+    positions = np.unique(np.asarray(positions, dtype=np.int64))
+    blocks = positions // step
+    frames = []
+    with archives.open_binary(file) as f:
+        header = f.readline()
+        for block in np.unique(blocks):
+            f.seek(offsets[block])
+            data = f.read(offsets[block + 1] - offsets[block]) if block + 1 < len(offsets) else f.read()
+            frame = pd.read_csv(io.BytesIO(header + data), **kwargs)
+            frames.append(frame.iloc[positions[blocks == block] - block * step])
+
+    if not frames:
+        return archives.read_csv(file, nrows=0, **kwargs)
+    return pd.concat(frames, ignore_index=True)
+
+
+class FileCatalog:
+    """Catalog of all files in a directory tree, scanned once and kept in memory. Use open() to load a saved catalog and only refresh what changed.
+       Rows are only counted for files that need it (see count_rows()) and are kept together with a sparse line index to read single rows later.
+
+    Attributes:
+        root (Path): directory of the catalog
+        files (pd.DataFrame): one row per file with the columns 'path', 'date', 'size', 'mtime' and 'rows' (NaN until counted)
+        directories (dict): relative path -> modification time of all directories, '.' is root
+        line_index (dict): relative path -> byte offsets of every LINE_STEP-th row of the counted files
+        file (Path): file the catalog is saved in, see save()
+    """
+
+    def __init__(self, root, suffix: str='csv', file=None, scan: bool=True):
+        self.root = Path(root)
+        self.suffix = suffix
+        self.file = Path(file) if file else catalog_file(root, suffix)
+        self.files = pd.DataFrame(columns=FILE_COLUMNS)
+        self.directories = {}
+        self.line_index = {}
+        if scan:
+            self.refresh()
+
+    @classmethod
+    def open(cls, root, suffix: str='csv', file=None):
+        """Loads the saved catalog of root and refreshes it, or scans root if no catalog was saved yet. Saves the catalog if anything changed.
+
+        Args:
+            root (str or Path): directory of the catalog
+            suffix (str, optional): file ending. Defaults to 'csv'.
+            file (str or Path, optional): file the catalog is saved in. Defaults to catalog_file(root, suffix).
+
+        Returns:
+            FileCatalog: the up-to-date catalog
+        """
+        catalog = cls(root, suffix, file, scan=False)
+        if catalog.file.is_file():
+            try:
+                state = pd.read_pickle(catalog.file)
+            except Exception as e:
+                print(f"An error occurred loading the catalog {catalog.file}, scanning again: {str(e)}")
+                state = {'suffix': None}
+            if state['suffix'] == suffix:
+                catalog.files, catalog.directories, catalog.line_index = state['files'], state['directories'], state['line_index']
+
+        if catalog.refresh():
+            catalog.save()
+        return catalog
+
+    def save(self, file=None):
+        """Saves the catalog including the row counts and line indices into a pickle file. Errors are printed, as the catalog is only a cache."""
+
+        file = Path(file) if file else self.file
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            state = {'suffix': self.suffix, 'files': self.files, 'directories': self.directories, 'line_index': self.line_index}
+            # replacing the file at once keeps it readable for other processes, e.g. workers of a shared work queue
+            temporary = file.with_name(f'.{file.name}.{os.getpid()}.tmp')
+            pd.to_pickle(state, temporary)
+            os.replace(temporary, file)
+        except OSError as e:
+            print(f"An error occurred saving the catalog {file}: {str(e)}")
+
+    def refresh(self, check_files: bool=False) -> bool:
+        """Updates the catalog incrementally. Only directories whose modification time changed are listed again, all others only need one stat call.
+           Files with a changed size or modification time lose their row count.
+
+        Args:
+            check_files (bool, optional): additionally check the size and modification time of every file. Files that are rewritten in place
+                                          (e.g. appended to) don't change the modification time of their directory. Defaults to False.
+
+        Returns:
+            bool: True if anything changed
+        """
+        known = self.files.set_index('path')
+        # archives whose directory changed are only listed again if they changed themselves
+        known_archives = archive_records(self.files)
+        records = []
+        rescanned = set()
+        directories = {}
+        pending = ['.'] + [d for d in self.directories if d != '.']
+        while pending:
+            directory = pending.pop()
+            if directory in directories:
+                continue
+            try:
+                mtime = os.stat(self.root / directory).st_mtime
+            except FileNotFoundError:
+                continue
+            directories[directory] = mtime
+            if self.directories.get(directory) != mtime:
+                files, subdirectories = scan_directory(self.root / directory, self.root, self.suffix, known_archives)
+                records.extend(files)
+                rescanned.add(directory)
+                pending.extend(subdirectories)
+
+        # files of unchanged directories are kept, files of removed directories are dropped. Members of archives belong to the directory of their archive.
+        parents = known.index.map(lambda path: archives.source_file(path).parent.as_posix())
+        is_kept = parents.isin(list(set(directories) - rescanned))
+        kept = list(known.loc[is_kept, ['size', 'mtime']].itertuples(name=None))
+        if check_files:
+            kept = self.check_files(kept)
+        files = to_frame(records + kept)
+
+        # row counts are kept as long as the file did not change
+        previous = known.reindex(files['path'])
+        is_unchanged = (previous['size'].to_numpy() == files['size'].to_numpy()) & (previous['mtime'].to_numpy() == files['mtime'].to_numpy())
+        files['rows'] = np.where(is_unchanged, previous['rows'].to_numpy(dtype=float), np.nan)
+        self.line_index = {path: self.line_index[path] for path in files.loc[files['rows'].notna(), 'path'] if path in self.line_index}
+
+        changed = directories != self.directories or len(files) != len(self.files) or not is_unchanged.all()
+        self.files = files
+        self.directories = directories
+        return changed
+
+    def check_files(self, records: list) -> list:
+        """Updates (path, size, mtime) records with the current size and modification time of each file. Files that don't exist anymore are dropped.
+           Archives that changed are listed again, the members of all others are kept.
+        """
+        checked = []
+        archive_stats = {}
+        for path, size, mtime in records:
+            archive, member = archives.split_member(path)
+            if member is None:
+                stat = self.stat(path)
+                if stat is not None:
+                    checked.append((path, stat.st_size, stat.st_mtime))
+                continue
+            if archive not in archive_stats:
+                archive_stats[archive] = stat = self.stat(archive)
+                if stat is not None and stat.st_mtime != mtime:
+                    checked.extend(scan_archive(self.root / archive, self.root, self.suffix, stat.st_mtime))
+            stat = archive_stats[archive]
+            if stat is not None and stat.st_mtime == mtime:
+                checked.append((path, size, mtime))
+        return checked
+
+    def stat(self, path):
+        """os.stat of a file in the catalog (of the archive of a member), None if it does not exist anymore"""
+        try:
+            return os.stat(self.root / archives.source_file(path))
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        return len(self.files)
+
+    def select(self, start=None, end=None, subset: str=None) -> pd.DataFrame:
+        """Returns the catalog entries of all files between start and end (both inclusive). Files without a date are only part of unrestricted queries.
+
+        Args:
+            start, end (str or pd.Timestamp, optional): date range. Defaults to None (unrestricted).
+            subset (str, optional): sub-directory of root, e.g. the name of a subset written by MultiSubsetProcessor into target_directory / name,
+                                    or a year like '2023'. Defaults to None (all files).
+
+        Returns:
+            pd.DataFrame: catalog entries sorted by date and path
+        """
+        is_selected = np.ones(len(self.files), dtype=bool)
+        if start is not None:
+            is_selected &= (self.files['date'] >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            is_selected &= (self.files['date'] <= pd.Timestamp(end)).to_numpy()
+        if subset is not None:
+            is_selected &= self.files['path'].str.startswith(f"{Path(subset).as_posix().strip('/')}/").to_numpy()
+        return self.files[is_selected]
+
+    def paths(self, start=None, end=None, subset: str=None) -> list:
+        """Returns the absolute paths of all files between start and end (and in subset), sorted by date and path"""
+        return [self.root / path for path in self.select(start, end, subset)['path']]
+
+    def subdirectories(self) -> list:
+        """Returns the names of the sub-directories of root that contain files, sorted by name"""
+        return sorted({path.split('/')[0] for path in self.files['path'] if '/' in path})
+
+    def count_rows(self, entries: pd.DataFrame=None) -> pd.Series:
+        """Counts the rows of catalog entries (default: all files) that were not counted yet and returns the rows of all entries.
+           The catalog is saved afterwards, so each file is counted only once.
+        """
+
+        entries = self.files if entries is None else entries
+        uncounted = entries.loc[entries['rows'].isna(), 'path']
+        for i, path in uncounted.items():
+            rows, offsets = index_lines(self.root / path)
+            self.files.loc[i, 'rows'] = rows
+            self.line_index[path] = offsets
+        if not uncounted.empty:
+            self.save()
+        return self.files.loc[entries.index, 'rows'].astype(int)
+
+    def sample_files(self, n: int=1, start=None, end=None, subset: str=None, random_state=None) -> list:
+        """Draws n random files between start and end without replacement, returned in the order of the catalog"""
+
+        entries = self.select(start, end, subset)
+        chosen = random.Random(random_state).sample(range(len(entries)), min(n, len(entries)))
+        return [self.root / path for path in entries['path'].iloc[sorted(chosen)]]
+
+    def sample_rows(self, n: int, start=None, end=None, days: int=None, subset: str=None, random_state=None, **kwargs) -> pd.DataFrame:
+        """Draws n random rows across all files between start and end. Each row is equally likely, regardless of the file it is in.
+           Only the files that are sampled from have to be counted once, and only the blocks of rows that contain sampled rows are parsed.
+
+        Args:
+            n (int): number of rows
+            start, end (str or pd.Timestamp, optional): date range of the files to sample from. Defaults to None (all files).
+            days (int, optional): first draw this many random files and sample rows only from these, which avoids counting the whole archive. Defaults to None.
+            subset (str, optional): sub-directory to sample from, see select(). Defaults to None.
+            random_state (int, optional): random seed to reproduce results. Defaults to None.
+            **kwargs: passed on to pd.read_csv, e.g. usecols
+
+        Returns:
+            pd.DataFrame: the sampled rows with an additional column 'file' (relative path of their file), in the order of the catalog
+        """
+        rng = random.Random(random_state)
+        entries = self.select(start, end, subset)
+        if days is not None:
+            entries = entries.iloc[sorted(rng.sample(range(len(entries)), min(days, len(entries))))]
+
+        rows = self.count_rows(entries).to_numpy()
+        bounds = np.concatenate([[0], np.cumsum(rows)])
+        chosen = np.sort(np.array(rng.sample(range(int(bounds[-1])), min(n, int(bounds[-1]))), dtype=np.int64))
+
+        # map the global row numbers to files and positions within each file
+        file_numbers = np.searchsorted(bounds, chosen, side='right') - 1
+        frames = []
+        for file_number in np.unique(file_numbers):
+            path = entries['path'].iloc[file_number]
+            positions = chosen[file_numbers == file_number] - bounds[file_number]
+            frames.append(read_rows(self.root / path, positions, self.line_index[path], **kwargs).assign(file=path))
+
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def sample_stations(self, n: int, start=None, end=None, days: int=None, column: str='station_uuid', stations=None, subset: str=None,
+                        random_state=None, chunksize: int=100_000) -> pd.DataFrame:
+        """Draws n random stations and returns all of their rows in the files between start and end.
+           Files are read in chunks in a background thread and reduced to the stations right away, so only the rows of the sampled stations are kept.
+
+        Args:
+            n (int): number of stations
+            start, end (str or pd.Timestamp, optional): date range of the files. Defaults to None (all files).
+            days (int, optional): only use this many random files of the date range. Defaults to None (all files).
+            column (str, optional): station column of the files. Defaults to 'station_uuid'.
+            stations (array-like, optional): stations to draw from, e.g. a subset. Defaults to None, drawing from the stations in the first file.
+            subset (str, optional): sub-directory to sample from, see select(). Defaults to None.
+            random_state (int, optional): random seed to reproduce results. Defaults to None.
+            chunksize (int, optional): rows read at once. Defaults to 100_000.
+
+        Returns:
+            pd.DataFrame: all rows of the sampled stations with an additional column 'file', in the order of the catalog
+        """
+        rng = random.Random(random_state)
+        entries = self.select(start, end, subset)
+        if days is not None:
+            entries = entries.iloc[sorted(rng.sample(range(len(entries)), min(days, len(entries))))]
+        if entries.empty:
+            return pd.DataFrame()
+
+        if stations is None:
+            stations = archives.read_csv(self.root / entries['path'].iloc[0], usecols=[column])[column].unique()
+        # sets (e.g. the subset of a FileProcessor) have no order, sorting makes the draw reproducible
+        stations = sorted(pd.unique(np.asarray(list(stations))))
+        chosen = set(rng.sample(stations, min(n, len(stations))))
+
+        def read_chunks():
+            for path in entries['path']:
+                for chunk in archives.read_csv(self.root / path, chunksize=chunksize):
+                    yield chunk[chunk[column].isin(chosen)].assign(file=path)
+
+        return pd.concat(fileutils.prefetch(read_chunks()), ignore_index=True)
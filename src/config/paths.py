@@ -10,3 +10,4 @@ META_DIR = ROOT_DIR / 'data_processed' / 'meta'
 PROCESSED_DIR = ROOT_DIR / 'data_processed'
 PROCESSED_PRICES = ROOT_DIR / 'data_processed' / 'prices'
 PROCESSED_STATIONS = ROOT_DIR / 'data_processed' / 'stations'
+MODELS_DIR = ROOT_DIR / 'data_processed' / 'models'
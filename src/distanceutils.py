@@ -228,3 +228,166 @@ def create_duration_matrix(station_matrix: pd.DataFrame) -> pd.DataFrame:
                 filled_matrix.iloc[c, 2:] = duration_list[0]
 
     return filled_matrix
+
+
+
+def calc_geo_distances(lat1, lon1, lat2, lon2) -> np.ndarray:
+    '''Vectorized calc_geo_distance() for arrays of points, in kilometers'''
+
+    lat1, lon1, lat2, lon2 = map(np.radians, [np.asarray(lat1, dtype=float), np.asarray(lon1, dtype=float),
+                                              np.asarray(lat2, dtype=float), np.asarray(lon2, dtype=float)])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return EARTH_RADIUS * c
+
+
+
+def find_candidate_pairs(station_df: pd.DataFrame, radius: float = 5) -> pd.DataFrame:
+    '''
+    Finds all ordered pairs of different stations within a great-circle distance (see calc_geo_distance).
+    Stations are sorted by latitude, so only stations within the latitude band of the radius
+    are compared instead of all N x N pairs.
+
+    Parameters:
+        station_df (pd.DataFrame): List of stations as dataframe
+                                   Must include uuid, latitude, longitude
+        radius (float):            Maximum distance in kilometers
+
+    Returns:
+        pairs (pd.DataFrame): Long dataframe with columns station, neighbor, distance (kilometers),
+                              both directions of each pair, sorted by station and distance
+    '''
+    check_cols_uuid(station_df)
+    check_cols_latlon(station_df)
+    stations = station_df.drop_duplicates(subset="uuid").dropna(subset=["latitude", "longitude"])
+    stations = stations.sort_values("latitude", kind="stable")
+
+    uuids = stations["uuid"].to_numpy()
+    lat = stations["latitude"].to_numpy(dtype=float)
+    lon = stations["longitude"].to_numpy(dtype=float)
+
+    # one degree of latitude is at least 110.5 km, the band may only be too wide
+    band = radius / 110.5
+    starts = np.searchsorted(lat, lat - band, side="left")
+    stops = np.searchsorted(lat, lat + band, side="right")
+
+    counts = stops - starts
+    origins = np.repeat(np.arange(len(lat)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    destinations = np.repeat(starts, counts) + offsets
+
+    is_other = origins != destinations
+    origins, destinations = origins[is_other], destinations[is_other]
+    distances = calc_geo_distances(lat[origins], lon[origins], lat[destinations], lon[destinations])
+    is_near = distances <= radius
+
+    pairs = pd.DataFrame({
+        "station": uuids[origins[is_near]],
+        "neighbor": uuids[destinations[is_near]],
+        "distance": distances[is_near],
+    })
+    return pairs.sort_values(["station", "distance"], ignore_index=True)
+
+
+
+def ors_durations(locations: list, sources: list, destinations: list) -> list:
+    '''
+    Requests driving durations (in seconds) between some of the locations from openrouteservice.org.
+
+    Parameters:
+        locations (list):    [longitude, latitude] pairs
+        sources (list):      Positions of the origins in locations
+        destinations (list): Positions of the destinations in locations
+
+    Returns:
+        durations (list): Sources x destinations list of lists, None for unroutable pairs
+    '''
+    ors_client = ors.Client(key=ORS_KEY)
+    ors_response = ors_client.distance_matrix(locations,
+                                              profile="driving-car",
+                                              sources=sources,
+                                              destinations=destinations,
+                                              metrics=['duration'])
+    return ors_response["durations"]
+
+
+
+def create_sparse_duration_matrix(station_df: pd.DataFrame, radius: float = 5, max_elements: int = 3500,
+                                  max_calls: int = 250, router=ors_durations, sleep: float = 2) -> pd.DataFrame:
+    '''
+    Driving durations (in seconds) only between stations within a great-circle radius of each other.
+    Nearby origins are grouped into one request with the union of their candidate neighbors,
+    so that each request stays below max_elements (sources x destinations) and far fewer
+    requests are needed than with one call per station in create_duration_matrix().
+
+    Parameters:
+        station_df (pd.DataFrame): List of stations as dataframe
+                                   Must include uuid, latitude, longitude
+        radius (float):            Maximum great-circle distance in kilometers
+        max_elements (int):        Maximum sources x destinations per request (ORS allows 3500)
+        max_calls (int):           Raise an exception if more requests would be made
+        router (callable):         Function(locations, sources, destinations) returning durations,
+                                   ors_durations by default. Can be replaced by a local router.
+        sleep (float):             Seconds to wait between requests (ORS allows 40 calls/minute)
+
+    Returns:
+        pairs (pd.DataFrame): Long dataframe with columns station, neighbor, distance (kilometers),
+                              duration (seconds). Pairs whose request failed have NaN durations.
+                              Can be passed to features.neighbor_positions() after renaming duration to distance.
+    '''
+    pairs = find_candidate_pairs(station_df, radius)
+    if pairs.empty:
+        return pairs.assign(duration=np.nan)
+
+    stations = station_df.drop_duplicates(subset="uuid").set_index("uuid")
+    lonlat = stations[["longitude", "latitude"]]
+
+    # sweep the origins in strips of one radius height, so that consecutive origins share most candidates,
+    # and fill each request with origins as long as it stays below max_elements
+    origins = lonlat.loc[pairs["station"].unique()]
+    strips = np.floor(origins["latitude"].to_numpy() / (radius / 110.5))
+    origins = origins.iloc[np.lexsort((origins["longitude"].to_numpy(), strips))]
+    neighbors = pairs.groupby("station", sort=False)["neighbor"].apply(set)
+
+    requests = []
+    batch, batch_neighbors = [], set()
+    for origin in origins.index:
+        union = batch_neighbors | neighbors[origin]
+        if batch and (len(batch) + 1) * len(union) > max_elements:
+            requests.append((batch, batch_neighbors))
+            batch, union = [], neighbors[origin]
+        batch.append(origin)
+        batch_neighbors = union
+    requests.append((batch, batch_neighbors))
+
+    if len(requests) > max_calls:
+        raise Exception(f"Request would generate {len(requests)} API calls. Only {max_calls} API calls allowed per function call.")
+
+    durations = []
+    for c, (batch, batch_neighbors) in enumerate(tqdm(requests, desc="Getting durations for station pairs")):
+        if c > 0 and sleep:
+            time.sleep(sleep)   # stay below API limit
+
+        destinations = sorted(batch_neighbors)
+        locations = list(dict.fromkeys(batch + destinations))
+        positions = {uuid: p for p, uuid in enumerate(locations)}
+        try:
+            result = router(lonlat.loc[locations].to_numpy().tolist(),
+                            [positions[uuid] for uuid in batch],
+                            [positions[uuid] for uuid in destinations])
+        except Exception as err:
+            print(f"The router reported the error: {err}")
+            print(f"No durations have been filled for {len(batch)} stations.")
+            continue
+
+        result = pd.DataFrame(result, index=batch, columns=destinations, dtype=float)
+        batch_pairs = pairs[pairs["station"].isin(batch)]
+        durations.append(pd.Series(
+            result.to_numpy()[result.index.get_indexer(batch_pairs["station"]), result.columns.get_indexer(batch_pairs["neighbor"])],
+            index=batch_pairs.index,
+        ))
+
+    pairs["duration"] = pd.concat(durations) if durations else np.nan
+    return pairs
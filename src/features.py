@@ -0,0 +1,331 @@
+"""
+Features Module
+---------------
+This module contains the feature engineering for panel-data as it is produced by resample_timestamps() in src.process_prices.
+All features are computed for all stations at once on a panel sorted by 'station' -> 'date', in which every station is one contiguous block of rows.
+Instead of grouping by station, every function works on the row position within a station's block, so there is no per-station python loop.
+Lags and windows are given in rows, i.e. in multiples of the frequency the panel was resampled to ('H' -> 24 rows are one day).
+
+It includes:
+
+    - prepare_panel(): set and sort the 'station' -> 'date' MultiIndex of a DataFrame loaded from a csv file.
+
+    - block_shift(): shift an array within each station block, leaving NaN where the shift would cross into another station.
+
+    - rolling_sum(): rolling sum within each station block, based on cumulative sums.
+
+    - rolling_extreme(): rolling min or max within each station block in log2(window) steps.
+
+    - lag_features(), rolling_features(), change_count_features(): the single feature families.
+
+    - time_of_day_features(): expanding mean per station and time of day. Takes and returns a state to continue over many files.
+
+    - build_features(): main function to create all features of a panel in one pass.
+
+    - carry_over(): the last rows of each station that are required to continue lags and windows in the next file or chunk.
+
+    - neighbor_index(): precompute the nearest competitors of each station from a distance or duration matrix as created in src.distanceutils.
+
+    - neighbor_positions(): translate a neighbor index into integer positions of a price grid.
+
+    - price_grid(): pivot a sorted panel into a timestamps x stations array.
+
+    - competitor_features(): main function to create neighbor min/mean/rank and "cheapest within radius" features by gathering from the price grid.
+"""
+
+import pandas as pd
+import numpy as np
+import warnings
+
+from . import process
+
+TIME_ATTRIBUTES = ['year', 'month', 'day', 'dayofyear', 'dayofweek', 'hour', 'minute']
+
+
+def prepare_panel(data: pd.DataFrame, date: str='date', individual: str='station') -> pd.DataFrame:
+    """Converts a DataFrame into a panel with a MultiIndex 'station' -> 'date', sorted by station first and date second.
+
+    Args:
+        data (pd.DataFrame): resampled prices, either loaded from a csv file or already with a MultiIndex
+        date (str, optional): Name of the date column or index. Defaults to 'date'.
+        individual (str, optional): Name of the individual column or index. Defaults to 'station'.
+
+    Returns:
+        pd.DataFrame: MultiIndex DataFrame with one contiguous block of rows per station
+    """
+    if not isinstance(data.index, pd.MultiIndex):
+        data = process.set_panel_index(data, date=date, individual=individual)
+    if data.index.names[0] != individual:
+        data = data.swaplevel(0, 1)
+    return data.sort_index()
+
+
+def block_shift(values: np.ndarray, positions: np.ndarray, periods: int) -> np.ndarray:
+    """Shifts values by periods rows within each station block.
+
+    Args:
+        values (np.ndarray): values of one column of the sorted panel
+        positions (np.ndarray): position of each row within its block, see process.block_positions()
+        periods (int): number of rows to shift by. Must not be negative.
+
+    Returns:
+        np.ndarray: shifted values as float, NaN for the first periods rows of each block
+    """
+    shifted = np.full(len(values), np.nan)
+    if periods == 0:
+        shifted[:] = values
+    elif periods < len(values):
+        shifted[periods:] = values[:-periods]
+    shifted[positions < periods] = np.nan
+    return shifted
+
+
+def rolling_sum(values: np.ndarray, positions: np.ndarray, window: int) -> np.ndarray:
+    """Rolling sum over the last window rows of each station block, NaN values count as 0.
+       Windows are truncated at the start of a block, which is the same as min_periods=1 in pandas.
+    """
+    cumulative = np.r_[0., np.cumsum(np.nan_to_num(values.astype(float)))]
+    rows = np.arange(len(values))
+    lower = np.maximum(rows + 1 - window, rows - positions)
+    return cumulative[rows + 1] - cumulative[lower]
+
+
+def rolling_extreme(values: np.ndarray, positions: np.ndarray, window: int, func=np.fmin) -> np.ndarray:
+    """Rolling minimum (func=np.fmin) or maximum (func=np.fmax) over the last window rows of each station block.
+       The window is doubled in each step, so a window of 168 rows only takes 8 vectorized steps instead of 168.
+    """
+    result = values.astype(float)
+    span = 1
+    while span * 2 <= window:
+        result = func(result, block_shift(result, positions, span))
+        span *= 2
+    # two overlapping windows of size span cover the remaining window
+    if span < window:
+        result = func(result, block_shift(result, positions, window - span))
+    return result
+
+
+def lag_features(panel: pd.DataFrame, columns: list, lags, positions: np.ndarray) -> dict:
+    """Creates '{column}_lag_{lag}' features"""
+    return {
+        f'{column}_lag_{lag}': block_shift(panel[column].to_numpy(dtype=float), positions, lag)
+        for column in columns for lag in lags
+    }
+
+
+def rolling_features(panel: pd.DataFrame, columns: list, windows, positions: np.ndarray) -> dict:
+    """Creates '{column}_roll_mean_{window}', '{column}_roll_min_{window}' and '{column}_roll_max_{window}' features"""
+    features = {}
+    for column in columns:
+        values = panel[column].to_numpy(dtype=float)
+        observed = (~np.isnan(values)).astype(float)
+        for window in windows:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                features[f'{column}_roll_mean_{window}'] = rolling_sum(values, positions, window) / rolling_sum(observed, positions, window)
+            features[f'{column}_roll_min_{window}'] = rolling_extreme(values, positions, window, np.fmin)
+            features[f'{column}_roll_max_{window}'] = rolling_extreme(values, positions, window, np.fmax)
+    return features
+
+
+def change_count_features(panel: pd.DataFrame, columns: list, windows, positions: np.ndarray) -> dict:
+    """Creates '{column}_changes_{window}' features: number of price changes between consecutive rows within the window"""
+    features = {}
+    for column in columns:
+        values = panel[column].to_numpy(dtype=float)
+        previous = block_shift(values, positions, 1)
+        changed = (~np.isnan(values) & ~np.isnan(previous) & (values != previous)).astype(float)
+        for window in windows:
+            features[f'{column}_changes_{window}'] = rolling_sum(changed, positions, window)
+    return features
+
+
+def time_of_day_features(panel: pd.DataFrame, columns: list, profile_attr: str='hour', state: pd.DataFrame=None, new_rows: np.ndarray=None):
+    """Creates '{column}_tod_mean' (expanding mean price of the station at that time of the day) and '{column}_tod_dev' (deviation from it) features.
+       The expanding mean only uses rows up to and including the current one, so it can be continued over many files by passing the returned state.
+
+    Args:
+        panel (pd.DataFrame): sorted panel, see prepare_panel()
+        columns (list): columns to create the profile for
+        profile_attr (str, optional): DatetimeIndex attribute defining the time of the day. Defaults to 'hour'.
+        state (pd.DataFrame, optional): sums and counts per station and time of day of all previously processed rows. Defaults to None.
+        new_rows (np.ndarray, optional): boolean mask of rows that were not processed before. Carried over rows only serve as context. Defaults to None.
+
+    Returns:
+        tuple: (dict of features, updated state)
+    """
+    stations = panel.index.get_level_values(0)
+    bins = getattr(panel.index.get_level_values(1), profile_attr)
+    keys = pd.MultiIndex.from_arrays([stations, bins], names=['station', profile_attr])
+
+    weights = np.ones(len(panel)) if new_rows is None else np.asarray(new_rows, dtype=float)
+    values = panel[columns].to_numpy(dtype=float)
+    counts = (~np.isnan(values)) * weights[:, None]
+    sums = np.nan_to_num(values) * counts
+    group = pd.DataFrame(np.hstack([sums, counts]), index=keys,
+                         columns=[f'{c}_sum' for c in columns] + [f'{c}_count' for c in columns])
+
+    running = group.groupby(level=[0, 1], sort=False).cumsum().to_numpy()
+    totals = group.groupby(level=[0, 1]).sum()
+    if state is not None and not state.empty:
+        running = running + state.reindex(keys).fillna(0).to_numpy()
+        totals = totals.add(state, fill_value=0)
+
+    features = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, column in enumerate(columns):
+            profile = running[:, i] / running[:, len(columns) + i]
+            features[f'{column}_tod_mean'] = profile
+            features[f'{column}_tod_dev'] = values[:, i] - profile
+    return features, totals
+
+
+def build_features(panel: pd.DataFrame, columns: list, lags=(1, 24), windows=(24, 168), attributes=TIME_ATTRIBUTES,
+                   profile_attr: str='hour', profile_state: pd.DataFrame=None, new_rows: np.ndarray=None):
+    """Main function to create lag, rolling, change-count, time-of-day and time-attribute features for all stations of a sorted panel in one pass.
+
+    Args:
+        panel (pd.DataFrame): sorted panel, see prepare_panel()
+        columns (list): price columns to create features for, e.g. ['diesel']
+        lags (iterable, optional): lags in rows. Defaults to (1, 24).
+        windows (iterable, optional): rolling window sizes in rows. Defaults to (24, 168).
+        attributes (list, optional): datetime attributes passed on to process.add_time_columns(). Defaults to TIME_ATTRIBUTES.
+        profile_attr (str, optional): see time_of_day_features(). Defaults to 'hour'.
+        profile_state (pd.DataFrame, optional): see time_of_day_features(). Defaults to None.
+        new_rows (np.ndarray, optional): see time_of_day_features(). Defaults to None.
+
+    Returns:
+        tuple: (panel with feature columns, updated time-of-day state)
+    """
+    positions = process.block_positions(panel.index.get_level_values(0))
+
+    features = lag_features(panel, columns, lags, positions)
+    features.update(rolling_features(panel, columns, windows, positions))
+    features.update(change_count_features(panel, columns, windows, positions))
+    tod_features, profile_state = time_of_day_features(panel, columns, profile_attr, profile_state, new_rows)
+    features.update(tod_features)
+
+    panel = panel.assign(**features)
+    if attributes:
+        panel = process.add_time_columns(panel, date=panel.index.names[1], attributes=attributes)
+    return panel, profile_state
+
+
+def lookback(lags=(1, 24), windows=(24, 168)) -> int:
+    """Number of rows per station that have to be carried over to continue all lags and windows"""
+    return max([*lags, *windows, 0])
+
+
+def carry_over(panel: pd.DataFrame, rows: int) -> pd.DataFrame:
+    """Returns the last rows of each station block of a sorted panel"""
+    stations = panel.index.get_level_values(0)
+    starts = process.block_starts(stations)
+    ends = np.r_[starts[1:], len(panel)]
+    from_end = np.repeat(ends, ends - starts) - 1 - np.arange(len(panel))
+    return panel[from_end < rows]
+
+
+def neighbor_index(matrix: pd.DataFrame, k: int=10, radius: float=None) -> pd.DataFrame:
+    """Precomputes the k nearest competitors of each station from a station matrix as created by create_distance_matrix() or create_duration_matrix().
+       The result only has to be recomputed when the station list changes and can be stored as a csv file.
+
+    Args:
+        matrix (pd.DataFrame): NxN station matrix indexed by uuid. Columns that are not station uuids (e.g. latitude, longitude) are ignored.
+        k (int, optional): maximum number of neighbors per station. Defaults to 10.
+        radius (float, optional): maximum distance (or duration) of a neighbor, in the unit of the matrix. Defaults to None.
+
+    Returns:
+        pd.DataFrame: long DataFrame with columns ['station', 'neighbor', 'distance'], sorted by station and distance
+    """
+    stations = matrix.index[matrix.index.isin(matrix.columns)]
+    distances = matrix.loc[stations, stations].to_numpy(dtype=float)
+    np.fill_diagonal(distances, np.inf)
+
+    k = min(k, len(stations) - 1)
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+
+    neighbors = pd.DataFrame({
+        'station': np.repeat(stations.to_numpy(), k),
+        'neighbor': stations.to_numpy()[nearest.ravel()],
+        'distance': nearest_distances.ravel(),
+    })
+    is_valid = np.isfinite(neighbors['distance'])
+    if radius is not None:
+        is_valid &= neighbors['distance'] <= radius
+    return neighbors[is_valid].reset_index(drop=True)
+
+
+def neighbor_positions(neighbors: pd.DataFrame, stations: pd.Index):
+    """Translates a neighbor index into padded integer arrays aligned to the stations of a price grid.
+
+    Args:
+        neighbors (pd.DataFrame): neighbor index as returned by neighbor_index()
+        stations (pd.Index): stations of the price grid, see price_grid()
+
+    Returns:
+        tuple: (positions, distances), both of shape stations x k. Missing neighbors have the position len(stations) and an infinite distance.
+    """
+    neighbors = neighbors[neighbors['station'].isin(stations) & neighbors['neighbor'].isin(stations)]
+    rows = stations.get_indexer(neighbors['station'])
+    ranks = process.block_positions(rows) if len(rows) else rows
+    k = int(ranks.max()) + 1 if len(ranks) else 0
+
+    positions = np.full((len(stations), k), len(stations))
+    distances = np.full((len(stations), k), np.inf)
+    positions[rows, ranks] = stations.get_indexer(neighbors['neighbor'])
+    distances[rows, ranks] = neighbors['distance'].to_numpy(dtype=float)
+    return positions, distances
+
+
+def price_grid(panel: pd.DataFrame, column: str):
+    """Pivots one column of a sorted panel into an array of shape timestamps x stations.
+
+    Returns:
+        tuple: (timestamps, stations, grid)
+    """
+    grid = panel[column].unstack(level=0)
+    return grid.index, grid.columns, grid.to_numpy(dtype=float)
+
+
+def competitor_features(prices_df: pd.DataFrame, column: str, neighbors: pd.DataFrame, radii=(1, 3, 5)) -> pd.DataFrame:
+    """Main function to create competitor features of each station from the prices of its neighbors at the same timestamp.
+       Neighbor prices are gathered from the price grid with integer positions, so the cost is stations x neighbors x timestamps without any merge.
+
+       Creates the columns:
+       - '{column}_nb_min', '{column}_nb_mean': minimum and mean price of all neighbors
+       - '{column}_nb_rank': rank of the station's price among itself and its neighbors, 1 is the cheapest
+       - '{column}_cheapest_{radius}': 1 if no neighbor within radius is cheaper, for each radius in the unit of the neighbor index
+
+    Args:
+        prices_df (pd.DataFrame): resampled prices, loaded from a csv file or as sorted panel
+        column (str): price column, e.g. 'diesel'
+        neighbors (pd.DataFrame): neighbor index as returned by neighbor_index()
+        radii (iterable, optional): radii for the "cheapest within radius" features. Defaults to (1, 3, 5).
+
+    Returns:
+        pd.DataFrame: sorted panel with the competitor features as additional columns
+    """
+    panel = prepare_panel(prices_df)
+    timestamps, stations, grid = price_grid(panel, column)
+    positions, distances = neighbor_positions(neighbors, stations)
+
+    # the appended NaN column is gathered for padded positions of missing neighbors
+    padded = np.c_[grid, np.full(len(timestamps), np.nan)]
+    neighbor_prices = padded[:, positions]
+    own_prices = grid[:, :, None]
+
+    features = {}
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        features[f'{column}_nb_min'] = np.nanmin(neighbor_prices, axis=2, initial=np.inf)
+        features[f'{column}_nb_mean'] = np.nanmean(neighbor_prices, axis=2)
+        features[f'{column}_nb_rank'] = 1 + (neighbor_prices < own_prices).sum(axis=2)
+        for radius in radii:
+            is_cheaper = (neighbor_prices < own_prices) & (distances <= radius)[None, :, :]
+            features[f'{column}_cheapest_{radius}'] = (~is_cheaper.any(axis=2)).astype(int)
+    features[f'{column}_nb_min'][np.isinf(features[f'{column}_nb_min'])] = np.nan
+
+    # the grid is timestamps x stations, the panel is sorted by station first
+    grid_index = pd.MultiIndex.from_product([stations, timestamps], names=panel.index.names)
+    features = pd.DataFrame({name: values.T.ravel() for name, values in features.items()}, index=grid_index)
+    return panel.join(features)
@@ -5,11 +5,17 @@ This module contains functions for general file management of unspecified type.
 
 It includes:
 
-    - get_files(path, suffix): provides a list of all files with a specified suffix within a folder and all sub-folders.
+    - get_files(path, suffix): provides a list of all files with a specified suffix within a folder and all sub-folders, including compressed files and archive members.
 
     - pick_random_csv(path, random_state): picks a random csv file from a folder incl. all sub-folder to work with as a sample.
     
     - save_without_overwrite(data, file_patch): function to save a file without overwriting if it already exists.
+
+    - prefetch(iterator, buffer): runs an iterator (e.g. reading files) in a background thread, keeping a bounded number of items ahead of the consumer.
+
+    - WriteBehind: executes writes in a background thread in their submitted order, with a bounded number of pending writes.
+
+    - KeyedWriter: submits writes to a shared WriteBehind under keys (prefix, key), e.g. to tell the writes of several subsets of the same file apart.
 """
 
 import pandas as pd
@@ -17,19 +23,32 @@ import numpy as np
 import arrow
 from pathlib import Path
 import random
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import archives
 
 
 def get_files(path: str, suffix='csv') -> list:
-    """Creates a set of all files of a specific file ending in a folder, including sub-folders.
+    """Creates a sorted list of all files of a specific file ending in a folder, including sub-folders.
+       Sorting keeps time-series files in the order of their naming convention.
+       Compressed files (e.g. '.csv.gz') are included, and so are the members of tar archives as virtual paths below the archive, see src.archives.
 
     Args:
         path (str): The path to look for files in.
         suffix (str, optional): Specify the file ending . Defaults to 'csv'.
 
     Returns:
-        path_list: list of all file-paths in the folder
+        path_list: sorted list of all file-paths in the folder
     """    
-    return list(Path(path).rglob(f'*.{suffix}'))
+    files = []
+    for file in Path(path).rglob('*'):
+        if archives.is_archive(file.name) and file.is_file():
+            files.extend(file / member for member, _ in archives.list_members(file, suffix))
+        elif archives.matches(file.name, suffix) and file.is_file():
+            files.append(file)
+    return sorted(files)
 
 
 def pick_random_csv(path: str, random_state=42) -> str:
@@ -65,4 +84,133 @@ def save_without_overwrite(data: pd.DataFrame, file_path):
     if file_path.is_file():
         raise FileExistsError(f"The file {file_path} already exists.")
     else:
-        data.to_csv(file_path, index=True)
\ No newline at end of file
+        data.to_csv(file_path, index=True)
+
+
+class _Raised:
+    """Wrapper to pass an exception from the background thread of prefetch() to the consuming thread"""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch(iterator, buffer: int=2):
+    """Generator that runs an iterator in a background thread and yields its items in order.
+       At most buffer items are read ahead, so I/O like reading the next files overlaps with processing the current one without unbounded memory.
+       An exception in the iterator is raised in the consuming thread when its position is reached.
+
+    Args:
+        iterator (iterable): any iterable, e.g. a generator reading files
+        buffer (int, optional): maximum number of items read ahead. Defaults to 2.
+
+    Yields:
+        the items of iterator
+    """
+    items = queue.Queue(maxsize=max(buffer, 1))
+    finished = object()
+    stop = threading.Event()
+
+    def put(item):
+        # time out regularly to notice when the consumer stopped early
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Raised(e))
+        put(finished)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is finished:
+                break
+            if isinstance(item, _Raised):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+
+
+class WriteBehind:
+    """Executes write functions (e.g. DataFrame.to_csv) in a background thread, so processing can continue while a file is written.
+       Writes are executed one after the other in the order they were submitted, which keeps appending chunks to the same file correct.
+       submit() blocks once buffer writes are pending, which bounds the memory held by data waiting to be written.
+
+       Errors don't interrupt the processing thread but are collected with the key they were submitted with, see pop_errors().
+    """
+
+    def __init__(self, buffer: int=2):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.BoundedSemaphore(max(buffer, 1))
+        self.errors = []
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Submits func(*args, **kwargs) to be executed in the background. key identifies the write in pop_errors(), e.g. the source file."""
+
+        self.slots.acquire()
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda future: self._done(key, future))
+        return future
+
+    def _done(self, key, future):
+        self.slots.release()
+        if future.exception() is not None:
+            with self.lock:
+                self.errors.append((key, future.exception()))
+                self.failed.add(key)
+
+    def pop_errors(self) -> list:
+        """Returns and clears all (key, exception) pairs of failed writes so far"""
+
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def succeeded(self, key) -> bool:
+        """True if no write submitted with key failed so far. Unlike pop_errors() this is not cleared, so it can be checked by a later write."""
+
+        with self.lock:
+            return key not in self.failed
+
+    def flush(self):
+        """Waits until all submitted writes are executed"""
+        self.executor.submit(lambda: None).result()
+
+    def close(self):
+        """Waits for all submitted writes and stops the background thread"""
+        self.executor.shutdown(wait=True)
+
+
+class KeyedWriter:
+    """Submits writes to a shared WriteBehind with the key (prefix, key) instead of key, so that errors of several users of the same writer,
+       e.g. the processors of each subset in MultiSubsetProcessor, can be told apart in pop_errors() of the shared writer.
+    """
+
+    def __init__(self, writer: WriteBehind, prefix):
+        self.writer = writer
+        self.prefix = prefix
+
+    def submit(self, key, func, *args, **kwargs):
+        """Submits func(*args, **kwargs) to the shared writer with the key (prefix, key)"""
+        return self.writer.submit((self.prefix, key), func, *args, **kwargs)
+
+    def succeeded(self, key) -> bool:
+        """True if no write submitted with key by this KeyedWriter failed so far"""
+        return self.writer.succeeded((self.prefix, key))
+
+    def flush(self):
+        """Waits until all writes submitted to the shared writer are executed"""
+        self.writer.flush()
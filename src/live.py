@@ -0,0 +1,298 @@
+"""
+Live Module
+-----------
+This module contains a streaming ingestion mode for price change events. Instead of waiting for the daily files from Tankerkönig, change events
+are consumed from a local source as they arrive (a csv file that is appended to, or a socket as stand-in for a push feed) and kept in a
+latest-price table that always holds the current prices of all stations. The events are periodically appended to the daily file layout of
+PRICES_DIR (YEAR/MONTH/YYYY-MM-DD-prices.csv), so that the batch pipeline (RawPriceProcessor) picks them up later like any downloaded day:
+
+    ingestor = LiveIngestor(PRICES_DIR, flush_interval=60)
+    ingestor.run(tail_file(ROOT_DIR / 'data' / 'live' / 'events.csv'))
+
+    # from another thread
+    ingestor.table.snapshot()
+
+Events have the columns of the raw price files: date, station_uuid, diesel, e5, e10 and the optional {fuel}change flags.
+Prices are interpreted like in process_prices.fill_missing_prices(): a missing price leaves the product of the station unchanged,
+a price of 0 or less means the product is not sold and the last positive price is kept.
+
+It includes:
+
+    - parse_events(): parse csv lines of change events into a DataFrame.
+
+    - tail_file(): follow a csv file that is appended to, yielding its new lines.
+
+    - socket_lines(): read lines from a TCP socket.
+
+    - LatestPrices: array-backed table of the latest price and selling flag of each product and station.
+
+    - daily_file(): the file of a day in the daily file layout.
+
+    - LiveIngestor: batches events from a source into LatestPrices and flushes them to the daily files.
+"""
+import io
+import time
+import socket
+import threading
+from pathlib import Path
+
+import pandas as pd
+import numpy as np
+
+from .config.paths import PRICES_DIR
+
+FUELS = ['diesel', 'e5', 'e10']
+EVENT_COLUMNS = ['date', 'station_uuid'] + FUELS + [f'{fuel}change' for fuel in FUELS]
+
+
+def parse_events(lines: list, columns: list=EVENT_COLUMNS) -> pd.DataFrame:
+    """Parses csv lines without header into change events. Lines that can't be parsed are skipped with a message.
+
+    Args:
+        lines (list): csv lines of change events
+        columns (list, optional): column names of the lines. Defaults to EVENT_COLUMNS.
+
+    Returns:
+        pd.DataFrame: events with float prices, in the order of the lines
+    """
+    try:
+        events = pd.read_csv(io.StringIO(''.join(line if line.endswith('\n') else line + '\n' for line in lines)),
+                             names=columns, header=None, dtype={'date': str, 'station_uuid': str}, on_bad_lines='skip')
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=columns)
+
+    for fuel in FUELS:
+        events[fuel] = pd.to_numeric(events[fuel], errors='coerce')
+    is_valid = events['date'].notna() & events['station_uuid'].notna()
+    if not is_valid.all():
+        print(f"Skipped {(~is_valid).sum()} malformed events")
+    return events[is_valid].reset_index(drop=True)
+
+
+def tail_file(file, poll_interval: float=1.0, stop: threading.Event=None, from_start: bool=True):
+    """Follows a csv file that is appended to, like 'tail -f', and yields its complete new lines. The header line is skipped.
+       The generator yields None whenever no new line arrived within poll_interval, so that consumers can flush in quiet periods.
+
+    Args:
+        file (str or Path): csv file of change events, created by the producer if it doesn't exist yet
+        poll_interval (float, optional): seconds to wait for new lines. Defaults to 1.0.
+        stop (threading.Event, optional): ends the generator when set. Defaults to None, following the file forever.
+        from_start (bool, optional): yield the lines already in the file. Defaults to True.
+    """
+    file = Path(file)
+    while not file.is_file():
+        if stop is not None and stop.is_set():
+            return
+        time.sleep(poll_interval)
+
+    with open(file, 'r') as f:
+        if not from_start:
+            f.seek(0, io.SEEK_END)
+        partial = ''
+        while stop is None or not stop.is_set():
+            line = f.readline()
+            if not line:
+                yield None
+                time.sleep(poll_interval)
+                continue
+            # the producer may not have written the whole line yet
+            partial += line
+            if not partial.endswith('\n'):
+                continue
+            line, partial = partial, ''
+            if line.startswith('date,'):
+                continue
+            yield line
+
+
+def socket_lines(host: str='localhost', port: int=9999, timeout: float=1.0, stop: threading.Event=None):
+    """Connects to a TCP socket and yields the lines it sends, as a stand-in for a push feed of change events.
+       Like tail_file(), the generator yields None whenever no data arrived within timeout and ends when the connection is closed.
+    """
+    with socket.create_connection((host, port)) as connection:
+        connection.settimeout(timeout)
+        buffer = b''
+        while stop is None or not stop.is_set():
+            try:
+                data = connection.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            if not data:
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                line = line.decode('utf-8').strip()
+                if line and not line.startswith('date,'):
+                    yield line + '\n'
+
+
+class LatestPrices:
+    """Array-backed table of the latest prices of all stations. Stations are mapped to rows once, so that a batch of events updates the table
+       with a few array assignments instead of DataFrame operations. The table grows when unknown stations appear.
+
+    Attributes:
+        fuels (list): price columns
+        rows (dict): station uuid -> row of the arrays
+        stations (list): station uuid of each row
+        prices (np.ndarray): float array of shape rows x fuels with the last positive price, NaN if no price was reported yet
+        is_selling (np.ndarray): int8 array of shape rows x fuels, 1 if the last reported price was positive
+        updated (np.ndarray): date string of the last event of each station
+    """
+
+    def __init__(self, fuels: list=FUELS, capacity: int=20_000):
+        self.fuels = fuels
+        self.rows = {}
+        self.stations = []
+        self.prices = np.full((capacity, len(fuels)), np.nan)
+        self.is_selling = np.zeros((capacity, len(fuels)), dtype=np.int8)
+        self.updated = np.full(capacity, None, dtype=object)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stations)
+
+    def encode(self, stations) -> np.ndarray:
+        """Returns the rows of stations, adding unknown stations to the table"""
+
+        for station in pd.unique(np.asarray(stations, dtype=object)):
+            if station not in self.rows:
+                self.rows[station] = len(self.stations)
+                self.stations.append(station)
+
+        if len(self.stations) > len(self.prices):
+            extra = max(len(self.stations), 2 * len(self.prices)) - len(self.prices)
+            self.prices = np.vstack([self.prices, np.full((extra, len(self.fuels)), np.nan)])
+            self.is_selling = np.vstack([self.is_selling, np.zeros((extra, len(self.fuels)), dtype=np.int8)])
+            self.updated = np.concatenate([self.updated, np.full(extra, None, dtype=object)])
+        return np.fromiter((self.rows[station] for station in stations), dtype=np.int64, count=len(stations))
+
+    def update(self, events: pd.DataFrame):
+        """Applies a batch of change events in their order: the last event of each station wins.
+
+           - A missing price leaves the price and selling flag of the product unchanged.
+           - A price of 0 or less sets the selling flag to 0 and keeps the last positive price.
+           - A positive price is stored and sets the selling flag to 1.
+        """
+        if events.empty:
+            return
+        with self.lock:
+            codes = self.encode(events['station_uuid'].to_numpy())
+            positions, rows = last_positions(codes)
+            self.updated[rows] = events['date'].to_numpy()[positions]
+
+            for column, fuel in enumerate(self.fuels):
+                values = events[fuel].to_numpy(dtype=float)
+                is_reported = ~np.isnan(values)
+                positions, rows = last_positions(codes, is_reported)
+                self.is_selling[rows, column] = values[positions] > 0
+                positions, rows = last_positions(codes, is_reported & (values > 0))
+                self.prices[rows, column] = values[positions]
+
+    def snapshot(self) -> pd.DataFrame:
+        """Returns the current table as DataFrame indexed by station, with the columns of fill_missing_prices() and the date of the last event"""
+
+        with self.lock:
+            n = len(self.stations)
+            data = {fuel: self.prices[:n, column].copy() for column, fuel in enumerate(self.fuels)}
+            data.update({f'{fuel}_is_selling': self.is_selling[:n, column].copy() for column, fuel in enumerate(self.fuels)})
+            data['updated'] = self.updated[:n].copy()
+            return pd.DataFrame(data, index=pd.Index(self.stations, name='station'))
+
+
+def last_positions(codes: np.ndarray, mask: np.ndarray=None):
+    """Positions of the last masked element of each code and the codes themselves, e.g. the last event of each station within a batch"""
+
+    positions = np.flatnonzero(mask) if mask is not None else np.arange(len(codes))
+    # np.unique returns the first occurrence, so search the reversed positions
+    reversed_positions = positions[::-1]
+    unique_codes, first = np.unique(codes[reversed_positions], return_index=True)
+    return reversed_positions[first], unique_codes
+
+
+def daily_file(directory, day: str) -> Path:
+    """File of a day ('YYYY-MM-DD') in the daily file layout: directory/YEAR/MONTH/YYYY-MM-DD-prices.csv"""
+    return Path(directory) / day[:4] / day[5:7] / f'{day}-prices.csv'
+
+
+class LiveIngestor:
+    """Consumes change events from a line source (tail_file(), socket_lines() or any iterable of csv lines), keeps the latest prices in a LatestPrices table
+       and periodically appends the events to the daily files, so that the batch pipeline can process them later.
+
+    Attributes:
+        directory (Path): root of the daily file layout, e.g. PRICES_DIR
+        table (LatestPrices): latest prices of all stations
+        batch_size (int): events that are parsed and applied at once
+        flush_interval (float): seconds between flushes to the daily files
+        pending (list): parsed events that were not flushed yet
+        totals (dict): number of events, flushes and written files
+    """
+
+    def __init__(self, directory=PRICES_DIR, batch_size: int=1000, flush_interval: float=60.0, columns: list=EVENT_COLUMNS):
+        self.directory = Path(directory)
+        self.table = LatestPrices()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.columns = columns
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.totals = {'events': 0, 'flushes': 0, 'files': 0}
+
+    def ingest(self, lines: list):
+        """Parses a batch of lines and applies it to the table"""
+
+        events = parse_events(lines, self.columns)
+        if events.empty:
+            return
+        self.table.update(events)
+        self.pending.append(events)
+        self.totals['events'] += len(events)
+
+    def flush(self):
+        """Appends the pending events to the file of their day, writing the header for new files. Events are sorted by date within each flush."""
+
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        events = pd.concat(self.pending, ignore_index=True)
+        self.pending = []
+
+        events = events.sort_values('date', kind='stable')
+        for day, day_events in events.groupby(events['date'].str[:10], sort=True):
+            file = daily_file(self.directory, day)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            is_new = not file.is_file()
+            day_events[self.columns].to_csv(file, mode='a', header=is_new, index=False)
+            self.totals['files'] += is_new
+        self.totals['flushes'] += 1
+
+    def run(self, source, stop: threading.Event=None):
+        """Consumes a source until it ends or stop is set. A batch is applied when it is full or the source is quiet (yields None),
+           pending events are flushed every flush_interval seconds and when the source ends.
+        """
+        batch = []
+        try:
+            for line in source:
+                if line is not None:
+                    batch.append(line)
+                if batch and (line is None or len(batch) >= self.batch_size):
+                    self.ingest(batch)
+                    batch = []
+                if time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.flush()
+                if stop is not None and stop.is_set():
+                    break
+        finally:
+            if batch:
+                self.ingest(batch)
+            self.flush()
+
+    def start(self, source) -> threading.Thread:
+        """Runs the ingestor in a background thread. Set the returned thread's stop event (thread.stop.set()) to end it."""
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self.run, args=(source, stop), daemon=True)
+        thread.stop = stop
+        thread.start()
+        return thread
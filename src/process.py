@@ -13,16 +13,29 @@ It includes:
 
     - get_unique_index(): pretty much what it says
 
+    - deduplicate(): resolve duplicated date/individual observations with a conflict policy in one sorted pass.
+
     - extend_panel(): extend a panel-like DataFrame with sparse observations into a DataFrame with observation s for each timestamp and each individual
 
     - panel_index_from_product(): creates a MultiIndex object by cross multiplying vectors of unique timestamps and unique individuals. serves as a mask to extend a sparse panel.
 
+    - LevelCache: sorted level of individuals that is reused from file to file as long as the individuals don't change, e.g. the stations of a subset.
+
+    - product_index(): cross product of two index levels built directly from integer codes.
+
+    - reindex_product(): reindex a panel to the cross product of two levels by placing its rows with integer codes.
+
     - swap_sort_index(): swap index levels in hierarchy and sort by index-level=0.
 
     - add_time_columns(): creates columns for specified datetime attributes.
+
+    - block_starts(): positions where a new individual starts in a panel sorted by individuals.
+
+    - block_positions(): position of each row within its individual's block of a sorted panel.
 """
 
 import pandas as pd
+import numpy as np
 import datetime as dt
 from typing import Union, List
 
@@ -103,7 +116,51 @@ def get_unique_index(df: pd.DataFrame, ind: Union[str, int]) -> pd.Series:
     return pd.Series(df.index.get_level_values(ind).unique())
 
 
-def extend_panel(df: pd.DataFrame, date: str='date', individual: str='station_uuid', names: list=['date','station']) -> pd.DataFrame:
+DUPLICATE_POLICIES = ['last', 'first', 'max_change']
+
+
+def deduplicate(df: pd.DataFrame, date: str='date', individual: str='station_uuid', keep: str='last', change_columns: list=None):
+    """Resolves duplicated date/individual observations before any reindexing. This happens on exactly one day in 10 years.
+    Duplicates are detected in one sorted pass over integer keys of both columns. Without duplicates, df is returned as it is.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a date and an individual column, e.g. a raw price file
+        date (str, optional): Name of the date column. Defaults to 'date'.
+        individual (str, optional): Name of the individual column. Defaults to 'station_uuid'.
+        keep (str, optional): Conflict policy, one of DUPLICATE_POLICIES. Defaults to 'last'.
+            - 'last', 'first': keep the last or first of the duplicated rows in the order of df.
+            - 'max_change': keep the row with most change flags set (e.g. dieselchange), on ties the last one.
+        change_columns (list, optional): change flag columns for 'max_change'. Defaults to None, using all columns containing 'change'.
+
+    Returns:
+        tuple: (DataFrame without duplicates in the original order, number of rows that were dropped)
+    """
+    if keep not in DUPLICATE_POLICIES:
+        raise ValueError(f"keep must be one of {DUPLICATE_POLICIES}")
+
+    date_codes, _ = pd.factorize(df[date])
+    individual_codes, individual_values = pd.factorize(df[individual])
+    keys = date_codes.astype(np.int64) * (len(individual_values) + 1) + individual_codes
+    sorted_keys = np.sort(keys)
+    if not (sorted_keys[1:] == sorted_keys[:-1]).any():
+        return df, 0
+
+    # sort by key, then by the policy. The last row of each key is kept
+    positions = np.arange(len(df))
+    if keep == 'max_change':
+        change_columns = change_columns if change_columns is not None else list(df.filter(like='change').columns)
+        score = df[change_columns].fillna(0).to_numpy().sum(axis=1)
+        order = np.lexsort((positions, score, keys))
+    else:
+        order = np.lexsort((positions if keep == 'last' else -positions, keys))
+
+    is_group_end = np.append(keys[order][1:] != keys[order][:-1], True)
+    kept = np.sort(order[is_group_end])
+    return df.iloc[kept], len(df) - len(kept)
+
+
+def extend_panel(df: pd.DataFrame, date: str='date', individual: str='station_uuid', names: list=['date','station'], individuals=None, keep: str='last',
+                 level_cache=None) -> pd.DataFrame:
     """Calls the methods to convert the DataFrame into a panel with a date and an individual column.
     Then stratifies the DataFrame by extending all timestamps to all stations
 
@@ -112,28 +169,110 @@ def extend_panel(df: pd.DataFrame, date: str='date', individual: str='station_uu
         date (str, optional): Name of the date column. Defaults to 'date'.
         individual (str, optional): Name of the individual column. Defaults to 'station_uuid'.
         names (list, optional): Names for [date, individual] indices . Defaults to ['date','station'].
+        individuals (iterable, optional): Individuals to extend the panel to instead of the individuals in df. Defaults to None.
+        keep (str, optional): Conflict policy for duplicated date/individual combinations, see deduplicate(). None if df is already deduplicated. Defaults to 'last'.
+        level_cache (LevelCache, optional): cache to reuse the level of individuals from the previous file. Defaults to None.
 
     Returns:
         pd.DataFrame: MultiIndex DataFrame with one time-series.
     """
-    # set panel indices and remove duplicate date/station combinations. This happens on exactly one day in 10 years
+    # remove duplicate date/station combinations before reindexing, which requires a unique index
+    if keep is not None:
+        df, _ = deduplicate(df, date, individual, keep)
+
+    # set panel indices and stratify. Only the timestamps are new in each file, the individuals can come from level_cache
     df = set_panel_index(df, date=date, individual=individual)
-    
-    try:
-        new_index = panel_index_from_product(df, date, individual, names)
-        return df.reindex(new_index)
-    
-    # df.reindex(new_index) will raise a ValueError in case of duplicated indices. To deal with this we can remove these duplicates first
-    except ValueError:
-        df = df[~df.index.duplicated(keep='last')]
-        new_index = panel_index_from_product(df, date, individual, names)
-        return df.reindex(new_index)
+    date_codes, timestamps = pd.factorize(df.index.get_level_values(date), sort=True)
+    level_cache = level_cache if level_cache is not None else LevelCache()
+    individual_level, individual_codes = level_cache.encode(df.index.get_level_values(individual), individuals)
+    return reindex_product(df, [timestamps, individual_level], [date_codes, individual_codes], names)
+
+def panel_index_from_product(df: pd.DataFrame, dt_index, ind_index, names, individuals=None):
+    """Helper Function that creates the stratified panel index of extend_panel with sorted levels"""
+    timestamps = get_unique_timestamps(df, dt_index).index.sort_values()
+    stations = get_unique_index(df, ind_index) if individuals is None else pd.Series(pd.unique(np.asarray(individuals)))
+    return product_index([timestamps, pd.Index(stations).sort_values()], names)
+
+
+class LevelCache:
+    """Sorted level of individuals (e.g. stations) that is reused from file to file as long as the individuals don't change.
+    The station universe of a subset is mostly constant across days, so each file only needs to look up its rows in the cached level
+    instead of building a new Index with its hash table. Use one cache per subset.
+
+    Attributes:
+        level (pd.Index): sorted unique individuals of the last call to encode()
+    """
+    def __init__(self):
+        self.level = None
+
+    def cache_token(self) -> str:
+        """Token in the key of cached results (see src.cache). The cached level only speeds up encode(), it never changes its result."""
+        return f'{type(self).__module__}.{type(self).__qualname__}'
+
+    def encode(self, values, individuals=None):
+        """Looks up the integer codes of values in the level of all individuals.
+
+        Args:
+            values (array-like): individual of each row
+            individuals (iterable, optional): all individuals of the panel. Defaults to None, using the individuals in values.
+
+        Returns:
+            tuple: (sorted level as pd.Index, np.ndarray of codes, -1 for values that are not part of individuals)
+        """
+        if self.level is not None:
+            codes = self.level.get_indexer(values)
+            if individuals is None:
+                # the same individuals as before if all values are known and every individual occurs
+                is_valid = len(codes) > 0 and codes.min() >= 0 and np.bincount(codes, minlength=len(self.level)).all()
+            else:
+                individuals = pd.Index(individuals)
+                is_valid = individuals.nunique() == len(self.level) and (self.level.get_indexer(individuals.unique()) >= 0).all()
+            if is_valid:
+                return self.level, codes
 
-def panel_index_from_product(df: pd.DataFrame, dt_index, ind_index, names):
-    """Helper Function for extend_panel to deal with exceptions"""
-    timestamps = set(get_unique_timestamps(df, dt_index))
-    stations = set(get_unique_index(df, ind_index))
-    return pd.MultiIndex.from_product([timestamps, stations], names=names)
+        self.level = pd.Index(pd.unique(np.asarray(values if individuals is None else individuals))).sort_values()
+        return self.level, self.level.get_indexer(values)
+
+
+def product_index(levels: list, names: list) -> pd.MultiIndex:
+    """Cross product of two index levels, built directly from integer codes without hashing any tuples. The first level changes slowest.
+
+    Args:
+        levels (list): two unique pd.Index objects
+        names (list): names of both levels
+
+    Returns:
+        pd.MultiIndex: MultiIndex with len(levels[0]) * len(levels[1]) entries
+    """
+    n_first, n_second = len(levels[0]), len(levels[1])
+    codes = [np.repeat(np.arange(n_first), n_second), np.tile(np.arange(n_second), n_first)]
+    return pd.MultiIndex(levels=levels, codes=codes, names=names, verify_integrity=False)
+
+
+def reindex_product(df: pd.DataFrame, levels: list, codes: list=None, names: list=None) -> pd.DataFrame:
+    """Reindexes a DataFrame with a unique 2-level MultiIndex to the cross product of levels, like df.reindex(product_index(levels, names)).
+    Each row is placed at its position in the product computed from the integer codes of both levels, missing rows are NaN.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a unique 2-level MultiIndex
+        levels (list): two unique pd.Index objects, e.g. sorted timestamps and sorted individuals
+        codes (list, optional): codes of each row of df in both levels, if they are already known. Defaults to None, looking them up.
+        names (list, optional): names of both levels. Defaults to None, using the names of df.
+
+    Returns:
+        pd.DataFrame: DataFrame indexed by the product of levels. Rows of df that are not part of levels are dropped.
+    """
+    if codes is None:
+        codes = [level.get_indexer(df.index.get_level_values(i)) for i, level in enumerate(levels)]
+    is_known = (codes[0] >= 0) & (codes[1] >= 0)
+
+    # position of each row of df in the product, -1 for positions without a row
+    indexer = np.full(len(levels[0]) * len(levels[1]), -1, dtype=np.intp)
+    indexer[codes[0][is_known] * len(levels[1]) + codes[1][is_known]] = np.flatnonzero(is_known)
+
+    index = product_index(levels, names if names is not None else list(df.index.names))
+    columns = {column: pd.api.extensions.take(df[column].to_numpy(), indexer, allow_fill=True) for column in df.columns}
+    return pd.DataFrame(columns, index=index, columns=df.columns)
 
 
 def swap_sort_index(df: pd.DataFrame) -> pd.DataFrame:
@@ -162,3 +301,33 @@ def add_time_columns(df: pd.DataFrame, date='date', attributes=['year', 'month',
     """
     timestamps = df.index.get_level_values(date)
     return df.assign(**{attr: getattr(timestamps, attr) for attr in attributes})
+
+
+def block_starts(individuals) -> np.ndarray:
+    """Returns the positions at which a new individual starts in a panel that is sorted by individuals.
+    Each individual is expected to be one contiguous block of rows, as it is after swap_sort_index().
+
+    Args:
+        individuals (array-like): individual of each row, e.g. df.index.get_level_values('station')
+
+    Returns:
+        np.ndarray: integer positions of the first row of each block
+    """
+    individuals = np.asarray(individuals)
+    if len(individuals) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[True, individuals[1:] != individuals[:-1]])
+
+
+def block_positions(individuals) -> np.ndarray:
+    """Returns the position of each row within its individual's block, counted from 0 at the first row of the block.
+
+    Args:
+        individuals (array-like): individual of each row of a panel sorted by individuals
+
+    Returns:
+        np.ndarray: integer position within the block for every row
+    """
+    starts = block_starts(individuals)
+    lengths = np.diff(np.r_[starts, len(individuals)])
+    return np.arange(len(individuals)) - np.repeat(starts, lengths)
@@ -8,20 +8,36 @@ This module implements the FileProcessor class, including sub-classes. Its main
 - FileSplitter(): A subclass specified to horizontally split the files into columns, keeping their indices, and saving them into multiple files.
 - FileMerger(): A subclass specified to vertically merge all files within a folder into a single file.
 - PriceProcessor(): A subclass that can be used to transform just about any csv file by applying a function or importing a predefined function and then processing an full directory in this manner.
+- MultiSubsetProcessor(): A subclass that reads each file only once and passes the rows of each of several named subsets on to its own processor of any of the classes above.
+- StationProcessor(): A subclass to consolidate the daily station exports into a station table that only stores changes between days.
+- FeatureProcessor(): A subclass to create lagged, rolling and time-of-day features from resampled prices, carrying the required rows of each station from one file to the next.
+- DatabaseLoader(): A subclass to bulk load processed, split or resampled panels into an embedded SQLite database for fast queries, see src.sqlstore.
 
 Functions that are specific to the data in this project are imported from src.process and src.price_process to keep this class modular and reusable.
 
-Running this module as __main__ will process all raw data imported from Tankerkönig. Currently can't take any arguments.
+Running this module as __main__ will process all raw data imported from Tankerkönig. Optionally takes --start and --end dates to reprocess only these days.
+
+Compressed files (e.g. '.csv.gz') and the members of tar archives are processed directly, without decompressing them to disk first, see src.archives.
 
 IMPORTANT: All files that need to be processed in a specific order like time-series data rely on the files's naming convention to be sortable.
 """
 import pandas as pd
+import numpy as np
 import datetime as dt
 import time
+import contextlib
+import tempfile
 
 from . import fileutils
+from . import process
+from . import catalog
 from . import process_prices
 from . import process_stations
+from . import features
+from . import aggregates
+from . import sqlstore
+from . import runlength
+from . import archives
 
 from .config.paths import ROOT_DIR
 
@@ -37,17 +53,31 @@ class FileProcessor:
         target_directory (str or Path): directory to save processed files into. structure of directory will be mirrored.
     
     Methods:
-        process_directory(): Process all files contained in directory, provides a progressbar as processing may take a while.
+        process_directory(start, end, queue): Process all files contained in directory, or only the files from start to end. Provides a progressbar as processing may take a while.
+        process_queue(queue, start, end): Process the files together with other workers on a shared work queue, see src.workqueue.
         list_files(): Returns a list of all files that are to be processed
         get_sample(suffix, random_state): Picks a random sample from all files in list_files to work with before processing. can be accessed with self.sample
+        get_catalog(suffix): Returns the cached catalog of all files in directory with their dates, sizes and row counts, see src.catalog.
+        sample_rows(n, start, end, days, random_state), sample_stations(...): Draw random rows or stations across many files into self.sample without reading whole files.
         set_subset(subset, subset_column, subset_df_column): Will be called automatically on __init__, but can also be called after init to process only a subset.
         get_subset(): Method used mostly internally reducing the current DataFrame to the specified subset when being called.
-        process_file(file): Method to load a file into a DataFrame, reduce it a subset if specified, process the data and then save the new file.
+        read_file(file, source): Method to load a file into DataFrames reduced to the subset, either as a whole or in chunks of chunksize rows.
+        process_file(file, chunks): Method to load a file into a DataFrame, reduce it a subset if specified, process the data and then save the new file.
+        process_frame(data, file, append): Method to process the DataFrame of a file that was already loaded and reduced to the subset, and then save the new file.
+        start_directory(start): Method called before the first file of process_directory() is processed. Not used by default.
+        start_file(file, prescan), finish_file(file): Methods called before and after the chunks of a file are processed. Not used by default.
+        prescan_columns(): Method that returns the columns start_file() needs from the whole file before its chunks are processed. None by default.
         save_to_file(data, file): Method to save a DataFrame in the target_directory with a relative file location as the original file location.
+        target_file(file, *subdirectories): Method that returns the file in target_directory that the output of a file is saved in, compressed if compression is set.
+        write_csv(data, target, file): Method used by save_to_file to write a csv file, in a background thread if write_behind is set.
         meta_dict(): Method that contains a dictionary about what meta information is to be stored from each file in an extra metadata DataFrame
         save_metadata(). Saved the metadata stored in self.metadata after calling process_directory()
     """
-    def __init__(self, directory, target_directory, subset=None, subset_column=None, subset_df_column=None, save_files=True):
+    # subclasses without state that spans files can be processed by several workers, see process_queue()
+    distributable = False
+
+    def __init__(self, directory, target_directory, subset=None, subset_column=None, subset_df_column=None, save_files=True, chunksize=None,
+                 prefetch=0, write_behind=0, decompress=0, compression=None):
         """On instantiation only stores information about the source directory files and, if already specified, the data subset.
 
         Args:
@@ -56,6 +86,13 @@ class FileProcessor:
             subset (iterable or DataFrame, optional): see set_subset()
             subset_column (_type_, optional): see set_subset()
             subset_df_column (_type_, optional): see set_subset()
+            chunksize (int, optional): number of rows to read and process at once. Peak memory then depends on chunksize instead of the file size.
+                                       Defaults to None, reading whole files.
+            prefetch (int, optional): number of files (or chunks) process_directory() reads ahead in a background thread. Defaults to 0, reading when needed.
+            write_behind (int, optional): number of pending writes process_directory() allows in a background thread. Defaults to 0, writing immediately.
+            decompress (int, optional): number of threads process_directory() decompresses compressed files and archive members with, ahead of reading them.
+                                        Defaults to 0, decompressing while reading.
+            compression (str, optional): compression of the saved files, 'gzip', 'zstd', 'bz2' or 'xz'. Defaults to None, saving plain csv files.
         """
         self.directory = Path(directory)
         self.target_directory = Path(target_directory)
@@ -63,35 +100,204 @@ class FileProcessor:
         self.metadata = pd.DataFrame()
         self.error_files = []
         self.save = save_files
+        self.chunksize = chunksize
+        self.prefetch = prefetch
+        self.write_behind = write_behind
+        self.decompress = decompress
+        self.compression = compression
+        self.writer = None
+        self.catalog = None
         self.set_subset(subset, subset_column, subset_df_column)
 
 
-    def process_directory(self):
-        """Process all files in self.directory and call process_file() on them"""
+    def process_directory(self, start=None, end=None, queue=None):
+        """Process all files in self.directory and call process_file() on them.
+           With start and end, only the files of these days are processed, selected by the dates in their filenames, e.g. to reprocess one week.
+           With prefetch, upcoming files are read in a background thread while the current one is processed.
+           With decompress, compressed files and archive members are additionally decompressed in parallel threads ahead of the background reader.
+           With write_behind, saving files happens in a background thread. Files that fail to be read or written end up in error_files like all others.
+           With a queue, the files are shared with other workers, see process_queue().
+
+        Args:
+            start (str or pd.Timestamp, optional): first day to process. Defaults to None, starting with the first file.
+            end (str or pd.Timestamp, optional): last day to process (inclusive). Defaults to None, ending with the last file.
+            queue (WorkQueue, optional): shared work queue from src.workqueue. Defaults to None, processing all files in this process.
+        """
+
+        if queue is not None:
+            return self.process_queue(queue, start, end)
+
+        # the catalog lists the files of all subdirectories (1 level) sorted by their dates, only changed directories are scanned again
+        file_catalog = self.get_catalog()
+        files_per_subdir = {self.directory / name: file_catalog.paths(start, end, subset=name) for name in file_catalog.subdirectories()}
+        files_per_subdir = {subdir: files for subdir, files in files_per_subdir.items() if files}
+        subdirectories = list(files_per_subdir)
+        self.start_directory(start)
+
+        # the background reader continues across subdirectories, files are still processed in their sorted order
+        prefetched = None
+        if self.prefetch or self.decompress:
+            prefetched = fileutils.prefetch(self.read_files(f for files in files_per_subdir.values() for f in files), max(self.prefetch, 1))
+        if self.write_behind:
+            self.set_writer(fileutils.WriteBehind(self.write_behind))
+
+        try:
+            # iterate through the subdirectories, use a tqdm-wrapper to keep track of the progress
+            for subdir in tqdm(subdirectories, desc="Processing directories"):
+                files = files_per_subdir[subdir]
+                with tqdm(total=len(files), desc=f"Processing files in {subdir.name}") as pbar:
+                    for file in files:
+                        chunks = self.file_chunks(prefetched, file) if prefetched else None
+                        try:
+                        # Process and save each file
+                            self.process_file(file, chunks)
+                        except Exception as e:
+                            # If the processing goes somehow wrong, skip the file, raise an error and safe which file wasn't processed
+                            print(f"An error occurred processing file {file}: {str(e)}")
+                            self.record_error(file)
+                        # chunks of a file that were not processed because of an error or on purpose must not be passed on to the next file
+                        if chunks:
+                            with contextlib.suppress(Exception):
+                                for _ in chunks:
+                                    pass
+                        self.collect_write_errors()
+                        pbar.set_postfix_str(f"Current file: {file}", refresh=True)
+                        pbar.update()
+        finally:
+            if self.writer:
+                self.writer.close()
+                self.collect_write_errors()
+                self.set_writer(None)
+            if prefetched:
+                prefetched.close()
+
+
+    def process_queue(self, queue, start=None, end=None) -> pd.DataFrame:
+        """Processes the files of self.directory together with other workers (processes or hosts) that run the same on a shared work queue.
+           Each file is claimed by one worker at a time, in no particular order. Only subclasses without state that spans files can be distributed.
+           Files that fail are retried by any worker until the max_attempts of the queue, afterwards they are part of error_files on every worker.
+
+        Args:
+            queue (WorkQueue): shared work queue from src.workqueue
+            start (str or pd.Timestamp, optional): first day to process. Defaults to None, starting with the first file.
+            end (str or pd.Timestamp, optional): last day to process (inclusive). Defaults to None, ending with the last file.
+
+        Returns:
+            pd.DataFrame: merged report of all workers, see WorkQueue.report()
+        """
+
+        if not self.distributable:
+            raise ValueError(f"{type(self).__name__} keeps state across files and can't be processed by several workers.")
+
+        file_catalog = self.get_catalog()
+        files = [f for name in file_catalog.subdirectories() for f in file_catalog.paths(start, end, subset=name)]
+        self.start_directory(start)
+        if self.write_behind:
+            self.set_writer(fileutils.WriteBehind(self.write_behind))
+
+        try:
+            for file in tqdm(queue.claim(files, self.directory), desc=f"Processing claimed files as {queue.worker}"):
+                error_count = len(self.error_files)
+                try:
+                    self.process_file(file)
+                    # a file is only done once it is written completely
+                    if self.writer:
+                        self.writer.flush()
+                    # the reason of a failed write is reported like any other error of the file
+                    errors = [str(e) for _, e in self.collect_write_errors()]
+                except Exception as e:
+                    print(f"An error occurred processing file {file}: {str(e)}")
+                    self.record_error(file)
+                    errors = [str(e)]
+                if errors or len(self.error_files) > error_count:
+                    queue.fail(file, '; '.join(errors) or f"error processing {file.relative_to(self.directory)}")
+                    self.error_files = self.error_files[:error_count]
+                else:
+                    queue.complete(file)
+        finally:
+            if self.writer:
+                self.writer.close()
+                self.collect_write_errors()
+                self.set_writer(None)
+
+        self.error_files = queue.error_files(self.directory)
+        return queue.report()
+
+
+    def read_files(self, files):
+        """Generator that reads all files with read_file(), used as background reader in process_directory().
+           With decompress, the files are decompressed in parallel threads ahead of reading, see archives.decompress_ahead().
+           Yields (file, DataFrame) for each chunk, (file, exception) if reading fails and (file, None) once a file is complete.
+        """
+
+        sources = archives.decompress_ahead(files, self.decompress) if self.decompress else ((file, None) for file in files)
+        for file, source in sources:
+            try:
+                if isinstance(source, Exception):
+                    raise source
+                for data in self.read_file(file, source):
+                    yield file, data
+            except Exception as e:
+                yield file, e
+            yield file, None
+
 
-        # use pathlib to generate a sorted generator expression of subdirectories (1 level)
-        subdirectories = sorted(d for d in self.directory.iterdir() if d.is_dir())
+    def file_chunks(self, prefetched, file):
+        """Generator that yields the prefetched chunks of one file from the background reader of process_directory(). Raises the error if reading failed."""
 
-        # iterate through the subdirectories, use a tqdm-wrapper to keep track of the progress
-        for subdir in tqdm(subdirectories, desc="Processing directories"):
-            files = list(fileutils.get_files(subdir))
-            with tqdm(total=len(files), desc=f"Processing files in {subdir.name}") as pbar:
-                for file in files:
-                    try:
-                    # Process and save each file
-                        self.process_file(file)
-                    except Exception as e:
-                        # If the processing goes somehow wrong, skip the file, raise an error and safe which file wasn't processed
-                        print(f"An error occurred processing file {file}: {str(e)}")
-                        self.error_files.append(file)
-                    pbar.set_postfix_str(f"Current file: {file}", refresh=True)
-                    pbar.update()
+        for chunk_file, data in prefetched:
+            if chunk_file != file:
+                raise RuntimeError(f"Expected prefetched data of {file}, but received {chunk_file}.")
+            if data is None:
+                return
+            if isinstance(data, Exception):
+                # consume the end marker of the file before raising
+                next(prefetched)
+                raise data
+            yield data
+
+
+    def set_writer(self, writer):
+        """Sets the WriteBehind instance used by write_csv(), None writes immediately"""
+        self.writer = writer
+
+
+    def write_csv(self, data, target, file, **kwargs):
+        """Writes data to target with DataFrame.to_csv. With a writer set by process_directory(), the write is executed in the background.
+
+        Args:
+            data (pd.DataFrame): data to write
+            target (Path): csv file to write to
+            file (Path): source file of the data to report in error_files if the write fails
+            **kwargs: passed on to DataFrame.to_csv
+        """
+        if self.writer:
+            self.writer.submit(file, data.to_csv, target, **kwargs)
+        else:
+            data.to_csv(target, **kwargs)
+
+
+    def collect_write_errors(self) -> list:
+        """Adds files that failed to be written in the background to error_files and returns their (file, exception) pairs"""
+
+        errors = self.writer.pop_errors() if self.writer else []
+        for file, e in errors:
+            print(f"An error occurred writing file {file}: {str(e)}")
+            self.record_error(file)
+        return errors
+
+
+    def record_error(self, file):
+        """Adds a file that failed to be read, processed or written to error_files, once"""
+
+        if file not in self.error_files:
+            self.error_files.append(file)
 
 
     def list_files(self):
         """Prints a list of all files that are to be processed and returns it as a list."""
 
-        files = list(fileutils.get_files(self.directory))
+        files = self.get_catalog().paths()
         print(f'{self.directory.relative_to(ROOT_DIR)} contains {len(files)} files.')
         for file in files:
             print(file.relative_to(ROOT_DIR))
@@ -109,10 +315,44 @@ class FileProcessor:
             pd.DataFrame: randomly chosen file loaded into a DataFrame
         """
 
-        random.seed(random_state)
-        files = list(Path(self.directory).rglob(f'*.{suffix}'))
-        self.sample = pd.read_csv(random.choice(files))
-        self.sample = self.get_subset(self.sample)
+        file = self.get_catalog(suffix).sample_files(1, random_state=random_state)[0]
+        self.sample = pd.concat(self.read_file(file))
+        return self.sample
+
+
+    def get_catalog(self, suffix: str='csv') -> catalog.FileCatalog:
+        """Returns the up-to-date catalog of self.directory, see src.catalog.
+           The saved catalog is loaded on the first call, afterwards only changed directories are scanned again.
+        """
+
+        if self.catalog is None or self.catalog.suffix != suffix:
+            self.catalog = catalog.FileCatalog.open(self.directory, suffix)
+        elif self.catalog.refresh():
+            self.catalog.save()
+        return self.catalog
+
+
+    def sample_rows(self, n: int, start=None, end=None, days: int=None, random_state: int=None) -> pd.DataFrame:
+        """Draws n random rows across the files between start and end, reading only the blocks of rows that are sampled. If a subset is specified, already applies it.
+           See FileCatalog.sample_rows() for the arguments. With a subset, fewer than n rows are returned.
+        """
+
+        self.sample = self.get_subset(self.get_catalog().sample_rows(n, start, end, days=days, random_state=random_state))
+        return self.sample
+
+
+    def sample_stations(self, n: int, start=None, end=None, days: int=None, random_state: int=None) -> pd.DataFrame:
+        """Draws n random stations and loads all of their rows in the files between start and end. If a subset is specified, stations are drawn from the subset.
+           See FileCatalog.sample_stations() for the arguments.
+        """
+
+        stations = None
+        if self.subset:
+            column, stations = next(iter(self.subset.items()))
+            stations = list(stations)
+        else:
+            column = 'station_uuid'
+        self.sample = self.get_catalog().sample_stations(n, start, end, days=days, column=column, stations=stations, random_state=random_state)
         return self.sample
     
     
@@ -162,33 +402,92 @@ class FileProcessor:
         return data
 
         
-    def process_file(self, file):
-        """Default method how to process a file on a file basis. Currently saves no metadata by default. Includes saving a file"""
+    def read_file(self, file, source=None):
+        """Generator that reads a file into DataFrames reduced to the desired subset.
+           Yields the whole file at once, or chunks of self.chunksize rows so that only one chunk is in memory at a time.
+           Compressed files and archive members are decompressed while reading, unless source already holds their decompressed content.
+        """
 
+        if self.chunksize:
+            reader = archives.read_csv(file, source, chunksize=self.chunksize)
+        else:
+            reader = [archives.read_csv(file, source)]
+        for data in reader:
+            yield self.get_subset(data)
+
+
+    def process_file(self, file, chunks=None):
+        """Default method how to process a file on a file basis. Currently saves no metadata by default. Includes saving a file.
+           If a chunksize is specified, each chunk is processed and appended to the saved file on its own.
+           chunks can pass on DataFrames that were already read with read_file(), e.g. by the background reader of process_directory().
+        """
+
+        self.start_file(file)
         # read the file into a DataFrame and reduce it to the desired subset
-        data = pd.read_csv(Path(file).resolve())
-        data = self.get_subset(data)
+        for i, data in enumerate(chunks if chunks is not None else self.read_file(file)):
+            self.process_frame(data, file, append=i > 0)
+        self.finish_file(file)
+
+
+    def start_directory(self, start=None):
+        """Called by process_directory() before the first file is processed. Subclasses with state that spans files can prepare it here, e.g. to continue on start."""
+        pass
+
+
+    def prescan_columns(self) -> list:
+        """Columns of the whole file that start_file() needs before the chunks are processed, e.g. to know all stations of the file. None by default."""
+        return []
+
+
+    def start_file(self, file, prescan=None):
+        """Called before the first chunk of a file is processed. Subclasses with state that spans chunks can prepare it here.
+           prescan holds the prescan_columns() of the whole file if they were read already, e.g. once for all subsets by MultiSubsetProcessor.
+        """
+        pass
+
+
+    def finish_file(self, file):
+        """Called after the last chunk of a file is processed. Subclasses with state that spans chunks can complete the file here."""
+        pass
+
+
+    def process_frame(self, data, file, append=False):
+        """Processes a DataFrame that was already read from file and reduced to the subset. Includes saving a file.
+           Separated from process_file so that the data of one file can be passed on to several processors, see MultiSubsetProcessor.
+           append=True adds the processed data to the file saved from the previous chunks.
+        """
 
         # process the DataFrame. process_data is a method on the Instance Variables
         self.process_data(data)
 
         # save the files
         if self.save:
-            self.save_to_file(self.last_processed, file)
+            self.save_to_file(self.last_processed, file, append=append)
 
         # APPEND STUFF TO self.metadata HERE
         # file_metadata = self.update_metadata(self.last_processed)
         # self.update_metadata(file_metadata)
 
 
-    def save_to_file(self, data, file):
-        """Method to save a file in the specified target_directory. Keeps the originals directory file structure by looking up relative paths."""
+    def save_to_file(self, data, file, append=False):
+        """Method to save a file in the specified target_directory. Keeps the originals directory file structure by looking up relative paths.
+           With append=True the data is added to an existing file without repeating the header, e.g. when a file is processed in chunks.
+        """
 
-        # file is required here only to create the new relative Path, but the file itself is not used
-        relative_path = file.relative_to(self.directory)
-        target = self.target_directory / relative_path
+        target = self.target_file(file)
         target.parent.mkdir(parents=True, exist_ok=True)
-        data.to_csv(target)
+        self.write_csv(data, target, file, mode='a' if append else 'w', header=not append)
+
+
+    def target_file(self, file, *subdirectories):
+        """Returns the file in target_directory (and its subdirectories) that the output of file is saved in. The relative path of file is mirrored
+           without archive and compression suffixes (see archives.logical_path()), with the suffix of self.compression if set.
+           pandas compresses the file according to its suffix, also when appending chunks.
+        """
+
+        # file is required here only to create the new relative Path, but the file itself is not used
+        relative_path = archives.logical_path(file.relative_to(self.directory))
+        return archives.with_compression(self.target_directory.joinpath(*subdirectories, relative_path), self.compression)
 
 
     def process_data(self, data):
@@ -222,25 +521,135 @@ class RawPriceProcessor(FileProcessor):
     - Irregular timestamps and sparse observations: The panel will be stratified by cross-multiplying all individuals and all timestamps in a panel resulting in one observation per individual per timestamp. 
     - This class will not create equidistant timestamps.
     - transform timezone specific datetime-strings into a correct datetime format.
-    - Sort data by individual firstly and by datetime secondly.
+    - Sort data by individual firstly and by datetime secondly. In chunked mode this holds for each chunk, see below.
     - Stores the last observation for each individual and each file as metadata.
     - Stores average prices for each day as metadata to generate daily data.
+    - Optionally updates a daily aggregate store with time-weighted statistics per station, brand and region, see src.aggregates.
+    - Resolves duplicated date/station observations with a conflict policy (keep) and stores their number per file in the metadata.
+    - Optionally flags if a station is open at each timestamp, using the opening hours from src.process_stations.
+    - Processing large files in chunks (chunksize) with the same results as processing the whole file:
+      All stations of the file are read first to stratify every chunk with the same stations, rows of the last timestamp in a chunk are held back for the next one
+      and each chunk continues from the closing prices of the previous one. Unlike a new day, a chunk also continues the products a station didn't sell at its end.
+      The files must be sorted by date, like the daily files from Tankerkönig. Only in the very first file, stations without any price in a chunk can't be backfilled from later chunks.
+      The saved rows are the same, but ordered date-major: the file holds one block per chunk in date order, each sorted by station and date.
+      Chunks never share a timestamp, so sort_index() on the read file restores the order of whole-file processing.
+    - Processing a date range (process_directory(start, end)) continues from the stored closing prices of the previous days, with the same results as a full run.
+    - Optionally stores only the change points of each station instead of the dense panel (output_mode='changes'), see src.runlength.
 
     Args:
         FileProcessor (class): This is a sub-class of the FileProcessor-class
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, opening_hours=None, holidays=None, closing_prices=None, keep='last', aggregates=None, output_mode='dense', **kwargs):
+        """
+        Args:
+            opening_hours (OpeningHours, optional): opening hours of the stations from src.process_stations to add an 'is_open' column. Defaults to None.
+            holidays (iterable, optional): dates that are holidays, see process_stations.holiday_dates(). Defaults to None.
+            closing_prices (pd.DataFrame or str or Path, optional): closing prices of a previous run or the path of its closing_prices metadata file.
+                                                                    Processing a date range continues from the closing prices before its start. Defaults to None.
+            keep (str, optional): conflict policy for duplicated date/station observations: 'last', 'first' or 'max_change', see process.deduplicate(). Defaults to 'last'.
+            aggregates (AggregateStore, optional): store from src.aggregates that is updated with the daily totals of each file. Defaults to None.
+            output_mode (str, optional): 'dense' saves the stratified panel, 'changes' only the rows where a value of a station changes.
+                                         Change-point files are expanded with runlength.read_changes() or runlength.expand_changes(). Defaults to 'dense'.
+        """
+        if output_mode not in ('dense', 'changes'):
+            raise ValueError("output_mode must be 'dense' or 'changes'")
         super().__init__(*args, **kwargs)
+        self.output_mode = output_mode
+        self.stored_closing_prices = closing_prices
+        self.keep = keep
+        self.level_cache = process.LevelCache()
+        self.aggregates = aggregates
+        self.file_aggregates = []
+        self.pending_panel = None
         self.last_closing_prices = pd.DataFrame()
         self.closing_prices = pd.DataFrame()
-    
+        self.opening_hours = opening_hours
+        self.holidays = holidays
+        self.file_stations = None
+        self.file_totals = []
+        self.held_back = None
+        self.saved_chunks = 0
+
+    def start_directory(self, start=None):
+        """Continues from the stored closing prices of the days before start, if processing starts on a later day and no closing prices are known yet"""
+
+        if start is None or self.stored_closing_prices is None or not self.last_closing_prices.empty:
+            return
+        closing_prices = self.stored_closing_prices
+        if not isinstance(closing_prices, pd.DataFrame):
+            closing_prices = pd.read_csv(closing_prices, index_col=0)
+        self.last_closing_prices = process_prices.closing_prices_before(closing_prices, start)
+
+    def prescan_columns(self) -> list:
+        """In chunked mode, all stations of a file (and the subset columns to reduce them) are needed before the first chunk"""
+
+        if not self.chunksize:
+            return []
+        return list(dict.fromkeys(['station_uuid', *(self.subset or {})]))
+
+    def start_file(self, file, prescan=None):
+        """In chunked mode, reads only the station column of the file to stratify all chunks with the same stations, unless prescan already holds it.
+           State of a previous file that failed part way is reset, so it is not mixed into the totals and aggregates of this file.
+        """
+
+        if self.chunksize:
+            if prescan is None:
+                prescan = pd.concat(archives.read_csv(file, usecols=self.prescan_columns(), chunksize=self.chunksize))
+            self.file_stations = self.get_subset(prescan)['station_uuid'].unique()
+        self.held_back = None
+        self.saved_chunks = 0
+        self.file_totals = []
+        self.file_aggregates = []
+        self.pending_panel = None
+
+    def process_frame(self, data, file, append=False):
+        """Modified implementation of process_frame that holds back the rows of the last timestamp in chunked mode, as they might continue in the next chunk"""
+
+        if not self.chunksize:
+            return super().process_frame(data, file, append)
+
+        if self.held_back is not None:
+            data = pd.concat([self.held_back, data], ignore_index=True)
+        # a chunk can hold no rows of the subset at all, e.g. in MultiSubsetProcessor
+        is_last_timestamp = (data['date'] == data['date'].iloc[-1]).to_numpy() if len(data) else np.zeros(0, dtype=bool)
+        self.held_back, data = data[is_last_timestamp], data[~is_last_timestamp]
+
+        if not data.empty:
+            super().process_frame(data, file, append=self.saved_chunks > 0)
+            self.saved_chunks += 1
+
+    def save_to_file(self, data, file, append=False):
+        """Modified version of save_to_file that reduces the panel to its change points in output_mode 'changes'"""
+
+        if self.output_mode == 'changes':
+            data = runlength.encode_changes(data)
+        super().save_to_file(data, file, append)
+
+    def finish_file(self, file):
+        """Processes the held back rows and stores closing prices and metadata once for the whole file"""
+
+        if self.held_back is not None and not self.held_back.empty:
+            super().process_frame(self.held_back, file, append=self.saved_chunks > 0)
+        self.held_back = None
+        self.file_stations = None
+
+        if self.chunksize:
+            self.update_closing_prices()
+            self.update_metadata()
+            self.update_aggregates(final=True)
+
     def process_data(self, data):
         """
         Implementing the method not implemented in the parent class on how to process data.
         Imports the specifics from src.process_prices, extracts closing prices and metadata from the transformed panel
         """
 
-        self.last_processed = process_prices.process_data(data, self.last_closing_prices)
+        # duplicates are resolved once here to count them, process_data() then skips its own deduplication
+        data, duplicates = process.deduplicate(data, keep=self.keep)
+        # the chunks after the first continue the previous chunk of the same file without a break, unlike a new day
+        continues = bool(self.chunksize) and self.saved_chunks > 0
+        self.last_processed = process_prices.process_data(data, self.last_closing_prices, self.opening_hours, self.holidays, self.file_stations, None,
+                                                         self.level_cache, continues)
         new_closing_prices = process_prices.get_closing_prices(self.last_processed)
 
         # closing prices is empty on the first iteration so it needs to be treated differently
@@ -249,18 +658,49 @@ class RawPriceProcessor(FileProcessor):
         else:
             self.last_closing_prices = new_closing_prices.combine_first(self.last_closing_prices)
 
-        # update closing prices and metadata
-        self.update_closing_prices()
-        self.update_metadata()
+        # update closing prices and metadata. In chunked mode this happens once all chunks of a file are processed.
+        self.file_totals.append(process_prices.get_metadata_totals(self.last_processed).assign(duplicates=duplicates))
+        if not self.chunksize:
+            self.update_closing_prices()
+            self.update_metadata()
+        self.update_aggregates(final=not self.chunksize)
 
         # returning DataFrame so the method can also be called to directly transform a DataFrame.
         return self.last_processed
 
     def update_metadata(self):
-        """Method that updates self.metadata with data from the processed DataFrame. Function specifics are imported"""
+        """Method that updates self.metadata with data from the processed DataFrame(s) of a file. Function specifics are imported"""
 
-        meta = process_prices.get_metadata(self.last_processed)
+        meta = process_prices.metadata_from_totals(pd.concat(self.file_totals, ignore_index=True))
         self.metadata = pd.concat([self.metadata, meta], ignore_index=True)
+        self.file_totals = []
+
+    def update_aggregates(self, final=False):
+        """Computes the daily totals of the processed data and updates the aggregate store once per file.
+           In chunked mode the last prices of a chunk are valid until the first timestamp of the next chunk, so each chunk is aggregated once the next one is processed.
+        """
+
+        if self.aggregates is None:
+            return
+
+        if self.chunksize:
+            # the panel of the previous chunk ends where the current one begins
+            if self.pending_panel is not None and not final:
+                end = self.last_processed.index.get_level_values('date').min()
+                self.file_aggregates.append(aggregates.daily_totals(self.pending_panel, self.aggregates.fuels, not self.file_aggregates, end))
+            if final:
+                if self.pending_panel is not None:
+                    self.file_aggregates.append(aggregates.daily_totals(self.pending_panel, self.aggregates.fuels, not self.file_aggregates))
+                self.pending_panel = None
+            else:
+                self.pending_panel = self.last_processed
+                return
+        else:
+            self.file_aggregates.append(aggregates.daily_totals(self.last_processed, self.aggregates.fuels))
+
+        if self.file_aggregates:
+            self.aggregates.update(self.file_aggregates)
+        self.file_aggregates = []
 
     def meta_dict(self):
         """Extended version of the metadata dict from the parent class. Required for saving it to a file."""
@@ -286,6 +726,8 @@ class FileSplitter(FileProcessor):
         FileProcessor (class): This is a sub-class of the FileProcessor-class
     """
 
+    distributable = True
+
     def __init__(self, directory, target_directory, split: list, *args, **kwargs):
         """
         Args:
@@ -299,15 +741,13 @@ class FileSplitter(FileProcessor):
         self.last_processed = {}
         self.split = split
 
-    def save_to_file(self, data, file):
+    def save_to_file(self, data, file, append=False):
         """Modified version of save_to_file from FileProcessor to accommodate for split-folders."""
 
-        # file is required here only to create the new relative Path, but the file itself is not used
         for key, data in data.items():
-            relative_path = file.relative_to(self.directory)
-            target = self.target_directory / key / relative_path
+            target = self.target_file(file, key)
             target.parent.mkdir(parents=True, exist_ok=True)
-            data.to_csv(target)
+            self.write_csv(data, target, file, mode='a' if append else 'w', header=not append)
 
     def process_data(self, data):
         """Set and keep panel indices in each of the dataframes while splitting the remainder of columns into separate DataFrames"""
@@ -332,40 +772,37 @@ class FileMerger(FileProcessor):
         self.merged_data = pd.DataFrame()
         self.data_list = []
 
-    def process_directory(self):
-        """Modified version of the parent-class' version that, after loading all files into memory, merges and sorts them.
+    def process_directory(self, start=None, end=None):
+        """Modified version of the parent-class' version that, after loading all files (from start to end) into memory, merges and sorts them.
            Merging and sorting is implemented in src.process_prices and can be either replaced or adjusted.
            Can work with subsets like any of the other child-classes.
            All data that is to be merged needs to fit into memory.
         """
 
-        super().process_directory()
+        super().process_directory(start, end)
         start_time = time.time()
         self.merged_data = process_prices.merge_sort_index(self.data_list)
         end_time = time.time()
         tqdm.write(f'Merged {len(self.merged_data)} rows in {end_time - start_time} seconds.')
 
-    def process_file(self, file):
-        """Modified implementation of process_file that, unlike in all other subclasses, does not save the file immediately after processing"""
-
-        # read the file into a DataFrame and reduce it to the desired subset
-        data = pd.read_csv(Path(file).resolve())
-        data = self.get_subset(data)
+    def process_frame(self, data, file, append=False):
+        """Modified implementation of process_frame that, unlike in all other subclasses, does not save the file immediately after processing.
+           With a chunksize, files are reduced to the subset chunk by chunk before they are kept in memory.
+        """
 
         # process the DataFrame. process_data is a method on the Instance Variables.
         self.process_data(data)
         # this subclass does not save the file immediately
 
 
-    def save_to_file(self, data, dir=None):
-        "Modified implementation of save_to_file with a different target_directory and naming convention"
+    def save_to_file(self, data, dir=None, name=None):
+        "Modified implementation of save_to_file with a different target_directory and naming convention. name defaults to the name of directory."
 
         # Saving merged file(s) into a parallel /merged/ directory with the original directories name as filename
-        f'{self.directory.name}.csv'
         if not dir:
             dir = Path(self.target_directory / 'merged')
         dir.mkdir(parents=True, exist_ok=True)
-        dir = Path(dir / f'{self.directory.name}.csv')
+        dir = archives.with_compression(dir / f'{name or self.directory.name}.csv', self.compression)
 
         # Wrapping the actual saving into a timer as this might take some time.
         print(f"Saving merged DataFrame...")
@@ -394,12 +831,61 @@ class PriceProcessor(FileProcessor):
        - pass a method that takes a pd.DataFrame and any *args and **kwargs as argument and returns a pd.DataFrame using set_method
        - test the method using process_data() on PriceProcessor.sample
        - call process_directory() when the method applies the desired transformation
+
+       Files are processed independently of each other, so process_directory(queue=...) can distribute them across workers, see src.workqueue.
+       With a cache (src.cache.ResultCache), files are skipped when the same input file was already processed with the same method, args and kwargs,
+       and their output is restored from the cache if it was overwritten in the meantime. Use the same cache for several processors to share results.
         """
 
-    def __init__(self, directory, target_directory, method=None, method_kwargs={}, *args, **kwargs):
+    distributable = True
+
+    def __init__(self, directory, target_directory, method=None, method_kwargs={}, *args, cache=None, **kwargs):
         super().__init__(directory, target_directory, *args, **kwargs)
         self.predefined_methods = process_prices.get_methods()
         self.set_method(method, **method_kwargs)
+        self.cache = cache
+        self.cached_files = []
+
+
+    def process_directory(self, start=None, end=None, queue=None):
+        """Modified version of the parent-class' version that saves the index of the cache and reports how many files were restored from it"""
+
+        self.cached_files = []
+        report = super().process_directory(start, end, queue)
+        if self.cache is not None:
+            self.cache.save()
+            tqdm.write(f'{len(self.cached_files)} files were unchanged and restored from the cache.')
+        return report
+
+
+    def process_file(self, file, chunks=None):
+        """Modified version of process_file that skips files whose result is cached and stores the output of all other files in the cache"""
+
+        if self.cache is None or not self.save or self.method is None:
+            return super().process_file(file, chunks)
+
+        subset = {column: sorted(values, key=str) for column, values in self.subset.items()} if self.subset else None
+        # the compression of the output is part of the key only if set, so keys of plain outputs stay valid
+        output = {'compression': self.compression} if self.compression else {}
+        key = self.cache.key(file, self.method, self.method_args, self.method_kwargs, subset=subset, chunksize=self.chunksize, **output)
+        target = self.target_file(file)
+        if self.cache.restore(key, target):
+            self.cached_files.append(file)
+            return
+
+        super().process_file(file, chunks)
+        # with write_behind, the output is stored once the background writes of the file are complete, and only if none of them failed
+        if self.writer:
+            self.writer.submit(file, self.store_result, self.writer, file, key, target)
+        else:
+            self.cache.store(key, target)
+
+
+    def store_result(self, writer, file, key, target):
+        """Stores the output of file in the cache unless a background write of file failed, so an incomplete output is never restored"""
+
+        if writer.succeeded(file):
+            self.cache.store(key, target)
 
 
     def set_method(self, method, *args, **kwargs):
@@ -448,40 +934,435 @@ class PriceProcessor(FileProcessor):
     
 
 
-    
+
+class FeatureProcessor(FileProcessor):
+    """Subclass to create features for resampled panel-data as produced by resample_timestamps. Specifics are implemented in src.features.
+       Files are processed in their sorted order and the last rows of each station are carried over into the next file,
+       so lags, rolling windows and time-of-day profiles continue across file boundaries as if all files were one panel.
+       With chunksize, files are read and saved in chunks of rows, which keeps memory bounded for large files like the output of FileMerger.
+
+    Args:
+        FileProcessor (class): This is a sub-class of the FileProcessor-class
+    """
+
+    def __init__(self, directory, target_directory, columns: list, lags=(1, 24), windows=(24, 168), attributes=features.TIME_ATTRIBUTES,
+                 profile_attr='hour', chunksize=None, *args, **kwargs):
+        """
+        Args:
+            directory (str or Path): directory of files that are to be processed
+            target_directory (str or Path): directory to save processed files into. structure of directory will be mirrored.
+            columns (list): price columns to create features for, e.g. ['diesel']
+            lags (iterable, optional): lags in rows. Defaults to (1, 24).
+            windows (iterable, optional): rolling window sizes in rows. Defaults to (24, 168).
+            attributes (list, optional): datetime attributes to add as columns. Defaults to features.TIME_ATTRIBUTES.
+            profile_attr (str, optional): datetime attribute the time-of-day profile is grouped by. Defaults to 'hour'.
+            chunksize (int, optional): number of rows to read at once. Defaults to None, reading whole files.
+        """
+        super().__init__(directory, target_directory, *args, chunksize=chunksize, **kwargs)
+        self.columns = columns
+        self.lags = lags
+        self.windows = windows
+        self.attributes = attributes
+        self.profile_attr = profile_attr
+        self.carry = None
+        self.profile_state = None
+
+    def process_data(self, data):
+        """Creates the features for data, using the rows carried over from previously processed data as context"""
+
+        data = features.prepare_panel(data)
+
+        # carry is None on the first iteration so it is initialized empty with the structure of the data
+        if self.carry is None:
+            self.carry = data.iloc[:0]
+
+        # only the carried rows of stations in this data are needed as context, the rows of all other stations are kept aside
+        is_context = self.carry.index.get_level_values(0).isin(data.index.get_level_values(0))
+        combined = pd.concat([self.carry[is_context].assign(is_new=False), data.assign(is_new=True)]).sort_index()
+        new_rows = combined.pop('is_new').to_numpy(dtype=bool)
+
+        panel, self.profile_state = features.build_features(combined, self.columns, self.lags, self.windows, self.attributes,
+                                                            self.profile_attr, self.profile_state, new_rows)
+
+        carried = features.carry_over(combined, features.lookback(self.lags, self.windows))
+        self.carry = pd.concat([self.carry[~is_context], carried])
+        self.last_processed = panel[new_rows]
+
+        # returning DataFrame so the method can also be called to directly transform a DataFrame.
+        return self.last_processed
+
+    def update_metadata(self):
+        raise NotImplementedError("Not implemented for this subclass")
+
+
 class StationProcessor(FileProcessor):
-    """NYI"""
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """Subclass to consolidate the daily station exports into a slowly-changing-dimension station table. Specifics are implemented in src.process_stations.
+       Files are processed in their sorted (i.e. daily) order and only stations that are new, changed or removed compared to the previous day are stored.
+       Per file, only the hashes of the currently valid versions are compared, so every export is read exactly once.
+
+       The resulting table has one row per version of a station with 'uuid', 'valid_from', 'valid_to' and all station attributes.
+       It is saved with save_to_file() and can be loaded again with load_table() to continue it incrementally with new exports.
+
+    Args:
+        FileProcessor (class): This is a sub-class of the FileProcessor-class
+    """
+    def __init__(self, directory, target_directory, attributes=process_stations.STATION_ATTRIBUTES, *args, **kwargs):
+        """
+        Args:
+            directory (str or Path): directory of daily station exports
+            target_directory (str or Path): directory to save the station table into
+            attributes (list, optional): attributes that define a version of a station. Defaults to process_stations.STATION_ATTRIBUTES.
+        """
+        super().__init__(directory, target_directory, *args, **kwargs)
+        self.attributes = attributes
+        self.current = pd.DataFrame({'hash': pd.Series(dtype='uint64'), 'valid_from': pd.Series(dtype='datetime64[ns]')})
+        self.versions = []
+        self.closed = []
+        self.last_date = None
+
+    def read_file(self, file, source=None):
+        """Modified implementation of read_file that reads all attributes as strings, so that e.g. house numbers are not parsed as floats"""
+
+        data = archives.read_csv(file, source, dtype=str)
+        yield self.get_subset(data)
+
+    def process_file(self, file, chunks=None):
+        """Modified implementation of process_file that does not save a file for each export.
+           Exports that are already part of the station table are skipped without reading them.
+        """
+
+        date = process_stations.file_date(file)
+        if self.last_date is not None and date <= self.last_date:
+            return
+
+        # read the file into a DataFrame and reduce it to the desired subset
+        data = pd.concat(chunks if chunks is not None else self.read_file(file))
+        self.process_data(data, date)
+
+    def process_data(self, data, date):
+        """Compares one daily export with the currently valid versions and stores only the differences"""
+
+        date = pd.Timestamp(date)
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f"Exports must be processed in daily order, but {date.date()} follows {self.last_date.date()}.")
+
+        snapshot = process_stations.prepare_snapshot(data, self.attributes)
+        versions, closed, self.current, counts = process_stations.compare_snapshot(self.current, snapshot, date)
+        if not versions.empty:
+            self.versions.append(versions)
+        if not closed.empty:
+            self.closed.append(closed)
+
+        self.last_date = date
+        self.update_metadata(date, counts)
+        return versions
+
+    def update_metadata(self, date, counts):
+        """Stores the number of new, changed and removed stations for each export"""
+
+        meta = pd.DataFrame([{'date': date.date(), **counts}])
+        self.metadata = pd.concat([self.metadata, meta], ignore_index=True)
+
+    def get_table(self):
+        """Returns the station table of all processed exports"""
+        return process_stations.build_table(self.versions, self.closed)
+
+    def get_stations(self, date=None):
+        """Returns the stations valid on date, or the currently valid stations if no date is specified"""
+
+        table = self.get_table()
+        if date is None:
+            return table[table['valid_to'].isna()].reset_index(drop=True)
+        return process_stations.stations_at(table, date)
+
+    def load_table(self, table):
+        """Continues an existing station table, e.g. loaded from a previously saved file, instead of starting from the first export.
+
+        Args:
+            table (pd.DataFrame or str or Path): station table as returned by get_table() or the path of its csv file
+        """
+        if not isinstance(table, pd.DataFrame):
+            table = pd.read_csv(table, dtype=str)
+        table = table.assign(valid_from=pd.to_datetime(table['valid_from']), valid_to=pd.to_datetime(table['valid_to']))
+
+        self.versions = [table.drop(columns='valid_to').set_index('uuid')]
+        self.closed = [table.loc[table['valid_to'].notna(), ['uuid', 'valid_from', 'valid_to']].set_index('uuid')]
+        self.current = process_stations.current_versions(table, self.attributes)
+        self.last_date = table[['valid_from', 'valid_to']].max().max()
+
+    def save_to_file(self, data=None, file_name='stations_scd.csv'):
+        """Modified implementation of save_to_file that saves the station table into the target_directory"""
+
+        if data is None:
+            data = self.get_table()
+        self.target_directory.mkdir(parents=True, exist_ok=True)
+        self.write_csv(data, self.target_directory / file_name, file_name, index=False)
+
+    def meta_dict(self):
+        return {
+            'stations_metadata': self.metadata,
+        }
+
+
+class DatabaseLoader(FileProcessor):
+    """Subclass to bulk load processed panels, e.g. the output of RawPriceProcessor, FileSplitter or resample_timestamps, into a table of the embedded database.
+       Specifics are implemented in src.sqlstore. Each file (or chunk, with a chunksize) is inserted in batches within one transaction,
+       rows of files that are loaded again replace the existing rows with the same station and date.
+
+    Args:
+        FileProcessor (class): This is a sub-class of the FileProcessor-class
+    """
+
+    def __init__(self, directory, table: str, database=sqlstore.DATABASE_FILE, *args, **kwargs):
+        """
+        Args:
+            directory (str or Path): directory of processed csv files
+            table (str): name of the table to load the files into, e.g. 'prices_dus_plus' or 'resampled_diesel'
+            database (str or Path, optional): SQLite database file. Defaults to sqlstore.DATABASE_FILE.
+        """
+        super().__init__(directory, Path(database).parent, *args, **kwargs)
+        self.table = table
+        self.database = Path(database)
+        self.table_created = False
+
+    def process_data(self, data):
+        """Converts the panel into columns with UTC timestamps as stored in the database"""
+
+        self.last_processed = sqlstore.prepare_panel(data)
+        return self.last_processed
+
+    def save_to_file(self, data, file, append=False):
+        """Modified implementation of save_to_file that inserts the data into the table instead of writing a csv file. Runs in the background with write_behind."""
+
+        if self.writer:
+            self.writer.submit(file, self.insert, data, file)
+        else:
+            self.insert(data, file)
+
+    def insert(self, data, file):
+        """Inserts the data of a file into the table within one transaction and stores the number of rows"""
 
-    def process_data(self, file):
-        return process_stations.process_data(file)
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        with sqlstore.get_engine(self.database).begin() as connection:
+            if not self.table_created:
+                sqlstore.create_table(connection, self.table, data)
+                self.table_created = True
+            rows = sqlstore.insert_panel(connection, self.table, data)
+        self.update_metadata(file, rows)
 
-    def update_metadata(self, data):
-        return process_stations.update_metadata(data)
+    def update_metadata(self, file, rows):
+        """Stores the number of rows loaded from each file"""
+
+        meta = pd.DataFrame([{'file': Path(file).name, 'table': self.table, 'rows': rows}])
+        self.metadata = pd.concat([self.metadata, meta], ignore_index=True)
+
+    def meta_dict(self):
+        return {
+            'database_metadata': self.metadata,
+        }
+
+
+class MultiSubsetProcessor(FileProcessor):
+    """Subclass to process several named subsets of the same data in one pass over the directory.
+       Each file is read only once and its rows are routed to one processor per subset, each with its own state (e.g. carried over closing prices),
+       metadata, error_files and target directory (target_directory / name).
+       error_files of this processor lists (name, file) for each subset a file failed in. A file that can't be read fails in all subsets.
+
+    Args:
+        FileProcessor (class): This is a sub-class of the FileProcessor-class
+    """
+
+    def __init__(self, processor_class, directory, target_directory, subsets: dict, subset_column: str, subset_df_column: str=None, *args,
+                 subset_kwargs: dict=None, **kwargs):
+        """
+        Args:
+            processor_class (class): FileProcessor subclass to create a processor for each subset with, e.g. RawPriceProcessor
+            directory (str or Path): directory of files that are to be processed
+            target_directory (str or Path): directory to save processed files into. Each subset is saved into a sub-directory with its name.
+            subsets (dict): name -> subset, each subset as accepted by set_subset()
+            subset_column (str): see set_subset()
+            subset_df_column (str, optional): see set_subset()
+            subset_kwargs (dict, optional): name -> dict of additional keyword arguments for the processor of this subset only,
+                                            e.g. its stored closing prices for RawPriceProcessor. Defaults to None.
+            *args, **kwargs: passed on to processor_class for each subset
+        """
+        subset_kwargs = subset_kwargs or {}
+        super().__init__(directory, target_directory, chunksize=kwargs.get('chunksize'),
+                         prefetch=kwargs.pop('prefetch', 0), write_behind=kwargs.pop('write_behind', 0), decompress=kwargs.pop('decompress', 0))
+        self.processors = {
+            name: processor_class(directory, self.target_directory / name, *args, subset=subset, subset_column=subset_column,
+                                  subset_df_column=subset_df_column, **{**kwargs, **subset_kwargs.get(name, {})})
+            for name, subset in subsets.items()
+        }
+        self.last_processed = {}
+
+    def process_file(self, file, chunks=None):
+        """Reads a file once (or chunk by chunk) and passes the rows of each subset on to its processor. Errors only affect the subset they occur in."""
+
+        failed = set()
+        # columns the processors need from the whole file before its chunks (e.g. all stations in chunked mode) are read once for all subsets
+        columns = list(dict.fromkeys(column for processor in self.processors.values() for column in processor.prescan_columns()))
+        prescan = None
+        if columns:
+            prescan = pd.concat(archives.read_csv(file, usecols=columns, chunksize=self.chunksize)) if self.chunksize else archives.read_csv(file, usecols=columns)
+        self.run_processors(lambda name, processor: processor.start_file(file, prescan), file, failed)
+
+        for i, data in enumerate(chunks if chunks is not None else self.read_file(file)):
+            # factorizing the subset columns once per chunk turns each subset filter into a lookup on the unique values only
+            factorized = {}
+            routed = {}
+            for name, processor in self.processors.items():
+                is_member = np.ones(len(data), dtype=bool)
+                for column, values in (processor.subset or {}).items():
+                    if column not in factorized:
+                        factorized[column] = pd.factorize(data[column])
+                    codes, uniques = factorized[column]
+                    # NaN values have the code -1 and are never part of a subset
+                    is_member &= np.append(uniques.isin(values), False)[codes]
+                routed[name] = data[is_member]
+
+            self.run_processors(lambda name, processor: processor.process_frame(routed[name], file, append=i > 0), file, failed)
+
+        self.run_processors(lambda name, processor: processor.finish_file(file), file, failed)
+        self.last_processed = {name: processor.last_processed for name, processor in self.processors.items()}
+
+    def set_writer(self, writer):
+        """Shares the WriteBehind instance with the processors of all subsets. Their writes are submitted with the subset name, see collect_write_errors()."""
+
+        self.writer = writer
+        for name, processor in self.processors.items():
+            processor.set_writer(fileutils.KeyedWriter(writer, name) if writer else None)
+
+    def collect_write_errors(self) -> list:
+        """Adds files that failed to be written in the background to error_files of the subset they were written for and returns their ((name, file), exception) pairs"""
+
+        errors = self.writer.pop_errors() if self.writer else []
+        for (name, file), e in errors:
+            print(f"An error occurred writing subset {name} of file {file}: {str(e)}")
+            self.record_error(file, [name])
+        return errors
+
+    def record_error(self, file, names=None):
+        """Adds (name, file) to error_files and file to error_files of the processor of each subset in names, once.
+           Without names, e.g. if the file could not be read, the file failed for all subsets.
+        """
+
+        for name in self.processors if names is None else names:
+            if (name, file) not in self.error_files:
+                self.error_files.append((name, file))
+            self.processors[name].record_error(file)
+
+    def start_directory(self, start=None):
+        """Prepares the processor of each subset"""
+
+        for processor in self.processors.values():
+            processor.start_directory(start)
+
+    def run_processors(self, step, file, failed: set):
+        """Runs one step of processing a file for each subset that did not fail on this file yet, collecting errors per subset"""
+
+        for name, processor in self.processors.items():
+            if name in failed:
+                continue
+            try:
+                step(name, processor)
+            except Exception as e:
+                print(f"An error occurred processing subset {name} of file {file}: {str(e)}")
+                failed.add(name)
+                self.record_error(file, [name])
+
+    def process_data(self, data):
+        """Processes a DataFrame with the processor of each subset"""
+
+        self.last_processed = {name: processor.process_data(processor.get_subset(data)) for name, processor in self.processors.items()}
+        return self.last_processed
+
+    def save_metadata(self, meta_dir, suffix=None):
+        """Saves the metadata of each subset with the subset name as additional suffix"""
+
+        for name, processor in self.processors.items():
+            processor.save_metadata(meta_dir, suffix=f'{suffix or ""}_{name}')
+
+    def update_metadata(self):
+        raise NotImplementedError("Not implemented for this subclass")
+
+
+def check_error_files(processor_class=RawPriceProcessor, **kwargs):
+    """Processes a directory with one corrupt file with a MultiSubsetProcessor and raises an AssertionError unless the file is listed once
+       as (name, file) for each subset in its error_files, and once in error_files of the processor of each subset.
+
+    Args:
+        processor_class (class, optional): FileProcessor subclass of the subsets. Defaults to RawPriceProcessor.
+        **kwargs: passed on to MultiSubsetProcessor, e.g. chunksize, prefetch or write_behind
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        file = directory / 'prices' / '2023' / '05' / '2023-05-01-prices.csv.gz'
+        file.parent.mkdir(parents=True)
+        file.write_bytes(b'not gzip compressed')
+
+        subsets = {'a': ['station_a'], 'b': ['station_b']}
+        processor = MultiSubsetProcessor(processor_class, directory / 'prices', directory / 'processed', subsets=subsets, subset_column='station_uuid', **kwargs)
+        processor.catalog = catalog.FileCatalog(processor.directory, file=directory / 'catalog.pkl')
+        with contextlib.redirect_stdout(None):
+            processor.process_directory()
+
+        assert processor.error_files == [(name, file) for name in subsets], processor.error_files
+        for name, subset_processor in processor.processors.items():
+            assert subset_processor.error_files == [file], (name, subset_processor.error_files)
 
 
 if __name__ == '__main__':
-    """When __main__ is called, the 'Düsseldorf' subset will be applied to all data, reducing the number of stations to 130 down from 15,000.
+    """When __main__ is called, the 'Düsseldorf', 'Rheinland' and 'NRW' subsets will be processed in one pass over all data.
+       The 'Düsseldorf' subset reduces the number of stations to 130 down from 15,000.
        - Loads directories from config.paths
-       - Processes all raw data using the RawPriceProcessor. Specifics of the transformation are defined in process_prices.
+       - Processes all raw data using the RawPriceProcessor for each subset. Specifics of the transformation are defined in process_prices.
+       - Each subset is saved into a sub-directory of PROCESSED_PRICES with its name.
        - Any errors while processing directories will be caught and printed.
-       - Saves metadata collected from all files. Metadata is currently average daily prices.
+       - Saves metadata collected from all files for each subset. Metadata is currently average daily prices.
+       - Updates the daily aggregate store of each subset with time-weighted statistics per station, brand and region.
+       - With --start and --end only these days are reprocessed, continuing from the closing prices saved in META_DIR by a previous run.
+         Their metadata is saved with the date range as suffix.
+       - With --check only check_error_files() is run instead.
        
     """
+    import argparse
     
     from .config.paths import PRICES_DIR, PROCESSED_PRICES
     from .config.paths import STATIONS_DIR, PROCESSED_STATIONS
     from .config.paths import META_DIR, SAMPLE_DIR
-
-    dus_stations_data = pd.read_csv(SAMPLE_DIR / 'stations' / 'stations_dus_plus.csv')
-    dus_stations = dus_stations_data.uuid
+    from .process_scripts.arguments import range_suffix
+
+    subsets = {
+        name: pd.read_csv(SAMPLE_DIR / 'stations' / f'stations_{name}.csv').uuid
+        for name in ['dus_plus', 'rheinland', 'nrw']
+    }
+
+    parser = argparse.ArgumentParser(description='Process the raw prices of all subsets')
+    parser.add_argument('--start', help='first day to process (YYYY-MM-DD). Defaults to the first file.')
+    parser.add_argument('--end', help='last day to process (YYYY-MM-DD), inclusive. Defaults to the last file.')
+    parser.add_argument('--check', action='store_true', help='only check that a corrupt file is reported in error_files of every subset')
+    args = parser.parse_args()
+    if args.check:
+        for kwargs in [{}, {'chunksize': 1000}, {'prefetch': 2, 'decompress': 2, 'write_behind': 2}]:
+            check_error_files(**kwargs)
+        print("A corrupt file is reported in error_files of every subset.")
+        raise SystemExit
+
+    # closing prices of the previous full run for each subset, only used if processing starts after the first day
+    # daily aggregates per station, brand and region are stored for each subset in PROCESSED_DIR / 'aggregates'
+    from .config.paths import PROCESSED_DIR
+    groups = aggregates.station_groups(pd.read_csv(ROOT_DIR / 'data' / 'stations.csv'))
+    subset_kwargs = {name: {'aggregates': aggregates.AggregateStore(PROCESSED_DIR / 'aggregates' / name, groups)} for name in subsets}
+    for name in subsets:
+        if (META_DIR / f'closing_prices_{name}.csv').is_file():
+            subset_kwargs[name]['closing_prices'] = META_DIR / f'closing_prices_{name}.csv'
 
     print(PRICES_DIR)
-    processor = RawPriceProcessor(PRICES_DIR, PROCESSED_PRICES, subset=dus_stations, subset_column='station_uuid')
-    processor.process_directory()
-    processor.save_metadata(META_DIR)
+    processor = MultiSubsetProcessor(RawPriceProcessor, PRICES_DIR, PROCESSED_PRICES, subsets=subsets, subset_column='station_uuid', subset_kwargs=subset_kwargs)
+    processor.process_directory(args.start, args.end)
+    processor.save_metadata(META_DIR, suffix=range_suffix(args.start, args.end) or None)
 
     print("The following files caused errors:")
-    for error_file in processor.error_files:
-        print(error_file)
+    for name, error_file in processor.error_files:
+        print(name, error_file)
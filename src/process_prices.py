@@ -12,10 +12,16 @@ It includes:
 
     - get_metadata(): dictionary that defines methods to collect metadata from the raw data while running RawPriceProcessor.
 
+    - get_metadata_totals(), metadata_from_totals(): metadata split into sums and counts, so that chunks of the same file can be combined.
+
+    - station_blocks(): positions of the first and last row of each station in a sorted panel.
+
     - get_closing_prices(): function to collect and store the last processed files' latest prices.
 
     - impute_closing_prices(): function to impute closing prices from get_closing_prices() into the next file.
 
+    - closing_prices_before(): restores the closing prices to continue processing on a date from stored closing prices.
+
     - fill_missing_prices(): method that fills NaN values after stratification and replaces 0 prices.
 
     - split_panel(): main function for the FileSplitter class
@@ -29,34 +35,48 @@ import numpy as np
 import inspect
 
 from . import process
+from . import features
 from .config.paths import SAMPLE_DIR
 
-def process_data(data: pd.DataFrame, last_closing_prices: pd.DataFrame)->pd.DataFrame:
+def process_data(data: pd.DataFrame, last_closing_prices: pd.DataFrame, opening_hours=None, holidays=None, stations=None, keep: str='last',
+                 level_cache=None, continues: bool=False)->pd.DataFrame:
     """main function to process all raw data from the Tankerkönig import with all its specifics. Also the main function to carry over data from one file to the next.
 
 
     Args:
         data (pd.DataFrame): DataFrame with raw price-data
         last_closing_prices (pd.DataFrame): closing prices to be imputed from the previous day. usually stored in self.last_closing_prices
+        opening_hours (OpeningHours, optional): see fill_missing_prices(). Defaults to None.
+        holidays (iterable, optional): see fill_missing_prices(). Defaults to None.
+        stations (iterable, optional): stations to stratify the panel with instead of the stations in data, e.g. all stations of a file that is processed in chunks. Defaults to None.
+        keep (str, optional): conflict policy for duplicated date/station observations, see process.deduplicate(). None if data is already deduplicated.
+                              Defaults to 'last'.
+        level_cache (process.LevelCache, optional): cache of the station level to reuse from the previous file. Defaults to None.
+        continues (bool, optional): True if data continues last_closing_prices without a break, e.g. the next chunk of the same file.
+                                    Stations then keep not selling a product and keep their closing prices until they report a price,
+                                    see impute_closing_prices() and fill_missing_prices(). Defaults to False, where each day starts from its reported prices.
 
     Returns:
         pd.DataFrame: MultiIndex DataFrame with indices: 'station' -> 'date', resampled to the original timestamps.
     """
 
+    # Resolve duplicated observations while the change flags are still available for the 'max_change' policy
+    if keep is not None:
+        data, _ = process.deduplicate(data, keep=keep)
+
     # Drop the 'change' columns for now as they dont provide us with any insight. FUTURE FEATURE ENGINEERING
     data = data.drop(columns=data.filter(like='change').columns)
 
     # Stratify the panel by cross-multiplying all timestamps with all stations and set a MultiIndex
-    data = process.extend_panel(data)
+    data = process.extend_panel(data, individuals=stations, keep=None, level_cache=level_cache)
     data = process.swap_sort_index(data)
 
     # If the first row is empty, impute them with the closing prices from the previous day
-    # SOMETIMES DOESNT WORK, FIX
     if not last_closing_prices.empty:
-        data = impute_closing_prices(data, last_closing_prices)
+        data = impute_closing_prices(data, last_closing_prices, carry_not_selling=continues)
 
     # ForwardFill all prices until a price-change occurs
-    data = fill_missing_prices(data)
+    data = fill_missing_prices(data, opening_hours, holidays, last_closing_prices if continues else None)
 
     return data
 
@@ -82,49 +102,113 @@ def get_metadata(data: pd.DataFrame)->pd.DataFrame:
         pd.DataFrame: one-Row DataFrame of file-specific metadata
     """
 
+    return metadata_from_totals(get_metadata_totals(data))
+
+
+def get_metadata_totals(data: pd.DataFrame)->pd.DataFrame:
+    """Creates a one-row DataFrame with sums and counts of all prices. Totals of several chunks of the same file can be combined with metadata_from_totals()."""
+
     return pd.DataFrame([{
         "date": data.tail(1).index.get_level_values(1)[0].date(),
-        "diesel_mean": data.diesel.mean().round(3),
-        "e5_mean": data.e5.mean().round(3),
-        "e10_mean": data.e10.mean().round(3),
+        **{f"{fuel}_sum": data[fuel].sum() for fuel in ['diesel', 'e5', 'e10']},
+        **{f"{fuel}_count": data[fuel].count() for fuel in ['diesel', 'e5', 'e10']},
         }])
 
 
+def metadata_from_totals(totals: pd.DataFrame)->pd.DataFrame:
+    """Combines the totals of one or more chunks of a file into the one-row metadata DataFrame of get_metadata(). Adds the number of resolved duplicates if the totals contain them."""
+
+    return pd.DataFrame([{
+        "date": totals['date'].max(),
+        **{f"{fuel}_mean": round(totals[f"{fuel}_sum"].sum() / totals[f"{fuel}_count"].sum(), 3) for fuel in ['diesel', 'e5', 'e10']},
+        **({"duplicates": int(totals['duplicates'].sum())} if 'duplicates' in totals.columns else {}),
+        }])
+
+
+def station_blocks(prices_df: pd.DataFrame):
+    """Positions of the first and last row of each station in a panel sorted by station and date, as it is after process.swap_sort_index()
+
+    Returns:
+        tuple: (stations in the order of the panel, positions of their first rows, positions of their last rows)
+    """
+    stations = prices_df.index.get_level_values('station')
+    first = process.block_starts(stations)
+    last = np.append(first[1:], len(prices_df)) - 1
+    return stations[first], first, last
+
+
 def get_closing_prices(prices_df: pd.DataFrame)->pd.DataFrame:
     """ Get closing prices defined as last price for each station observed for a day"""
 
-    closing_prices = prices_df.groupby(level='station').tail(1).reset_index(level='date')
+    _, _, last = station_blocks(prices_df)
+    closing_prices = prices_df.iloc[last].reset_index(level='date')
     return closing_prices
 
 
-def impute_closing_prices(new_prices: pd.DataFrame, closing_prices: pd.DataFrame)->pd.DataFrame:
+def closing_prices_before(closing_prices: pd.DataFrame, date)->pd.DataFrame:
+    """Restores the closing prices to continue processing on date from closing prices stored by RawPriceProcessor, e.g. the closing_prices metadata file.
+       For each station, its last closing prices before date are used. Stations that closed earlier continue from their last day like in a full run.
+
+    Args:
+        closing_prices (pd.DataFrame): stored closing prices indexed by station with a 'date' column, one row per station and processed day
+        date (str or pd.Timestamp): first day that is going to be processed
+
+    Returns:
+        pd.DataFrame: closing prices in the format of get_closing_prices()
+    """
+
+    dates = pd.to_datetime(closing_prices['date'], utc=True).dt.tz_convert('Europe/Berlin')
+    closing_prices = closing_prices.assign(date=dates)
+    closing_prices = closing_prices[(dates.dt.tz_localize(None) < pd.Timestamp(date)).to_numpy()]
+    closing_prices = closing_prices.sort_values('date', kind='stable').groupby(level=0).tail(1)
+    return closing_prices.rename_axis('station').sort_index()
+
+
+def impute_closing_prices(new_prices: pd.DataFrame, closing_prices: pd.DataFrame, carry_not_selling: bool=False)->pd.DataFrame:
     """Takes a DataFrame of raw data and imputes the last observed price for each station from previous prices
 
     Args:
         new_prices (pd.DataFrame): raw price DataFrame that is currently being processed
         closing_prices (pd.DataFrame): closing prices stored in self.last_closing_prices of previous days
+        carry_not_selling (bool, optional): stations that did not sell a product at closing continue not to sell it, like after a reported price of 0.
+                                            Used between chunks of the same file. Defaults to False, where the closing price is imputed.
 
     Returns:
         pd.DataFrame: raw prices DataFrame with imputed prices on the very first timestamp if no price was reported
     """
 
-    opening_prices = new_prices.groupby(level='station').head(1).reset_index(level=1)
-    opening_prices = opening_prices.fillna(closing_prices)
-
-    # set the datetime index back to where it was and update the new prices with the opening prices
-    opening_prices = opening_prices.set_index('date', append=True)
-    new_prices.update(opening_prices, overwrite = False)
+    # closing prices aligned to the stations of the panel, stations without closing prices are NaN
+    stations, first, _ = station_blocks(new_prices)
+    columns = [c for c in new_prices.columns if c in closing_prices.columns and c != 'date']
+    previous = closing_prices[~closing_prices.index.duplicated(keep='last')].reindex(stations)
+
+    for column in columns:
+        values = previous[column].to_numpy()
+        if carry_not_selling and f'{column}_is_selling' in previous.columns:
+            values = np.where(previous[f'{column}_is_selling'].to_numpy() == 0, 0, values)
+
+        # only missing values in the first row of each station are imputed
+        opening = new_prices[column].to_numpy(copy=True)
+        is_missing = pd.isna(opening[first])
+        opening[first[is_missing]] = values[is_missing]
+        new_prices[column] = opening
     return new_prices
 
 
-def fill_missing_prices(prices_df: pd.DataFrame)->pd.DataFrame:
+def fill_missing_prices(prices_df: pd.DataFrame, opening_hours=None, holidays=None, closing_prices: pd.DataFrame=None)->pd.DataFrame:
     """Function that fills NaN and Zero values of the raw price DataFrame
 
        IMPORTANT: Feature engineering: Assumes that prices are also present when no product is being sold as prices of 0 make o sense
                                        There might be an error when imputing prices for 0 values.
 
+       If opening_hours are passed, an 'is_open' column is added, so that closed stations can be told apart from stations that don't sell a product or report no data.
+
     Args:
         prices_df (pd.DataFrame): Sparse raw price DataFrame with many missing values after stratifying the panel
+        opening_hours (OpeningHours, optional): opening hours index from src.process_stations. Defaults to None.
+        holidays (iterable, optional): dates that are holidays, see process_stations.holiday_dates(). Defaults to None.
+        closing_prices (pd.DataFrame, optional): closing prices of the previous chunk of the same file. Stations that don't sell a product at the start of the chunk
+                                                 keep these prices, as they would without the chunk boundary. Defaults to None.
 
     Returns:
         pd.DataFrame: Price DataFrame with no NaN and no 0 Values
@@ -141,17 +225,31 @@ def fill_missing_prices(prices_df: pd.DataFrame)->pd.DataFrame:
         e5_is_selling = prices_df['e5'].apply(lambda x: 0 if pd.isna(x) else 1),
         e10_is_selling = prices_df['e10'].apply(lambda x: 0 if pd.isna(x) else 1),
     )
+    if opening_hours is not None:
+        prices_df['is_open'] = opening_hours.is_open(
+            prices_df.index.get_level_values('station'),
+            prices_df.index.get_level_values('date'),
+            holidays,
+        ).astype(int)
     prices_df[['diesel', 'e5', 'e10']] = prices_df \
         .groupby(level='station')[['diesel', 'e5', 'e10']] \
-        .fillna(method='ffill') \
-        .fillna(method='bfill')
+        .fillna(method='ffill')
+    if closing_prices is not None and not closing_prices.empty:
+        # closing prices are aligned once per station and repeated over the rows of its block
+        stations, first, last = station_blocks(prices_df)
+        previous = closing_prices[~closing_prices.index.duplicated(keep='last')][['diesel', 'e5', 'e10']].reindex(stations).to_numpy()
+        previous = np.repeat(previous, last - first + 1, axis=0)
+        prices_df[['diesel', 'e5', 'e10']] = prices_df[['diesel', 'e5', 'e10']].fillna(pd.DataFrame(previous, index=prices_df.index, columns=['diesel', 'e5', 'e10']))
+    prices_df[['diesel', 'e5', 'e10']] = prices_df[['diesel', 'e5', 'e10']].fillna(method='bfill')
     return prices_df
 
 
-def split_panel(prices_df: pd.DataFrame, split)->dict:
-    """Function to split panels according to the split-list. Currently only splits into name-like frames and creates a frame for each element in split"""
+def split_panel(prices_df: pd.DataFrame, split, shared=('is_open',))->dict:
+    """Function to split panels according to the split-list. Currently only splits into name-like frames and creates a frame for each element in split.
+       Columns in shared that are present in the panel are kept in every frame."""
     prices_df = process.set_panel_index(prices_df, date='date', individual='station')
-    split_data = {name: prices_df[prices_df.filter(like=name).columns] for name in split}
+    shared = [column for column in shared if column in prices_df.columns]
+    split_data = {name: prices_df[list(prices_df.filter(like=name).columns) + shared] for name in split}
     return split_data
 
 def make_hourly(data: pd.DataFrame)->pd.DataFrame:
@@ -161,11 +259,12 @@ def make_hourly(data: pd.DataFrame)->pd.DataFrame:
 def get_methods()->dict:
     """Library of predefined methods are defined in here"""
     return {
-            'resample_timestamps': resample_timestamps
+            'resample_timestamps': resample_timestamps,
+            'competitor_features': features.competitor_features,
         }
 
 
-def resample_timestamps(prices_df: pd.DataFrame, agg_dict: dict,  date='date', individual='station', freq: str = 'H')->pd.DataFrame:
+def resample_timestamps(prices_df: pd.DataFrame, agg_dict: dict,  date='date', individual='station', freq: str = 'H', level_cache=None)->pd.DataFrame:
     """Function that will transform a panel-like DataFrame with irregular timestamps into equidistant timestamps of desired time-bins.
        Time-bins will have average prices over the interval.
 
@@ -173,6 +272,7 @@ def resample_timestamps(prices_df: pd.DataFrame, agg_dict: dict,  date='date', i
         prices_df (pd.DataFrame): panel-like DataFrame as processed by RawPriceProcessor
         agg_dict (dict): dictionary that defines how each column is to be aggregated within time-bins. Necessary since not all aggregation methods work for all DataTypes
         freq (str, optional): time-bin size. examples: 'H' for hourly 'T' for minutes 'D' for daily data. '5T' is 5 minutes. Defaults to 'H'.
+        level_cache (process.LevelCache, optional): cache of the station level to reuse from the previous file. Defaults to None.
 
     Returns:
         pd.DataFrame: Panel DataFrame with equidistant time-bins
@@ -192,15 +292,16 @@ def resample_timestamps(prices_df: pd.DataFrame, agg_dict: dict,  date='date', i
     # grouping by station and freq-bins, using specified aggregation for all columns. groupby is agnostic to DataTypes so not all aggregations work on every DataType
     prices_df = prices_df.groupby([individual,date]).agg(agg_dict)
 
-    # creating a new index-object that serves as a mask for the resampled DataFrame with equidistant timestamps
-    stations = prices_df.index.get_level_values(individual).unique()
+    # creating the product of all stations and equidistant timestamps from integer codes, only the timestamps are new in each file
+    level_cache = level_cache if level_cache is not None else process.LevelCache()
+    stations, station_codes = level_cache.encode(prices_df.index.get_level_values(individual))
     min_date = prices_df.index.get_level_values(date).min().floor('D')
     max_date = prices_df.index.get_level_values(date).max().ceil('D') - pd.Timedelta(1, unit='us')
     date_range = pd.date_range(min_date, max_date, freq=freq)
-    resampled_index = pd.MultiIndex.from_product([stations, date_range], names=[individual, date])
+    date_codes = date_range.get_indexer(prices_df.index.get_level_values(date))
 
     # applying the resampled index to the original DataFrame and filling the NaNs.
-    prices_df = prices_df.reindex(resampled_index).ffill().bfill()
+    prices_df = process.reindex_product(prices_df, [stations, date_range], [station_codes, date_codes], [individual, date]).ffill().bfill()
 
     return prices_df
 
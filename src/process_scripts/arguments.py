@@ -0,0 +1,42 @@
+"""Command line arguments and directory layout shared by the process scripts, e.g. python -m src.process_scripts.split_prices --start 2023-05-01 --end 2023-05-07"""
+import re
+import argparse
+from pathlib import Path
+
+
+def parse_date_range(description: str) -> argparse.Namespace:
+    """Parses the optional --start and --end dates that are passed on to process_directory()"""
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--start', help='first day to process (YYYY-MM-DD). Defaults to the first file.')
+    parser.add_argument('--end', help='last day to process (YYYY-MM-DD), inclusive. Defaults to the last file.')
+    return parser.parse_args()
+
+
+def subset_directories(directory) -> dict:
+    """Returns the station subsets of a fuel directory like resampled_prices/<fuel> as name -> directory.
+       Since all subsets are processed in one pass (see MultiSubsetProcessor), each subset has its own tree <fuel>/<subset>/<year>/<month>/.
+       'merged' holds the output of merge_prices and is not a subset.
+       The previous layout without subsets (<fuel>/<year>/<month>/) is detected by its year directories and returned as {None: directory}.
+
+    Raises:
+        ValueError: if subset and year directories are mixed, e.g. when old and new outputs were written into the same directory
+    """
+    directories = sorted(d for d in Path(directory).iterdir() if d.is_dir() and d.name != 'merged')
+    is_year = [re.fullmatch(r'\d{4}', d.name) is not None for d in directories]
+    if directories and all(is_year):
+        return {None: Path(directory)}
+    if any(is_year):
+        raise ValueError(f"{directory} mixes year directories of the layout without subsets with subset directories, remove one of them.")
+    return {d.name: d for d in directories}
+
+
+def range_suffix(start=None, end=None) -> str:
+    """Suffix of outputs that only cover a date range, e.g. '_2023-05-01_2023-05-07'. Missing bounds are left out: '_2023-05-01' from start on,
+       '_until_2023-05-07' up to end, and no suffix for all files.
+    """
+    if start and end:
+        return f'_{start}_{end}'
+    if start:
+        return f'_{start}'
+    return f'_until_{end}' if end else ''
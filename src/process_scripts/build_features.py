@@ -0,0 +1,25 @@
+from src.process_files import FeatureProcessor
+
+from pathlib import Path
+from src.config.paths import ROOT_DIR
+from src.process_scripts.arguments import parse_date_range, subset_directories
+
+args = parse_date_range('Build features from resampled prices')
+
+
+resample_dir = Path(ROOT_DIR / 'resampled_prices')
+features_dir = Path(ROOT_DIR / 'features')
+
+print(f"Building features from {resample_dir}")
+print(f"Saving them to {features_dir}")
+
+fuels = ['diesel', 'e5', 'e10']
+
+for fuel in fuels:
+    # features carry state from file to file, so each station subset gets its own processor. merged files are not part of any subset
+    for name, source in subset_directories(resample_dir / fuel).items():
+        target = Path(features_dir / fuel / name) if name else Path(features_dir / fuel)
+
+        # lags and windows in hours: previous hour, same hour yesterday, last day and last week
+        processor = FeatureProcessor(source, target, columns=[fuel], lags=(1, 24), windows=(24, 168))
+        processor.process_directory(args.start, args.end)
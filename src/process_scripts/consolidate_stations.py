@@ -0,0 +1,20 @@
+from src.process_files import StationProcessor
+
+from src.config.paths import STATIONS_DIR, PROCESSED_STATIONS, META_DIR
+from src.process_scripts.arguments import parse_date_range
+
+args = parse_date_range('Consolidate the daily station exports into a station table')
+
+print(f"Consolidating stations from {STATIONS_DIR}")
+print(f"Saving them to {PROCESSED_STATIONS}")
+
+processor = StationProcessor(STATIONS_DIR, PROCESSED_STATIONS)
+
+# continue an existing station table, exports that are already included will be skipped
+table_file = PROCESSED_STATIONS / 'stations_scd.csv'
+if table_file.is_file():
+    processor.load_table(table_file)
+
+processor.process_directory(args.start, args.end)
+processor.save_to_file()
+processor.save_metadata(META_DIR, suffix=f'_{processor.last_date.date()}')
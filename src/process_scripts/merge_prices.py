@@ -2,18 +2,24 @@ from src.process_files import FileMerger
 
 from pathlib import Path
 from src.config.paths import ROOT_DIR
+from src.process_scripts.arguments import parse_date_range, subset_directories, range_suffix
+
+args = parse_date_range('Merge resampled prices into one file per fuel and subset')
 
 resample_dir = Path(ROOT_DIR / 'resampled_prices')
 
 print(f"Merging prices from {Path(resample_dir)}")
-print(f"Saving them to {Path(resample_dir / 'merged')}")
+print(f"Saving them to {Path(resample_dir)} / <fuel> / merged")
 
 fuels = ['diesel', 'e5', 'e10']
 
 for fuel in fuels:
-    source = Path(resample_dir / fuel)
-    target = Path(resample_dir)
-    processor = FileMerger(source, target)
+    # each station subset is processed into its own sub-directory and merged into its own file.
+    # the layout without subsets is merged into resample_dir / merged / <fuel>.csv as before
+    for name, source in subset_directories(resample_dir / fuel).items():
+        target = Path(resample_dir / fuel) if name else resample_dir
+        processor = FileMerger(source, target)
 
-    processor.process_directory()
-    processor.save_to_file(processor.merged_data)
\ No newline at end of file
+        processor.process_directory(args.start, args.end)
+        # a date range is saved next to the merged file of all days instead of replacing it
+        processor.save_to_file(processor.merged_data, name=f'{source.name}{range_suffix(args.start, args.end)}')
@@ -1,8 +1,13 @@
 from src.process_files import PriceProcessor
 
 from pathlib import Path
-from src.config.paths import PROCESSED_PRICES, ROOT_DIR
+from src.config.paths import PROCESSED_PRICES, PROCESSED_DIR, ROOT_DIR
 from src import process_prices
+from src import process
+from src.cache import ResultCache
+from src.process_scripts.arguments import parse_date_range
+
+args = parse_date_range('Resample split prices to hourly timestamps')
 
 
 
@@ -14,10 +19,13 @@ print(f"Saving them to {resample_dir}")
 
 fuels = ['diesel', 'e5', 'e10']
 
+# files are only resampled again if the split file or the parameters below changed
+cache = ResultCache(PROCESSED_DIR / 'cache' / 'resampled_prices', max_bytes=10 * 2**30)
+
 for fuel in fuels:
     source = Path(split_dir / fuel)
     target = Path(resample_dir / fuel)
-    processor = PriceProcessor(source, target)
+    processor = PriceProcessor(source, target, cache=cache)
 
     agg_dict = {
         fuel: 'mean',
@@ -25,5 +33,6 @@ for fuel in fuels:
         'total_changes': 'count'
         }
 
-    processor.set_method(process_prices.resample_timestamps, agg_dict, freq='H')
-    processor.process_directory()
+    # the station level is reused from file to file as long as the stations don't change
+    processor.set_method(process_prices.resample_timestamps, agg_dict, freq='H', level_cache=process.LevelCache())
+    processor.process_directory(args.start, args.end)
@@ -2,6 +2,9 @@ from src.process_files import FileSplitter
 
 from pathlib import Path
 from src.config.paths import PROCESSED_PRICES
+from src.process_scripts.arguments import parse_date_range
+
+args = parse_date_range('Split processed prices by fuel')
 
 split_dir = Path(PROCESSED_PRICES / '..' / 'split_prices')
 print(f"Splitting prices from {PROCESSED_PRICES}")
@@ -9,4 +12,4 @@ print(f"Saving them to {split_dir}")
 
 split = ['diesel', 'e5', 'e10']
 splitter = FileSplitter(PROCESSED_PRICES, split_dir, split)
-splitter.process_directory()
\ No newline at end of file
+splitter.process_directory(args.start, args.end)
\ No newline at end of file
@@ -1,12 +1,269 @@
-from . import process
+"""
+Station Processing Module
+-------------------------
+This module contains all functions that are required to process the daily station exports from Tankerkönig (stations/YEAR/MONTH/YYYY-MM-DD-stations.csv).
+The exports are consolidated into a slowly-changing-dimension table: one row per version of a station with the period it was valid in.
+Only changes between consecutive days are stored, so thousands of days with ~15,000 stations each reduce to a table not much larger than one export.
 
-def process_csv(file):
-    pass
-    # Code to process a price file goes here.
+It includes:
 
-def collect_metadata(data):
-    pass
-    # function that returns a datastructure to add metadata to the metadata DataFrame
+    - file_date(): extract the date of an export from its filename.
 
-if __name__ == "__main__":
-    pass
+    - prepare_snapshot(): normalize one daily export and hash the attributes of each station to compare days cheaply.
+
+    - compare_snapshot(): compare a snapshot with the currently valid versions and return new versions and closed versions.
+
+    - build_table(): combine stored versions and closing dates into the station table with valid_from/valid_to columns.
+
+    - current_versions(): restore the currently valid versions from an existing station table to continue it incrementally.
+
+    - stations_at(): the stations that were valid on a specific date.
+
+    - OpeningHours: weekly opening-hours bitmap of all stations, parsed once from openingtimes_json, to look up if stations are open for whole panels.
+
+    - holiday_dates(): public holidays in Germany to pass on to OpeningHours.is_open().
+"""
+import re
+import json
+
+import pandas as pd
+import numpy as np
+
+STATION_ATTRIBUTES = ['name', 'brand', 'street', 'house_number', 'post_code', 'city', 'latitude', 'longitude', 'first_active', 'openingtimes_json']
+COORDINATES = ['latitude', 'longitude']
+
+# applicable_days is binary encoded, one bit per weekday starting on monday. 128 (bit 7) are holidays
+DAY_BITS = [1, 2, 4, 8, 16, 32, 64, 128]
+QUARTERS_PER_DAY = 96
+
+
+def file_date(file) -> pd.Timestamp:
+    """Extracts the date of a daily export from its filename, e.g. '2023-05-01-stations.csv'"""
+
+    match = re.search(r'\d{4}-\d{2}-\d{2}', str(file))
+    if not match:
+        raise ValueError(f"No date found in the filename of {file}")
+    return pd.Timestamp(match.group())
+
+
+def prepare_snapshot(data: pd.DataFrame, attributes: list=STATION_ATTRIBUTES) -> pd.DataFrame:
+    """Normalizes one daily station export and adds a hash of all attributes to detect changes without comparing each column.
+
+       - Stations that appear more than once in an export are reduced to their last row.
+       - Coordinates are rounded to 6 decimals, all other attributes are compared as stripped strings.
+
+    Args:
+        data (pd.DataFrame): daily station export, ideally read with dtype=str so that e.g. house numbers are not parsed as floats
+        attributes (list, optional): attributes that define a version of a station. Defaults to STATION_ATTRIBUTES.
+
+    Returns:
+        pd.DataFrame: snapshot indexed by uuid with the available attributes and a 'hash' column
+    """
+    attributes = [a for a in attributes if a in data.columns]
+    snapshot = data.drop_duplicates(subset='uuid', keep='last').set_index('uuid')[attributes].copy()
+
+    for column in attributes:
+        if column in COORDINATES:
+            snapshot[column] = pd.to_numeric(snapshot[column], errors='coerce').round(6)
+        else:
+            snapshot[column] = snapshot[column].fillna('').astype(str).str.strip()
+
+    snapshot['hash'] = pd.util.hash_pandas_object(snapshot[attributes], index=False).to_numpy()
+    return snapshot
+
+
+def compare_snapshot(current: pd.DataFrame, snapshot: pd.DataFrame, date: pd.Timestamp):
+    """Compares the snapshot of a day with the currently valid versions of all stations.
+
+    Args:
+        current (pd.DataFrame): currently valid versions indexed by uuid with the columns 'hash' and 'valid_from'
+        snapshot (pd.DataFrame): snapshot of the day as returned by prepare_snapshot()
+        date (pd.Timestamp): date of the snapshot
+
+    Returns:
+        tuple: (new versions valid from date, closed versions with valid_to date, updated current versions, dict of change counts)
+    """
+    known_hash = current['hash'].reindex(snapshot.index)
+    is_changed = known_hash.to_numpy() != snapshot['hash'].to_numpy()
+    is_new = known_hash.isna().to_numpy()
+    is_removed = ~current.index.isin(snapshot.index)
+
+    # stations that changed or are missing in the snapshot close their current version
+    closed_uuids = current.index[is_removed].union(snapshot.index[is_changed & ~is_new])
+    closed = current.loc[closed_uuids, ['valid_from']].assign(valid_to=date)
+
+    versions = snapshot[is_changed].drop(columns='hash').assign(valid_from=date)
+    current = pd.concat([
+        current[~is_removed & ~current.index.isin(versions.index)],
+        snapshot.loc[is_changed, ['hash']].assign(valid_from=date),
+    ])
+
+    counts = {
+        'stations': len(snapshot),
+        'new': int(is_new.sum()),
+        'changed': int((is_changed & ~is_new).sum()),
+        'removed': int(is_removed.sum()),
+    }
+    return versions, closed, current, counts
+
+
+def build_table(versions: list, closed: list) -> pd.DataFrame:
+    """Combines all stored versions and closing dates into one station table.
+
+    Args:
+        versions (list): DataFrames of new versions as returned by compare_snapshot()
+        closed (list): DataFrames of closed versions as returned by compare_snapshot()
+
+    Returns:
+        pd.DataFrame: station table with one row per version, sorted by uuid and valid_from. valid_to is NaT for versions that are still valid.
+    """
+    if not versions:
+        return pd.DataFrame(columns=['uuid', 'valid_from', 'valid_to'])
+
+    table = pd.concat(versions).rename_axis('uuid').reset_index()
+    if closed:
+        closing_dates = pd.concat(closed).rename_axis('uuid').reset_index()
+        table = table.merge(closing_dates, on=['uuid', 'valid_from'], how='left')
+    else:
+        table['valid_to'] = pd.NaT
+
+    columns = ['uuid', 'valid_from', 'valid_to']
+    table = table[columns + [c for c in table.columns if c not in columns]]
+    return table.sort_values(['uuid', 'valid_from'], ignore_index=True)
+
+
+def current_versions(table: pd.DataFrame, attributes: list=STATION_ATTRIBUTES) -> pd.DataFrame:
+    """Restores the currently valid versions from a station table, e.g. one loaded from a csv file, to continue it with new exports.
+
+    Returns:
+        pd.DataFrame: currently valid versions indexed by uuid with the columns 'hash' and 'valid_from'
+    """
+    is_valid = table['valid_to'].isna()
+    current = prepare_snapshot(table[is_valid], attributes)
+    current['valid_from'] = pd.to_datetime(table.loc[is_valid].set_index('uuid')['valid_from'])
+    return current[['hash', 'valid_from']]
+
+
+def stations_at(table: pd.DataFrame, date) -> pd.DataFrame:
+    """Returns all station versions that were valid on date, one row per uuid"""
+
+    date = pd.Timestamp(date)
+    valid_from = pd.to_datetime(table['valid_from'])
+    valid_to = pd.to_datetime(table['valid_to'])
+    is_valid = (valid_from <= date) & (valid_to.isna() | (valid_to > date))
+    return table[is_valid].reset_index(drop=True)
+
+
+def parse_time(value: str) -> int:
+    """Converts an 'HH:MM' string into minutes after midnight"""
+    hours, minutes = value.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def opening_hours_bits(openingtimes_json: str) -> np.ndarray:
+    """Parses one openingtimes_json string into an 8 x 96 boolean array: monday to sunday and holidays in quarter hours.
+       A quarter hour is open if the station is open during any part of it.
+       Periods ending before they start (e.g. '06:00' - '00:00' or '22:00' - '02:00') continue on the following day, equal start and end is open all day.
+       Dated exceptions in 'overrides' are not part of the weekly bitmap.
+
+    Returns:
+        np.ndarray: boolean array, or None if the string contains no opening times
+    """
+    opening_times = json.loads(openingtimes_json) if isinstance(openingtimes_json, str) and openingtimes_json else {}
+    if not opening_times.get('openingTimes'):
+        return None
+
+    # two days per row so that periods past midnight can simply be continued and folded back at the end
+    bits = np.zeros((8, 2 * QUARTERS_PER_DAY), dtype=bool)
+    for entry in opening_times['openingTimes']:
+        days = [day for day, bit in enumerate(DAY_BITS) if entry.get('applicable_days', 0) & bit]
+        for period in entry.get('periods', []):
+            start, end = parse_time(period['startp']), parse_time(period['endp'])
+            if end <= start:
+                end += 24 * 60
+            bits[days, start // 15:-(-end // 15)] = True
+
+    # fold the part after midnight into the following day, sunday continues on monday. Holidays continue into themselves
+    following = [1, 2, 3, 4, 5, 6, 0, 7]
+    week = bits[:, :QUARTERS_PER_DAY].copy()
+    week[following] |= bits[:, QUARTERS_PER_DAY:]
+    return week
+
+
+class OpeningHours:
+    """Weekly opening hours of stations as a compact bitmap: 8 days (monday to sunday and holidays) x 96 quarter hours, packed into 8 x 12 bytes per station.
+       The openingtimes_json strings are parsed only once, identical strings (e.g. of the same brand) only once in total.
+       Afterwards is_open() looks up whole panels of stations and timestamps with array indexing.
+
+       Stations without opening times ('{}') are considered always open, stations without holiday times use their weekday times on holidays.
+
+    Attributes:
+        stations (pd.Index): uuids of all stations in the bitmap
+        bitmap (np.ndarray): uint8 array of shape stations x 8 x 12
+        has_times (np.ndarray): False for stations without any opening times
+        has_holiday (np.ndarray): True for stations with separate opening times on holidays
+    """
+
+    def __init__(self, stations, bitmap: np.ndarray, has_times: np.ndarray, has_holiday: np.ndarray):
+        self.stations = pd.Index(stations)
+        self.bitmap = bitmap
+        self.has_times = has_times
+        self.has_holiday = has_holiday
+
+    @classmethod
+    def from_stations(cls, stations_df: pd.DataFrame, uuid: str='uuid', column: str='openingtimes_json'):
+        """Creates the bitmap from a station DataFrame, e.g. a daily export or the current stations of StationProcessor"""
+
+        stations_df = stations_df.drop_duplicates(subset=uuid, keep='last')
+        codes, strings = pd.factorize(stations_df[column].fillna('{}'))
+
+        parsed = [opening_hours_bits(string) for string in strings]
+        has_times = np.array([bits is not None for bits in parsed], dtype=bool)
+        unique_bits = np.stack([bits if bits is not None else np.ones((8, QUARTERS_PER_DAY), dtype=bool) for bits in parsed])
+        has_holiday = unique_bits[:, 7].any(axis=1) & has_times
+
+        return cls(stations_df[uuid], np.packbits(unique_bits, axis=2)[codes], has_times[codes], has_holiday[codes])
+
+    def is_open(self, stations, timestamps, holidays=None) -> np.ndarray:
+        """Looks up if stations are open at timestamps.
+
+        Args:
+            stations (array-like): uuid for each observation, e.g. df.index.get_level_values('station')
+            timestamps (pd.DatetimeIndex): local time for each observation, e.g. df.index.get_level_values('date')
+            holidays (iterable, optional): dates that are holidays, see holiday_dates(). Defaults to None.
+
+        Returns:
+            np.ndarray: boolean array, True if the station is open or has no opening times
+        """
+        codes = self.stations.get_indexer(stations)
+        is_known = codes >= 0
+        codes = np.where(is_known, codes, 0)
+
+        timestamps = pd.DatetimeIndex(timestamps)
+        days = np.asarray(timestamps.dayofweek)
+        if holidays is not None:
+            is_holiday = np.asarray(pd.Index(timestamps.date).isin(set(holidays)))
+            days = np.where(is_holiday & self.has_holiday[codes], 7, days)
+        quarters = np.asarray(timestamps.hour) * 4 + np.asarray(timestamps.minute) // 15
+
+        packed = self.bitmap[codes, days, quarters // 8]
+        is_open = (packed >> (7 - quarters % 8)) & 1
+        return ~is_known | ~self.has_times[codes] | is_open.astype(bool)
+
+    def save(self, file):
+        """Saves the bitmap into a compressed .npz file"""
+        np.savez_compressed(file, stations=self.stations.to_numpy(dtype=str), bitmap=self.bitmap,
+                            has_times=self.has_times, has_holiday=self.has_holiday)
+
+    @classmethod
+    def load(cls, file):
+        """Loads a bitmap saved with save()"""
+        with np.load(file) as data:
+            return cls(data['stations'], data['bitmap'], data['has_times'], data['has_holiday'])
+
+
+def holiday_dates(years, subdiv: str=None) -> set:
+    """Returns the public holidays in Germany, or in a federal state if subdiv is specified (e.g. 'NW'). Requires the holidays package."""
+    import holidays
+
+    return set(holidays.Germany(years=years, subdiv=subdiv).keys())
@@ -0,0 +1,159 @@
+"""
+Run-Length Module
+-----------------
+This module contains the change-point storage of stratified price panels. RawPriceProcessor stratifies every station at every timestamp of a day
+and forward fills the prices, so almost all rows of a processed file repeat the previous row of their station. In change-point form only
+the rows where a value of the station changes are stored (run-length encoding of prices, *_is_selling flags and is_open), and the dense panel
+or any resampled grid is expanded from them on demand:
+
+    processor = RawPriceProcessor(PRICES_DIR, PROCESSED_DIR / 'price_changes', subset=subset, output_mode='changes')
+    processor.process_directory()
+
+    dense = read_changes(file)
+    hourly = read_changes(file, freq='H')
+
+    # or expand a whole directory for the split and resample scripts
+    PriceProcessor(PROCESSED_DIR / 'price_changes', PROCESSED_PRICES, method=expand_changes).process_directory()
+
+Each file (and each chunk of a file) stays self-contained: the first row of every station is always stored, and so is one row of every timestamp
+of the stratified panel, so that the dense panel is restored exactly, with the same timestamps.
+
+It includes:
+
+    - change_mask(): rows of a sorted panel that differ from the previous row of their station.
+
+    - encode_changes(): reduce a stratified panel to its change points.
+
+    - to_panel(): index a change-point frame read from csv by station and date.
+
+    - expand_changes(): restore the dense panel from change points.
+
+    - sample_changes(): values of each station at the timestamps of an equidistant grid.
+
+    - read_changes(): read a change-point file and expand it.
+"""
+import pandas as pd
+import numpy as np
+
+from . import process
+
+
+def change_mask(panel: pd.DataFrame, columns: list=None) -> np.ndarray:
+    """Returns True for each row of a panel sorted by station and date that is the first of its station or differs from the previous row in any column.
+       NaN equals NaN, so unknown prices don't create change points.
+    """
+    columns = columns if columns is not None else list(panel.columns)
+    is_change = np.zeros(len(panel), dtype=bool)
+    is_change[process.block_starts(panel.index.get_level_values('station'))] = True
+
+    for column in columns:
+        values = panel[column].to_numpy()
+        current, previous = values[1:], values[:-1]
+        is_different = current != previous
+        if values.dtype.kind == 'f':
+            is_different &= ~(np.isnan(current) & np.isnan(previous))
+        is_change[1:] |= is_different
+    return is_change
+
+
+def encode_changes(panel: pd.DataFrame, columns: list=None) -> pd.DataFrame:
+    """Reduces a stratified panel, as processed by process_prices.process_data(), to its change points.
+
+    Args:
+        panel (pd.DataFrame): panel indexed by station and date, sorted by station and date
+        columns (list, optional): columns that define a change. Defaults to None, using all columns.
+
+    Returns:
+        pd.DataFrame: rows of the panel that start a new value of their station, plus one row of each timestamp that would otherwise be lost
+    """
+    is_kept = change_mask(panel, columns)
+
+    # timestamps without any change still belong to the grid of the dense panel
+    codes, timestamps = pd.factorize(panel.index.get_level_values('date'))
+    is_covered = np.zeros(len(timestamps), dtype=bool)
+    is_covered[codes[is_kept]] = True
+    if not is_covered.all():
+        first = np.full(len(timestamps), len(panel), dtype=np.int64)
+        np.minimum.at(first, codes, np.arange(len(panel)))
+        is_kept[first[~is_covered]] = True
+    return panel[is_kept]
+
+
+def to_panel(changes: pd.DataFrame, date: str='date', individual: str='station') -> pd.DataFrame:
+    """Indexes change points that were read from csv by station and date, sorted by station and date.
+       Timestamps are parsed from their UTC offsets, so shifts in daylight saving time need no inference.
+    """
+    if isinstance(changes.index, pd.MultiIndex):
+        return changes.sort_index()
+    dates = pd.to_datetime(changes[date], utc=True).dt.tz_convert('Europe/Berlin')
+    changes = changes.assign(**{date: dates}).set_index([individual, date])
+    return changes.sort_index()
+
+
+def expand_changes(changes: pd.DataFrame, timestamps=None, fill_start: bool=False) -> pd.DataFrame:
+    """Restores the dense panel from change points: every station at every timestamp, each value valid until the next change of its station.
+
+    Args:
+        changes (pd.DataFrame): change points as returned by encode_changes(), or read from csv with columns 'station' and 'date'
+        timestamps (pd.DatetimeIndex, optional): timestamps of the dense panel. Defaults to None, using all timestamps of the change points.
+        fill_start (bool, optional): timestamps before the first change point of a station take its values, like the backfill of resample_timestamps().
+                                     Defaults to False, leaving them NaN.
+
+    Returns:
+        pd.DataFrame: dense panel indexed by station and date
+    """
+    changes = to_panel(changes)
+    stations, station_codes = process.LevelCache().encode(changes.index.get_level_values('station'))
+    if timestamps is None:
+        timestamps = changes.index.get_level_values('date').unique().sort_values()
+    date_codes = timestamps.get_indexer(changes.index.get_level_values('date'))
+
+    # position of the last change point at or before each position of the product, within the block of its station
+    is_known = date_codes >= 0
+    positions = np.full(len(stations) * len(timestamps), -1, dtype=np.int64)
+    positions[station_codes[is_known] * len(timestamps) + date_codes[is_known]] = np.flatnonzero(is_known)
+    positions = np.maximum.accumulate(positions)
+    first_change = np.full(len(stations), len(changes), dtype=np.int64)
+    np.minimum.at(first_change, station_codes[is_known], np.flatnonzero(is_known))
+    first_change = np.repeat(first_change, len(timestamps))
+    positions = np.where(positions >= first_change, positions, first_change if fill_start else -1)
+    positions[positions >= len(changes)] = -1
+
+    index = process.product_index([stations, timestamps], ['station', 'date'])
+    columns = {column: pd.api.extensions.take(changes[column].to_numpy(), positions, allow_fill=True) for column in changes.columns}
+    return pd.DataFrame(columns, index=index, columns=changes.columns)
+
+
+def sample_changes(changes: pd.DataFrame, freq: str='H', start=None, end=None) -> pd.DataFrame:
+    """Values of each station at the timestamps of an equidistant grid, i.e. the last change at or before each timestamp.
+       Timestamps before the first change point of a station take its first values, which continue the closing prices of the previous day.
+       Unlike process_prices.resample_timestamps() the values are not averaged within the intervals.
+
+    Args:
+        changes (pd.DataFrame): change points, see expand_changes()
+        freq (str, optional): frequency of the grid. Defaults to 'H'.
+        start (pd.Timestamp, optional): first timestamp of the grid. Defaults to None, midnight before the first change point.
+        end (pd.Timestamp, optional): last timestamp of the grid. Defaults to None, the end of the day of the last change point.
+
+    Returns:
+        pd.DataFrame: panel indexed by station and date on the grid
+    """
+    changes = to_panel(changes)
+    dates = changes.index.get_level_values('date')
+    start = start if start is not None else dates.min().floor('D')
+    end = end if end is not None else dates.max().ceil('D') - pd.Timedelta(1, unit='us')
+    grid = pd.date_range(start, end, freq=freq)
+
+    # the grid timestamps are added to the timestamps of the change points, so that expanding carries each value to them
+    timestamps = dates.unique().union(grid).sort_values()
+    dense = expand_changes(changes, timestamps, fill_start=True)
+    return dense[dense.index.get_level_values('date').isin(grid)]
+
+
+def read_changes(file, freq: str=None, **kwargs) -> pd.DataFrame:
+    """Reads a change-point file and expands it to the dense panel, or samples it on an equidistant grid of freq. kwargs are passed on to pd.read_csv."""
+
+    changes = pd.read_csv(file, **kwargs)
+    if freq:
+        return sample_changes(changes, freq)
+    return expand_changes(changes)
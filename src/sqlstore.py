@@ -0,0 +1,143 @@
+"""
+SQL Store Module
+----------------
+This module contains an embedded SQLite database for processed, split and resampled panels, so that consumers query one indexed table
+instead of re-reading csv trees under data_processed. Panels are loaded with DatabaseLoader from src.process_files:
+
+    loader = DatabaseLoader(PROCESSED_PRICES / 'dus_plus', table='prices_dus_plus')
+    loader.process_directory()
+    load_stations(pd.read_csv(ROOT_DIR / 'data' / 'stations.csv'))
+
+    read_sql('''SELECT p.date, p.station, p.diesel FROM prices_dus_plus p JOIN stations s ON s.uuid = p.station
+                WHERE s.kreis_name = :kreis AND p.date >= :start''', {'kreis': 'Kreis Mettmann', 'start': '2023-04-01'})
+
+Timestamps are stored as UTC text ('YYYY-MM-DD HH:MM:SS'), which sorts correctly across shifts in daylight saving time and works with the date functions of SQLite.
+Every table has indexes on (station, date) and (date).
+
+It includes:
+
+    - get_engine(): pooled SQLAlchemy engine per database file, shared by notebooks and jobs of the same process.
+
+    - connect(): connection from the pool of get_engine().
+
+    - read_sql(): run a query into a DataFrame.
+
+    - prepare_panel(): reset a panel to columns and convert its timestamps to UTC text.
+
+    - create_table(): create a table and its indexes from the columns of a panel.
+
+    - insert_panel(): bulk insert a panel in batches within one transaction.
+
+    - load_stations(): load a station list (e.g. located with src.subsets) into the 'stations' table.
+"""
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import event
+
+from .config.paths import PROCESSED_DIR
+
+DATABASE_FILE = PROCESSED_DIR / 'prices.sqlite'
+
+# rows per executemany call within the transaction of one file
+BATCH_SIZE = 50_000
+
+_ENGINES = {}
+
+
+def get_engine(file=DATABASE_FILE, pool_size: int=5, max_overflow: int=10) -> sqlalchemy.Engine:
+    """Returns the pooled engine of a database file. Engines are created once per file and process, so all callers share one connection pool.
+       Connections use write-ahead logging, which lets readers query while a loader writes.
+
+    Args:
+        file (str or Path, optional): SQLite database file. Defaults to DATABASE_FILE.
+        pool_size (int, optional): connections kept open in the pool. Defaults to 5.
+        max_overflow (int, optional): additional connections allowed at peak times. Defaults to 10.
+
+    Returns:
+        sqlalchemy.Engine: engine of the database
+    """
+    key = str(file)
+    if key not in _ENGINES:
+        engine = sqlalchemy.create_engine(f'sqlite:///{file}', poolclass=sqlalchemy.pool.QueuePool, pool_size=pool_size, max_overflow=max_overflow)
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA temp_store=MEMORY')
+            cursor.close()
+
+        _ENGINES[key] = engine
+    return _ENGINES[key]
+
+
+def connect(file=DATABASE_FILE) -> sqlalchemy.Connection:
+    """Returns a connection from the pool of the database file, to be used as context manager: with connect() as connection: ..."""
+    return get_engine(file).connect()
+
+
+def read_sql(query: str, params: dict=None, file=DATABASE_FILE, **kwargs) -> pd.DataFrame:
+    """Runs a query with named parameters (e.g. :start) on the database and returns the result as DataFrame. kwargs are passed on to pd.read_sql."""
+
+    with connect(file) as connection:
+        return pd.read_sql(sqlalchemy.text(query), connection, params=params, **kwargs)
+
+
+def prepare_panel(data: pd.DataFrame, date: str='date') -> pd.DataFrame:
+    """Resets the index of a panel into columns and converts its timestamps (tz-aware or strings with offsets) to UTC text"""
+
+    if not isinstance(data.index, pd.RangeIndex):
+        data = data.reset_index()
+    dates = pd.to_datetime(data[date], utc=True)
+    return data.assign(**{date: dates.dt.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def column_type(dtype) -> str:
+    """SQLite type of a pandas dtype"""
+
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+def create_table(connection: sqlalchemy.Connection, table: str, data: pd.DataFrame, station: str='station', date: str='date'):
+    """Creates a table with the columns of a prepared panel if it doesn't exist, with a unique index on (station, date) and an index on (date).
+       The unique index lets reloading a file replace its rows instead of duplicating them.
+    """
+
+    columns = ', '.join(f'"{column}" {column_type(dtype)}' for column, dtype in data.dtypes.items())
+    connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+    connection.exec_driver_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "ix_{table}_{station}_{date}" ON "{table}" ("{station}", "{date}")')
+    connection.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{date}" ON "{table}" ("{date}")')
+
+
+def insert_panel(connection: sqlalchemy.Connection, table: str, data: pd.DataFrame, batch_size: int=BATCH_SIZE) -> int:
+    """Bulk inserts a prepared panel in batches of executemany calls. Rows with an existing (station, date) are replaced.
+       The caller controls the transaction, e.g. with engine.begin(), so that a file is loaded completely or not at all.
+
+    Returns:
+        int: number of inserted rows
+    """
+    columns = ', '.join(f'"{column}"' for column in data.columns)
+    placeholders = ', '.join('?' for _ in data.columns)
+    statement = f'INSERT OR REPLACE INTO "{table}" ({columns}) VALUES ({placeholders})'
+
+    # NaN becomes NULL, numpy scalars become python objects the sqlite3 driver accepts
+    values = data.astype(object).where(data.notna(), None)
+    for start in range(0, len(values), batch_size):
+        rows = list(values.iloc[start:start + batch_size].itertuples(index=False, name=None))
+        connection.exec_driver_sql(statement, rows)
+    return len(values)
+
+
+def load_stations(stations: pd.DataFrame, file=DATABASE_FILE, table: str='stations', uuid: str='uuid'):
+    """Replaces the station table, e.g. data/stations.csv located with subsets.PostcodeIndex.locate() to query prices by region"""
+
+    stations = stations.drop_duplicates(subset=uuid, keep='last')
+    engine = get_engine(file)
+    with engine.begin() as connection:
+        stations.to_sql(table, connection, if_exists='replace', index=False)
+        connection.exec_driver_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "ix_{table}_{uuid}" ON "{table}" ("{uuid}")')
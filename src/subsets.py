@@ -0,0 +1,196 @@
+"""
+Subsets Module
+--------------
+This module contains the creation of station subsets for administrative regions, e.g. all stations in Düsseldorf, in a Kreis or in a federal state.
+Stations are assigned to regions by their postcode, using the georef postcode dataset from opendatasoft that is also used in create_station_subsets.ipynb:
+https://public.opendatasoft.com/explore/dataset/georef-germany-postleitzahl/ (to be placed in the data/ folder).
+Stations with faulty or unknown postcodes are assigned by their coordinates instead.
+
+The regions of all stations are looked up only once, afterwards any subset is a simple comparison on one column and can be passed to FileProcessor.set_subset() directly:
+
+    index = PostcodeIndex.from_file()
+    stations = index.locate(pd.read_csv(ROOT_DIR / 'data' / 'stations.csv'))
+    subset = create_station_subset(stations, ['Düsseldorf', 'Ratingen'], level=3)
+    processor.set_subset(subset, 'station_uuid', 'uuid')
+
+It includes:
+
+    - load_georef(): load and rename the georef postcode dataset.
+
+    - normalize_post_codes(): clean postcodes of the station list to match the georef postcodes.
+
+    - point_in_polygon(): ray casting test of one point in a GeoJSON polygon or multipolygon.
+
+    - PostcodeIndex: postcode -> (location, kreis, state) index with a fallback from coordinates.
+
+    - create_station_subset(): reduce a located station list to the stations of a list of regions.
+"""
+import json
+
+import pandas as pd
+import numpy as np
+
+from .config.paths import ROOT_DIR
+
+GEOREF_FILE = ROOT_DIR / 'data' / 'georef-germany-postleitzahl.csv'
+
+# shortcut dict to select a column by administrative level
+ADMINISTRATIVE_LEVEL = {
+    1: 'state_name',
+    2: 'kreis_name',
+    3: 'location',
+}
+
+GEOREF_COLUMNS = {
+    'Name': 'name',
+    'PLZ Name (short)': 'location',
+    'PLZ Name (long)': 'plz_long',
+    'Geometry': 'geometry',
+    'Geo Point': 'geo_point',
+    'Postleitzahl / Post code': 'plz',
+    'Kreis code': 'kreis_code',
+    'Land name': 'state_name',
+    'Land code': 'state_code',
+    'Kreis name': 'kreis_name',
+}
+
+
+def load_georef(file=GEOREF_FILE) -> pd.DataFrame:
+    """Loads the georef postcode dataset and renames its columns like in create_station_subsets.ipynb. Postcodes are 5-digit strings."""
+
+    georef = pd.read_csv(file, sep=';', dtype={'Postleitzahl / Post code': str})
+    georef = georef.rename(columns=GEOREF_COLUMNS)
+    georef['plz'] = normalize_post_codes(georef['plz'])
+    return georef
+
+
+def normalize_post_codes(post_codes: pd.Series) -> pd.Series:
+    """Extracts 5-digit postcodes from strings or numbers, restoring leading zeros. Faulty postcodes become NaN."""
+
+    post_codes = post_codes.astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+    post_codes = post_codes.str.extract(r'^(\d{4,5})$', expand=False)
+    return post_codes.str.zfill(5)
+
+
+def point_in_polygon(lon: float, lat: float, geometry: dict) -> bool:
+    """Ray casting test if a point lies within a GeoJSON 'Polygon' or 'MultiPolygon'. Holes are respected, the edges of each ring are tested at once."""
+
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    for polygon in polygons:
+        crossings = 0
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=float)
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            is_spanning = (y1 > lat) != (y2 > lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+            crossings += np.count_nonzero(is_spanning & (lon < x_cross))
+        # inside the outer ring and not inside a hole
+        if crossings % 2 == 1:
+            return True
+    return False
+
+
+class PostcodeIndex:
+    """Index of all postcodes with their location, kreis and federal state, built once from the georef dataset.
+
+    Attributes:
+        regions (pd.DataFrame): indexed by postcode with the columns of ADMINISTRATIVE_LEVEL
+        centroids (np.ndarray): latitude and longitude of each postcode area, if available in the dataset
+        geometries (pd.Series): GeoJSON string of each postcode area, if available in the dataset
+    """
+
+    def __init__(self, georef: pd.DataFrame):
+        georef = georef.dropna(subset=['plz']).drop_duplicates(subset='plz').set_index('plz')
+        self.regions = georef[list(ADMINISTRATIVE_LEVEL.values())]
+
+        if 'geo_point' in georef.columns:
+            self.centroids = georef['geo_point'].str.split(',', expand=True).astype(float).to_numpy()
+        else:
+            self.centroids = None
+        self.geometries = georef['geometry'] if 'geometry' in georef.columns else None
+
+    @classmethod
+    def from_file(cls, file=GEOREF_FILE):
+        return cls(load_georef(file))
+
+    def lookup(self, post_codes) -> pd.DataFrame:
+        """Returns location, kreis_name and state_name for each postcode. Unknown postcodes are NaN."""
+
+        post_codes = normalize_post_codes(pd.Series(post_codes))
+        return self.regions.reindex(post_codes).reset_index(drop=True)
+
+    def locate_coordinates(self, latitude, longitude, candidates: int=10) -> pd.DataFrame:
+        """Assigns points to postcode areas by their coordinates.
+           Only the postcode areas with the nearest centroids are tested for containment. If none contains the point, the nearest one is used.
+
+        Args:
+            latitude (array-like): latitudes of the points
+            longitude (array-like): longitudes of the points
+            candidates (int, optional): number of nearest postcode areas to test. Defaults to 10.
+
+        Returns:
+            pd.DataFrame: location, kreis_name and state_name for each point
+        """
+        if self.centroids is None:
+            raise ValueError("The georef dataset contains no 'Geo Point' column to locate coordinates.")
+
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        post_codes = []
+        for lat, lon in zip(latitude, longitude):
+            if np.isnan(lat) or np.isnan(lon):
+                post_codes.append(None)
+                continue
+
+            # equirectangular distances are exact enough to rank nearby centroids
+            distances = (self.centroids[:, 0] - lat) ** 2 + ((self.centroids[:, 1] - lon) * np.cos(np.radians(lat))) ** 2
+            nearest = np.argsort(distances)[:candidates]
+            post_code = self.regions.index[nearest[0]]
+            if self.geometries is not None:
+                for position in nearest:
+                    geometry = self.geometries.iloc[position]
+                    if isinstance(geometry, str) and point_in_polygon(lon, lat, json.loads(geometry)):
+                        post_code = self.regions.index[position]
+                        break
+            post_codes.append(post_code)
+
+        return self.regions.reindex(post_codes).reset_index(drop=True)
+
+    def locate(self, stations: pd.DataFrame, post_code: str='post_code') -> pd.DataFrame:
+        """Adds the columns location, kreis_name and state_name to a station list.
+           Stations are located by their postcode, stations with unknown postcodes by their coordinates if these are available.
+
+        Args:
+            stations (pd.DataFrame): station list, e.g. data/stations.csv or a daily export
+            post_code (str, optional): name of the postcode column. Defaults to 'post_code'.
+
+        Returns:
+            pd.DataFrame: station list with the additional region columns
+        """
+        regions = self.lookup(stations[post_code])
+        is_unknown = regions['state_name'].isna().to_numpy()
+
+        if is_unknown.any() and self.centroids is not None and {'latitude', 'longitude'}.issubset(stations.columns):
+            located = self.locate_coordinates(stations.loc[is_unknown, 'latitude'], stations.loc[is_unknown, 'longitude'])
+            regions.loc[is_unknown, :] = located.to_numpy()
+
+        stations = stations.drop(columns=regions.columns, errors='ignore').reset_index(drop=True)
+        return pd.concat([stations, regions], axis=1)
+
+
+def create_station_subset(stations: pd.DataFrame, names: list, level: int) -> pd.DataFrame:
+    """Reduces a station list with region columns (see PostcodeIndex.locate()) to all stations in the specified regions.
+
+    Args:
+        stations (pd.DataFrame): located station list
+        names (list): names of regions, e.g. ['Düsseldorf', 'Ratingen'] or ['Nordrhein-Westfalen']
+        level (int): administrative level of the names, see ADMINISTRATIVE_LEVEL. 1: state, 2: kreis, 3: location
+
+    Returns:
+        pd.DataFrame: subset of the station list, can be passed to FileProcessor.set_subset() with subset_df_column='uuid'
+    """
+    if level not in ADMINISTRATIVE_LEVEL:
+        raise ValueError(f"level must be one of {list(ADMINISTRATIVE_LEVEL)}")
+    return stations[stations[ADMINISTRATIVE_LEVEL[level]].isin(names)]
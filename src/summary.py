@@ -0,0 +1,502 @@
+"""
+Summary Module
+--------------
+This module contains the summary engine behind visualization.nice_summary(): the table of dtypes, distinct values, missing values, zeros
+and descriptive statistics of each column. summarize() computes it exactly for one DataFrame, converting the numeric columns into one array
+and sorting it once for the minimum, quartiles, maximum and distinct values.
+
+To profile data that does not fit into memory, SummarySketch keeps mergeable sketches per column instead: counts, moments (mean and variance),
+min and max, a HyperLogLog register for distinct values and a compressed quantile sketch. Sketches of chunks, files or whole directories
+(e.g. computed in parallel) are merged into the same table:
+
+    sketch = summarize_directory(PROCESSED_PRICES / 'dus_plus', start='2023-01-01', chunksize=500_000)
+    sketch.table()
+
+    sketch = SummarySketch().update(chunk_a).merge(SummarySketch().update(chunk_b))
+
+Counts, missing values, zeros, mean, std, min and max of sketches are exact. Distinct values are exact up to EXACT_DISTINCT per column,
+and quartiles are exact up to 2 * k values per column. Beyond that, both are approximations with errors of about 1%.
+
+It includes:
+
+    - format_summary(): the nice_summary() table from statistics per column.
+
+    - describe_summary(): the nice_summary() table computed with DataFrame.describe(), the reference of summarize().
+
+    - summary_table(): the nice_summary() table of one DataFrame, from summarize() where it matches describe_summary().
+
+    - check_summary(): regression check of summary_table() against describe_summary().
+
+    - summarize(): exact statistics of one DataFrame in a single pass.
+
+    - HyperLogLog: mergeable approximate count of distinct values.
+
+    - QuantileSketch: mergeable quantiles from weighted centroids.
+
+    - ColumnSketch: mergeable statistics of one column.
+
+    - SummarySketch: mergeable statistics of all columns of many DataFrames.
+
+    - summarize_files(), summarize_directory(): sketch files chunk by chunk without loading them at once.
+
+Running this module as __main__ checks summary_table() against describe_summary() on a sample price file and on frames with datetime,
+boolean and text columns.
+"""
+import pandas as pd
+import numpy as np
+
+from . import fileutils
+from . import archives
+from .catalog import FileCatalog
+
+QUANTILES = [0.25, 0.5, 0.75]
+DESCRIBE_COLUMNS = ['mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+# distinct values of a column that are counted exactly before switching to HyperLogLog
+EXACT_DISTINCT = 10_000
+
+
+def format_summary(stats: pd.DataFrame, rows: int) -> pd.DataFrame:
+    """Formats statistics per column into the table of nice_summary().
+
+    Args:
+        stats (pd.DataFrame): indexed by column with 'dtype', 'nunique', 'count', 'missing', 'zeros' and the DESCRIBE_COLUMNS (NaN for non-numeric columns)
+        rows (int): number of rows of the summarized data
+
+    Returns:
+        pd.DataFrame: one row per column with 'Columns', 'Dtype', 'nunique', 'Non-Null Count', 'Missing', 'Missing %', 'Zero Count' and the describe() columns
+    """
+    counts = stats[['nunique', 'count', 'missing', 'zeros']].astype(np.int64)
+    table = pd.DataFrame({
+        'Dtype': stats['dtype'],
+        'nunique': counts['nunique'],
+        'Non-Null Count': counts['count'],
+        'Missing': counts['missing'],
+        'Missing %': round((counts['missing'] / rows) * 100, 2) if rows else 0.0,
+        'Zero Count': counts['zeros'],
+    })
+    numeric = stats[DESCRIBE_COLUMNS]
+    numeric = numeric[numeric.notna().any(axis=1)].astype(float).round(2)
+    return pd.concat([table, numeric], axis=1) \
+        .fillna('-') \
+        .reset_index() \
+        .rename(columns={'index': 'Columns'}) \
+        .replace({'Missing': 0, 'Missing %': 0}, '-')
+
+
+def describe_summary(df: pd.DataFrame) -> pd.DataFrame:
+    """The nice_summary() table computed with DataFrame.describe(). Several passes over the data, but covers every dtype the way describe() does,
+       e.g. datetime columns or frames without numeric columns (unique, top and freq).
+    """
+    return pd.concat([
+                pd.DataFrame({
+                'Dtype': df.dtypes,
+                'nunique': df.nunique(),
+                'Non-Null Count': df.count(),
+                'Missing': df.isnull().sum(),
+                'Missing %': round((df.isnull().sum()/df.shape[0])*100, 2),
+                'Zero Count': (df == 0).sum(),
+                })
+                ,df.describe().round(2).T.iloc[:,1:]
+            ], axis=1) \
+            .fillna('-') \
+            .reset_index() \
+            .rename(columns={'index': 'Columns'}) \
+            .replace({'Missing': 0, 'Missing %': 0}, '-')
+
+
+def summary_table(df: pd.DataFrame) -> pd.DataFrame:
+    """The nice_summary() table of a DataFrame. summarize() covers frames whose describe() only contains numeric columns.
+       describe() also summarizes datetime and timedelta columns and switches to unique, top and freq for frames without numeric columns,
+       these frames are summarized with describe_summary().
+    """
+    dtypes = df.dtypes
+    has_times = any(pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype) for dtype in dtypes)
+    if has_times or not any(is_described(dtype) for dtype in dtypes):
+        return describe_summary(df)
+    return format_summary(summarize(df), df.shape[0])
+
+
+def check_summary(df: pd.DataFrame):
+    """Raises an AssertionError if summary_table() differs from describe_summary() for df"""
+    pd.testing.assert_frame_equal(summary_table(df), describe_summary(df))
+
+
+def is_described(dtype) -> bool:
+    """True for the dtypes that DataFrame.describe() summarizes, i.e. numbers but not booleans"""
+    return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+
+def sorted_quantiles(values: np.ndarray, counts: np.ndarray, quantiles: list) -> np.ndarray:
+    """Linearly interpolated quantiles (like DataFrame.describe()) of the columns of a sorted array, whose valid values come first.
+
+    Args:
+        values (np.ndarray): array of shape rows x columns, each column sorted with NaN last
+        counts (np.ndarray): number of valid values of each column
+        quantiles (list): quantiles between 0 and 1
+
+    Returns:
+        np.ndarray: array of shape quantiles x columns, NaN for columns without values
+    """
+    result = np.full((len(quantiles), values.shape[1]), np.nan)
+    columns = np.flatnonzero(counts > 0)
+    for row, q in enumerate(quantiles):
+        position = q * (counts[columns] - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts[columns] - 1)
+        low, high = values[lower, columns], values[upper, columns]
+        result[row, columns] = low + (high - low) * (position - lower)
+    return result
+
+
+def summarize(df: pd.DataFrame) -> pd.DataFrame:
+    """Exact statistics of each column of a DataFrame, computed in one pass over each column.
+       The described (numeric) columns are converted into one float array and sorted once, which yields min, quartiles, max and distinct values.
+
+    Returns:
+        pd.DataFrame: statistics indexed by column, see format_summary()
+    """
+    stats = pd.DataFrame(index=df.columns, columns=['dtype', 'nunique', 'count', 'missing', 'zeros'] + DESCRIBE_COLUMNS, dtype=object)
+    stats['dtype'] = df.dtypes
+    described = [column for column, dtype in df.dtypes.items() if is_described(dtype)]
+    others = [column for column in df.columns if column not in described]
+
+    if described:
+        values = df[described].to_numpy(dtype=float)
+        is_missing = np.isnan(values)
+        counts = (~is_missing).sum(axis=0)
+        values = np.sort(values, axis=0)
+
+        # distinct values are the valid values that differ from their predecessor in the sorted column
+        is_valid = np.arange(len(values))[:, None] < counts
+        is_new = np.ones_like(values, dtype=bool)
+        is_new[1:] = values[1:] != values[:-1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.nansum(values, axis=0) / counts
+            variances = np.nansum((values - means) ** 2, axis=0) / (counts - 1)
+
+        stats.loc[described, 'nunique'] = (is_new & is_valid).sum(axis=0)
+        stats.loc[described, 'count'] = counts
+        stats.loc[described, 'missing'] = len(df) - counts
+        stats.loc[described, 'zeros'] = (values == 0).sum(axis=0)
+        stats.loc[described, 'mean'] = np.where(counts > 0, means, np.nan)
+        stats.loc[described, 'std'] = np.where(counts > 1, np.sqrt(variances), np.nan)
+        stats.loc[described, ['min', '25%', '50%', '75%', 'max']] = sorted_quantiles(values, counts, [0] + QUANTILES + [1]).T
+
+    for column in others:
+        series = df[column]
+        is_missing = series.isna().to_numpy()
+        stats.loc[column, ['nunique', 'count', 'missing', 'zeros']] = [
+            series.nunique(), len(series) - is_missing.sum(), is_missing.sum(), (series == 0).sum(),
+        ]
+    return stats
+
+
+class HyperLogLog:
+    """Approximate count of distinct values with 2^p registers of the maximum rank of the value hashes. Registers of two sketches merge with their maximum.
+
+    Attributes:
+        p (int): number of bits of the register index, the relative error is about 1.04 / sqrt(2^p)
+        registers (np.ndarray): uint8 register of each index
+    """
+
+    def __init__(self, p: int=14):
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    def update(self, hashes: np.ndarray):
+        """Adds uint64 hashes of values, e.g. from pd.util.hash_array()"""
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        # rank = position of the first set bit of the remaining bits, counted from the left
+        bit_length = np.where(rest > 0, np.frexp(rest.astype(float))[1], 0)
+        rank = (64 - self.p - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m ** 2 / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+class QuantileSketch:
+    """Quantiles of a stream of values, kept as at most 2 * k weighted centroids. When there are more, adjacent values are combined into k centroids
+       of equal weight, so the rank error is about 1 / k. Up to 2 * k values the quantiles are exact.
+
+    Attributes:
+        k (int): number of centroids after compressing
+        values (np.ndarray): sorted centroid values
+        weights (np.ndarray): number of values of each centroid
+    """
+
+    def __init__(self, k: int=1000):
+        self.k = k
+        self.values = np.array([], dtype=float)
+        self.weights = np.array([], dtype=float)
+
+    def update(self, values: np.ndarray, weights: np.ndarray=None):
+        """Adds values (without NaN), optionally with weights, e.g. the centroids of another sketch"""
+
+        values = np.asarray(values, dtype=float)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+        values, weights = np.r_[self.values, values], np.r_[self.weights, weights]
+        order = np.argsort(values, kind='stable')
+        self.values, self.weights = values[order], weights[order]
+        if len(self.values) > 2 * self.k:
+            self.compress()
+        return self
+
+    def merge(self, other):
+        return self.update(other.values, other.weights)
+
+    def compress(self):
+        """Combines adjacent centroids into k centroids of about equal weight, at their weighted mean"""
+
+        cumulative = np.cumsum(self.weights)
+        bins = np.minimum((cumulative - self.weights) * self.k // cumulative[-1], self.k - 1).astype(np.int64)
+        weights = np.bincount(bins, self.weights, minlength=self.k)
+        sums = np.bincount(bins, self.weights * self.values, minlength=self.k)
+        is_used = weights > 0
+        self.values, self.weights = sums[is_used] / weights[is_used], weights[is_used]
+
+    def quantile(self, quantiles) -> np.ndarray:
+        """Linearly interpolated quantiles like DataFrame.describe(), exact as long as no centroids were combined"""
+
+        if not len(self.values):
+            return np.full(len(quantiles), np.nan)
+        # each centroid sits at the mean rank of its values
+        ranks = np.cumsum(self.weights) - self.weights + (self.weights - 1) / 2
+        total = self.weights.sum()
+        return np.interp(np.asarray(quantiles) * (total - 1), ranks, self.values)
+
+
+class ColumnSketch:
+    """Mergeable statistics of one column: counts, zeros, moments, min and max, distinct values and, for described columns, quantiles.
+
+    Attributes:
+        dtype: dtype of the column in the first DataFrame
+        rows (int): number of values including missing values
+        count (int): number of valid values
+        zeros (int): number of values equal to 0
+        mean (float), m2 (float): mean and sum of squared deviations of the valid values, merged with Chan's formula
+        minimum (float), maximum (float): minimum and maximum of the valid values
+        distinct (np.ndarray): unique hashes of the valid values, None once there are more than EXACT_DISTINCT
+        hll (HyperLogLog): distinct values beyond EXACT_DISTINCT
+        quantiles (QuantileSketch): quantiles of described columns
+    """
+
+    def __init__(self, dtype=None, k: int=1000, p: int=14):
+        self.dtype = dtype
+        self.rows = 0
+        self.count = 0
+        self.zeros = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.distinct = np.array([], dtype=np.uint64)
+        self.hll = HyperLogLog(p)
+        self.quantiles = QuantileSketch(k)
+
+    @property
+    def is_described(self) -> bool:
+        return is_described(self.dtype)
+
+    def update(self, series: pd.Series):
+        """Adds the values of a column of a DataFrame or chunk"""
+
+        if self.dtype is None:
+            self.dtype = series.dtype
+        is_missing = series.isna().to_numpy()
+        valid = series.to_numpy()[~is_missing]
+
+        other = ColumnSketch(self.dtype, self.quantiles.k, self.hll.p)
+        other.rows, other.count = len(series), len(valid)
+        other.zeros = int((series == 0).sum())
+        if len(valid):
+            other.add_distinct(pd.util.hash_array(valid))
+            if self.is_described:
+                values = valid.astype(float)
+                other.mean = float(values.mean())
+                other.m2 = float(((values - other.mean) ** 2).sum())
+                other.minimum, other.maximum = float(values.min()), float(values.max())
+                other.quantiles.update(values)
+        return self.merge(other)
+
+    def add_distinct(self, hashes: np.ndarray):
+        self.hll.update(hashes)
+        if self.distinct is not None:
+            self.distinct = np.union1d(self.distinct, hashes)
+            if len(self.distinct) > EXACT_DISTINCT:
+                self.distinct = None
+
+    def merge(self, other):
+        """Merges the statistics of another sketch of the same column"""
+
+        if self.dtype is None:
+            self.dtype = other.dtype
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.rows += other.rows
+        self.count = count
+        self.zeros += other.zeros
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+        self.hll.merge(other.hll)
+        if self.distinct is not None and other.distinct is not None:
+            self.distinct = np.union1d(self.distinct, other.distinct)
+            if len(self.distinct) > EXACT_DISTINCT:
+                self.distinct = None
+        else:
+            self.distinct = None
+        self.quantiles.merge(other.quantiles)
+        return self
+
+    def nunique(self) -> int:
+        return len(self.distinct) if self.distinct is not None else self.hll.count()
+
+    def stats(self) -> dict:
+        stats = {
+            'dtype': self.dtype,
+            'nunique': self.nunique(),
+            'count': self.count,
+            'missing': self.rows - self.count,
+            'zeros': self.zeros,
+        }
+        if self.is_described and self.count:
+            quartiles = self.quantiles.quantile(QUANTILES)
+            stats.update({
+                'mean': self.mean,
+                'std': np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+                'min': self.minimum,
+                '25%': quartiles[0],
+                '50%': quartiles[1],
+                '75%': quartiles[2],
+                'max': self.maximum,
+            })
+        return stats
+
+
+class SummarySketch:
+    """Mergeable statistics of all columns of many DataFrames, e.g. the chunks of all files of a directory.
+
+    Attributes:
+        columns (dict): column name -> ColumnSketch, in the order the columns appeared
+        rows (int): number of rows of all DataFrames
+        k (int): centroids of the quantile sketches
+        p (int): register bits of the HyperLogLog sketches
+    """
+
+    def __init__(self, k: int=1000, p: int=14):
+        self.columns = {}
+        self.rows = 0
+        self.k = k
+        self.p = p
+
+    def column(self, name, dtype=None) -> ColumnSketch:
+        if name not in self.columns:
+            self.columns[name] = ColumnSketch(dtype, self.k, self.p)
+        return self.columns[name]
+
+    def update(self, df: pd.DataFrame):
+        """Adds a DataFrame or chunk. Columns missing in earlier DataFrames count their rows as missing."""
+
+        for name, series in df.items():
+            sketch = self.column(name, series.dtype)
+            if sketch.rows < self.rows:
+                sketch.rows = self.rows
+            sketch.update(series)
+        self.rows += len(df)
+        for sketch in self.columns.values():
+            sketch.rows = self.rows
+        return self
+
+    def merge(self, other):
+        """Merges the sketch of other DataFrames, e.g. computed in another process"""
+
+        for name, sketch in other.columns.items():
+            own = self.column(name, sketch.dtype)
+            own.rows = self.rows
+            sketch_rows = sketch.rows
+            sketch.rows = other.rows
+            own.merge(sketch)
+            sketch.rows = sketch_rows
+        self.rows += other.rows
+        for sketch in self.columns.values():
+            sketch.rows = self.rows
+        return self
+
+    def stats(self) -> pd.DataFrame:
+        stats = pd.DataFrame([sketch.stats() for sketch in self.columns.values()], index=list(self.columns))
+        return stats.reindex(columns=['dtype', 'nunique', 'count', 'missing', 'zeros'] + DESCRIBE_COLUMNS)
+
+    def table(self) -> pd.DataFrame:
+        """The nice_summary() table of all summarized data"""
+        return format_summary(self.stats(), self.rows)
+
+
+def summarize_files(files: list, chunksize: int=None, prefetch: int=2, k: int=1000, p: int=14, **kwargs) -> SummarySketch:
+    """Sketches csv files chunk by chunk, reading ahead in a background thread. Only one chunk per file is in memory at a time.
+
+    Args:
+        files (list): csv files, compressed files or archive members
+        chunksize (int, optional): rows per chunk. Defaults to None, reading whole files.
+        prefetch (int, optional): chunks read ahead. Defaults to 2.
+        k (int, optional): centroids of the quantile sketches. Defaults to 1000.
+        p (int, optional): register bits of the HyperLogLog sketches. Defaults to 14.
+        **kwargs: passed on to pd.read_csv
+
+    Returns:
+        SummarySketch: sketch of all files
+    """
+    def read_chunks():
+        for file in files:
+            if chunksize:
+                yield from archives.read_csv(file, chunksize=chunksize, **kwargs)
+            else:
+                yield archives.read_csv(file, **kwargs)
+
+    sketch = SummarySketch(k, p)
+    chunks = fileutils.prefetch(read_chunks(), prefetch) if prefetch else read_chunks()
+    for chunk in chunks:
+        sketch.update(chunk)
+    return sketch
+
+
+def summarize_directory(directory, start=None, end=None, subset: str=None, **kwargs) -> SummarySketch:
+    """Sketches the csv files of a directory between start and end, using its FileCatalog. kwargs are passed on to summarize_files()."""
+
+    files = FileCatalog.open(directory).paths(start, end, subset=subset)
+    return summarize_files(files, **kwargs)
+
+
+if __name__ == '__main__':
+    from .config.paths import PRICES_DIR
+
+    sample = FileCatalog.open(PRICES_DIR).sample_files(1, random_state=42)[0]
+    prices = archives.read_csv(sample)
+    frames = {
+        sample.name: prices,
+        'dates': prices.assign(date=pd.to_datetime(prices['date'], utc=True)),
+        'booleans': prices.assign(is_cheap=prices['diesel'] < prices['diesel'].median()),
+        'text': prices[['date', 'station_uuid']],
+    }
+    for name, df in frames.items():
+        check_summary(df)
+        print(f'{name}: summary_table() equals describe_summary()')
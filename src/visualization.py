@@ -1,22 +1,12 @@
-import pandas as pd
-import numpy as np
-
 from sklearn.metrics import accuracy_score, fbeta_score, recall_score, precision_score
 
+from . import summary
+
 def nice_summary(df):
+    """Table of dtype, distinct values, missing values, zeros and describe() statistics of each column, computed in one pass by src.summary,
+       see summary.summary_table(). Pass a summary.SummarySketch instead of a DataFrame to summarize data that was sketched chunk by chunk, e.g. with summary.summarize_directory().
+    """
 
-    return pd.concat([    
-                pd.DataFrame({
-                'Dtype': df.dtypes,
-                'nunique': df.nunique(),
-                'Non-Null Count': df.count(),
-                'Missing': df.isnull().sum(),        
-                'Missing %': round((df.isnull().sum()/df.shape[0])*100, 2),
-                'Zero Count': (df == 0).sum(),
-                })
-                ,df.describe().round(2).T.iloc[:,1:]
-            ], axis=1) \
-            .fillna('-') \
-            .reset_index() \
-            .rename(columns={'index': 'Columns'}) \
-            .replace({'Missing': 0, 'Missing %': 0}, '-')
\ No newline at end of file
+    if isinstance(df, summary.SummarySketch):
+        return df.table()
+    return summary.summary_table(df)
@@ -0,0 +1,321 @@
+"""
+Work Queue Module
+-----------------
+This module contains a work queue on a shared directory, so that several workers (processes on one machine or on different hosts with the same
+network filesystem) can process the files of one directory together without a coordinator service. Workers claim files by creating lease files
+atomically, renew their leases with heartbeats while processing and mark files as done or failed. Leases that are not renewed for lease_seconds
+(e.g. of a crashed worker) are taken over by another worker, files that fail are retried until max_attempts:
+
+    queue = WorkQueue(PROCESSED_DIR / 'queues' / 'split_prices')
+    splitter = FileSplitter(PROCESSED_PRICES, PROCESSED_DIR / 'split_prices', ['diesel', 'e5', 'e10'])
+    splitter.process_directory(queue=queue)      # run the same on every worker
+
+    queue.report()                               # merged report of all workers
+
+Only stateless stages can be distributed this way (FileSplitter, PriceProcessor), as files are processed in no particular order and by different workers.
+The queue directory contains:
+
+    - leases/<key>: file currently processed by a worker, its modification time is the last heartbeat. It contains a unique token of the lease,
+      so workers notice when their lease was taken over and never release or renew the lease of another worker.
+    - leases/.<key>.takeover: lock of a worker that takes over an abandoned lease, so only one worker at a time can replace it
+    - done/<key>.json, failed/<key>.json: result of each file with its worker, attempts, duration and error
+    - attempts/<key>: number of failed or abandoned attempts of a file
+
+Keys are the paths of the files relative to the processed directory, so workers may mount the shared directory at different paths.
+They are percent-encoded into file names ('/' as '%2F'), which keeps them unique and reversible for any file name.
+
+It includes:
+
+    - file_key(), key_path(): key of a file in the queue and the relative path of a key.
+
+    - WorkQueue: lease-based work queue on a shared directory.
+"""
+import os
+import json
+import urllib.parse
+import time
+import uuid
+import socket
+import threading
+import contextlib
+from pathlib import Path
+
+import pandas as pd
+
+
+def file_key(file, root) -> str:
+    """Key of a file in the queue: its path relative to root, percent-encoded into a file name, e.g. '2023%2F05%2F2023-05-01-prices.csv'"""
+    return urllib.parse.quote(Path(file).relative_to(root).as_posix(), safe='')
+
+
+def key_path(key: str) -> str:
+    """Path relative to root of the file of a key, the inverse of file_key()"""
+    return urllib.parse.unquote(key)
+
+
+def write_json(file, data: dict):
+    """Writes a json file atomically, so readers on other hosts never see a partial file"""
+
+    temporary = file.with_name(f'.{file.name}.{os.getpid()}.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(data, f, default=str)
+    os.replace(temporary, file)
+
+
+class WorkQueue:
+    """Lease-based work queue of the files of one run on a shared directory.
+
+    Attributes:
+        directory (Path): shared queue directory
+        worker (str): id of this worker, host name and process id by default
+        lease_seconds (float): time without heartbeat after which a lease is considered abandoned
+        heartbeat_seconds (float): interval of the heartbeats of held leases
+        max_attempts (int): attempts per file before it is marked as failed
+        poll_seconds (float): wait time before checking leases of other workers again
+        held (dict): key -> file of the leases held by this worker
+        tokens (dict): key -> token of the leases held by this worker
+    """
+
+    def __init__(self, directory, worker: str=None, lease_seconds: float=300, heartbeat_seconds: float=30, max_attempts: int=3,
+                 poll_seconds: float=5):
+        self.directory = Path(directory)
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.held = {}
+        self.tokens = {}
+        self.claimed = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heartbeat_thread = None
+        for name in ['leases', 'done', 'failed', 'attempts']:
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+
+    def lease_file(self, key: str) -> Path:
+        return self.directory / 'leases' / key
+
+    def result_file(self, key: str, status: str) -> Path:
+        return self.directory / status / f'{key}.json'
+
+    def is_finished(self, key: str) -> bool:
+        return self.result_file(key, 'done').is_file() or self.result_file(key, 'failed').is_file()
+
+    def attempts(self, key: str) -> int:
+        file = self.directory / 'attempts' / key
+        return int(file.read_text() or 0) if file.is_file() else 0
+
+    def add_attempt(self, key: str) -> int:
+        """Counts a failed or abandoned attempt. Only the holder of the lease of key calls this, so no other worker writes at the same time."""
+
+        attempts = self.attempts(key) + 1
+        file = self.directory / 'attempts' / key
+        temporary = file.with_name(f'.{key}.{os.getpid()}.tmp')
+        temporary.write_text(str(attempts))
+        os.replace(temporary, file)
+        return attempts
+
+    def read_lease(self, key: str):
+        """Returns (token, modification time) of the lease of key, (None, None) if there is none. A lease that is still being written has no token."""
+
+        lease = self.lease_file(key)
+        try:
+            mtime = lease.stat().st_mtime
+            with open(lease) as f:
+                token = json.load(f).get('token')
+        except FileNotFoundError:
+            return None, None
+        except ValueError:
+            token = None
+        return token, mtime
+
+    def lease_content(self, token: str) -> dict:
+        return {'worker': self.worker, 'token': token, 'since': time.time()}
+
+    def acquire(self, key: str) -> bool:
+        """Creates the lease of key atomically. An abandoned lease is replaced under a takeover lock, which only one worker can hold:
+           the lease is checked again under the lock and only replaced if it still has the same token and was not renewed since.
+
+        Returns:
+            bool: True if this worker holds the lease
+        """
+        lease = self.lease_file(key)
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self.take_over(key, token)
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.lease_content(token), f)
+        self.tokens[key] = token
+        return True
+
+    def take_over(self, key: str, token: str) -> bool:
+        """Replaces the lease of key with a new lease of this worker if it was not renewed for lease_seconds. Counts an abandoned attempt."""
+
+        old_token, mtime = self.read_lease(key)
+        if mtime is None or time.time() - mtime < self.lease_seconds:
+            return False
+
+        lock = self.lease_file(key).with_name(f'.{key}.takeover')
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # a takeover lock of a worker that crashed during the takeover is removed, the lease is taken over on the next attempt
+            with contextlib.suppress(FileNotFoundError):
+                if time.time() - lock.stat().st_mtime > self.lease_seconds:
+                    lock.unlink()
+            return False
+        os.close(fd)
+
+        try:
+            # another worker might have taken over or the holder might have renewed the lease since it was read
+            if self.read_lease(key) != (old_token, mtime):
+                return False
+            write_json(self.lease_file(key), self.lease_content(token))
+            self.tokens[key] = token
+            self.add_attempt(key)
+            return True
+        finally:
+            lock.unlink(missing_ok=True)
+
+    def holds(self, key: str) -> bool:
+        """True if the lease of key still is the lease of this worker, i.e. was not taken over after missing heartbeats"""
+
+        token = self.tokens.get(key)
+        return token is not None and self.read_lease(key)[0] == token
+
+    def release(self, key: str):
+        """Removes the lease of key, unless it was taken over by another worker in the meantime"""
+
+        with self.lock:
+            self.held.pop(key, None)
+        if self.holds(key):
+            self.lease_file(key).unlink(missing_ok=True)
+        self.tokens.pop(key, None)
+
+    def heartbeat(self):
+        """Renews the leases of this worker every heartbeat_seconds until close() is called. Runs in a background thread."""
+
+        while not self.stop.wait(self.heartbeat_seconds):
+            with self.lock:
+                keys = list(self.held)
+            for key in keys:
+                # a lease that was taken over after missing heartbeats is not renewed, the result of the other worker counts as well
+                if self.holds(key):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.utime(self.lease_file(key))
+
+    def start_heartbeat(self):
+        if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+            self.stop.clear()
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+
+    def close(self):
+        """Stops the heartbeats. Leases that are still held expire after lease_seconds."""
+
+        self.stop.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def claim(self, files: list, root):
+        """Generator that claims files one at a time and yields them to this worker, until every file is done or failed.
+           Files leased by other workers are checked again every poll_seconds, so abandoned leases are taken over once they expire.
+           Each yielded file must be passed on to complete() or fail().
+
+        Args:
+            files (list): files of the run, the same list on all workers
+            root (Path): directory the files are relative to, see file_key()
+
+        Yields:
+            Path: claimed file
+        """
+        self.start_heartbeat()
+        pending = list(files)
+        try:
+            while pending:
+                waiting = []
+                for file in pending:
+                    key = file_key(file, root)
+                    if self.is_finished(key):
+                        continue
+                    if not self.acquire(key):
+                        waiting.append(file)
+                        continue
+                    # the result might have been written between the check and the lease
+                    if self.is_finished(key):
+                        self.release(key)
+                        continue
+                    if self.attempts(key) >= self.max_attempts:
+                        self.finish(key, file, 'failed', error='abandoned too often')
+                        continue
+
+                    with self.lock:
+                        self.held[key] = file
+                    self.claimed[file] = (key, time.time())
+                    yield file
+                    # failed files are released for another attempt, by this or any other worker
+                    if not self.is_finished(key):
+                        waiting.append(file)
+                pending = waiting
+                if pending:
+                    time.sleep(self.poll_seconds)
+        finally:
+            self.close()
+
+    def finish(self, key: str, file, status: str, **info):
+        """Writes the result of a file and releases its lease. Attempts count the failed and abandoned attempts, plus the successful one."""
+
+        write_json(self.result_file(key, status), {
+            'file': key_path(key),
+            'status': status,
+            'worker': self.worker,
+            'attempts': self.attempts(key) + (status == 'done'),
+            'finished': pd.Timestamp.now().isoformat(),
+            **info,
+        })
+        self.release(key)
+
+    def complete(self, file, **metrics):
+        """Marks a claimed file as done. metrics are stored in the report, the duration since the claim is added."""
+
+        key, started = self.claimed.pop(file)
+        self.finish(key, file, 'done', seconds=round(time.time() - started, 3), **metrics)
+
+    def fail(self, file, error=None):
+        """Releases a claimed file for another attempt, or marks it as failed after max_attempts"""
+
+        key, started = self.claimed.pop(file)
+        if self.add_attempt(key) >= self.max_attempts:
+            self.finish(key, file, 'failed', seconds=round(time.time() - started, 3), error=str(error))
+        else:
+            self.release(key)
+
+    def report(self) -> pd.DataFrame:
+        """Merged report of all workers: one row per finished file with its status, worker, attempts, duration and error"""
+
+        results = []
+        for status in ['done', 'failed']:
+            for file in sorted((self.directory / status).glob('*.json')):
+                with open(file) as f:
+                    results.append(json.load(f))
+        return pd.DataFrame(results)
+
+    def error_files(self, root) -> list:
+        """Files of all workers that failed, as paths below root like FileProcessor.error_files"""
+
+        report = self.report()
+        if report.empty:
+            return []
+        return [Path(root) / file for file in report.loc[report['status'] == 'failed', 'file']]
+
+    def reset(self):
+        """Removes all leases, results and attempts to run the queue again, e.g. after the source files changed"""
+
+        for name in ['leases', 'done', 'failed', 'attempts']:
+            for file in (self.directory / name).iterdir():
+                file.unlink(missing_ok=True)